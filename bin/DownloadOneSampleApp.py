@@ -1,11 +1,13 @@
 """
 Tool to download the appropriate files for a finished app. 
 
-In normal operation, will be called as a subprocess from Downloader.py but can also be run manually.
+Downloader.py and DownloadService.py download SampleApps in-process; this is for downloading one SampleApp by hand,
+whatever its status.
 """
 
 import os
 import sys
+import time
 import logging
 
 # Add relative path libraries
@@ -23,6 +25,7 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('-i', '--id', type=str, dest="id", required=True, help='local ID of SampleApp')
+    parser.add_argument('-f', '--force', dest="force", action="store_true", default=False, help='download every file, even those already present and up to date')
     parser.add_argument('-l', '--logfile', type=str, dest="logfile", default="", help='path to logfile')
 
     parser.add_argument("-L", "--loglevel", dest="loglevel", default="INFO", help="loglevel, default INFO. Choose from WARNING, INFO, DEBUG")
@@ -38,8 +41,11 @@ if __name__ == "__main__":
         logging.debug("Downloading SampleApp: %s %s" % (Repository.SampleAppToSampleName(sampleApp), Repository.SampleAppToAppName(sampleApp)))
         attempt = 0
         MAX_ATTEMPTS = ConfigurationServices.GetConfig("MAX_ATTEMPTS")
-        AppServices.DownloadDeliverable(sampleApp)
-        Repository.SetSampleAppStatus(sampleApp, "downloaded")
+        started = time.time()
+        downloadedFiles = AppServices.DownloadDeliverable(sampleApp, sync=False if args.force else None)
+        summary = AppServices.SummariseDownload(downloadedFiles, time.time() - started)
+        logging.info("downloaded %s" % summary)
+        Repository.SetDeliverableDownloaded(sampleApp, downloadedFiles, summary)
     except Exception as e:
         Repository.SetSampleAppStatus(sampleApp, "download-failed", str(e))
         logging.error(str(e))
\ No newline at end of file
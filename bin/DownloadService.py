@@ -0,0 +1,56 @@
+"""
+Long-lived service that downloads the appropriate files for qc-passed samples as they arrive.
+
+Keeps a pool of worker threads (see DownloadServices.py) with at most MAX_DOWNLOADS downloads in flight,
+checking the database for new work every DOWNLOAD_SERVICE_INTERVAL seconds and whenever a download finishes.
+Stop it with SIGTERM or Ctrl-C; downloads already running are allowed to finish first.
+"""
+
+import os
+import sys
+import signal
+import logging
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import DownloadServices
+import ConfigurationServices
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='run a persistent download service')
+    parser.add_argument('-i', '--interval', type=int, dest="interval", default=ConfigurationServices.GetConfig("DOWNLOAD_SERVICE_INTERVAL"), help='seconds between checks for new work')
+    parser.add_argument('-s', '--safe', dest="safe", default=False, action="store_true", help='safe mode - say what you would do without doing it, then exit')
+    parser.add_argument('-w', '--workers', type=int, dest="workers", default=ConfigurationServices.GetConfig("MAX_DOWNLOADS"), help='maximum number of concurrent downloads')
+    parser.add_argument('-l', '--logtostdout', dest="logtostdout", default=False, action="store_true", help="log to stdout instead of default log file")
+    parser.add_argument("-L", "--loglevel", dest="loglevel", default="INFO", help="loglevel, default INFO. Choose from WARNING, INFO, DEBUG")
+    args = parser.parse_args()
+
+    if args.safe or args.logtostdout:
+        logging.basicConfig(level=args.loglevel, format=ConfigurationServices.GetConfig("LogFormat"))
+    else:
+        logfile = ConfigurationServices.GetConfig("DOWNLOADER_LOG_FILE")
+        if not os.access(os.path.dirname(logfile), os.W_OK):
+            print "log directory: %s does not exist or is not writeable" % (logfile)
+            sys.exit(1)
+        logging.basicConfig(filename=logfile, level=args.loglevel, format=ConfigurationServices.GetConfig("LogFormat"))
+
+    pl = logging.getLogger("peewee")
+    pl.setLevel(logging.INFO)
+
+    service = DownloadServices.DownloadService(args.workers, args.safe)
+    if args.safe:
+        service.RunUntilDone()
+        sys.exit(0)
+
+    def stop(signum, frame):
+        logging.info("stopping download service after %d running downloads finish" % service.NumRunning())
+        service.Stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info("Starting download service (%d workers, checking every %ds)" % (args.workers, args.interval))
+    service.RunForever(args.interval)
+    logging.info("Stopped download service")
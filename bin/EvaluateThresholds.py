@@ -0,0 +1,87 @@
+"""
+Try out a candidate set of QC thresholds against every SampleApp of an app, without going to BaseSpace.
+
+Uses the metrics stored by the QCChecker, or failing that the metrics files kept in the log directory of each SampleApp,
+and reports which SampleApps would flip between passing and failing QC compared to the current thresholds for the app.
+Nothing is changed - to adopt the new thresholds, update the app and reset the SampleApps to app-finished.
+"""
+
+import os
+import sys
+import time
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import Repository
+import AppServices
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='evaluate candidate QC thresholds against the metrics already gathered for an app')
+    parser.add_argument('-n', '--name', type=str, dest="name", required=True, help='name of app')
+    parser.add_argument('-r', '--thresholds', type=str, dest="thresholds", required=True, help='file containing json description of candidate QC thresholds')
+    parser.add_argument('-p', '--project', type=str, dest="project", help='only evaluate SampleApps from this project')
+    parser.add_argument('-a', '--all', dest="all", action="store_true", default=False, help='report the result for every SampleApp, not just those that would change')
+
+    args = parser.parse_args()
+
+    try:
+        candidateEvaluator = AppServices.ThresholdEvaluator(AppServices.ValidateThresholdsJson(open(args.thresholds).read()))
+    except AppServices.AppServicesException as ae:
+        print "invalid threshold json file: %s" % (ae)
+        sys.exit(1)
+    app = Repository.GetAppByName(args.name)
+    currentEvaluator = AppServices.GetThresholdEvaluator(Repository.AppToLocalId(app), Repository.AppToQCThresholds(app))
+    metricNames = candidateEvaluator.metricNames | currentEvaluator.metricNames
+
+    startTime = time.time()
+    constraints = { "name" : args.name }
+    if args.project:
+        constraints["project"] = args.project
+    columns, rows = Repository.GetMetricsMatrix(constraints, sorted(metricNames), exact=True)
+    storedMetrics = dict((rowDetails[0], metrics) for rowDetails, metrics in rows)
+
+    # gather the metrics for each SampleApp, falling back to the local metrics file if they haven't all been stored
+    sampleApps = []
+    metricsList = []
+    numSkipped = 0
+    for sampleApp in Repository.GetSampleAppByConstraints(constraints, exact=True):
+        metrics = storedMetrics.get(Repository.SampleAppToId(sampleApp), {})
+        if len(metrics) < len(metricNames):
+            try:
+                localMetrics = AppServices.ReadLocalQCMetrics(sampleApp, metricNames)
+            except AppServices.AppServicesException:
+                localMetrics = None
+            if localMetrics:
+                metrics = localMetrics
+        if not metrics:
+            numSkipped += 1
+            continue
+        sampleApps.append(sampleApp)
+        metricsList.append(metrics)
+
+    currentFailures = currentEvaluator.EvaluateBatch(metricsList)
+    candidateFailures = candidateEvaluator.EvaluateBatch(metricsList)
+    elapsed = time.time() - startTime
+
+    nowFailing = []
+    nowPassing = []
+    for sampleApp, current, candidate in zip(sampleApps, currentFailures, candidateFailures):
+        if candidate and not current:
+            nowFailing.append((sampleApp, candidate))
+        elif current and not candidate:
+            nowPassing.append((sampleApp, current))
+        elif args.all:
+            print "%s\t%s" % (Repository.SampleAppSummary(sampleApp), ";".join([ str(failure) for failure in candidate ]) if candidate else "pass")
+
+    print "evaluated %d SampleApps of %s in %.2fs (%d skipped with no metrics available)" % (len(sampleApps), args.name, elapsed, numSkipped)
+    print "current thresholds: %d pass, %d fail" % (len([ x for x in currentFailures if not x ]), len([ x for x in currentFailures if x ]))
+    print "candidate thresholds: %d pass, %d fail" % (len([ x for x in candidateFailures if not x ]), len([ x for x in candidateFailures if x ]))
+    print "pass -> fail: %d" % len(nowFailing)
+    for sampleApp, failures in nowFailing:
+        print "\t%s\t%s" % (Repository.SampleAppSummary(sampleApp), ";".join([ str(failure) for failure in failures ]))
+    print "fail -> pass: %d" % len(nowPassing)
+    for sampleApp, failures in nowPassing:
+        print "\t%s\t(was failing: %s)" % (Repository.SampleAppSummary(sampleApp), ";".join([ str(failure) for failure in failures ]))
@@ -0,0 +1,59 @@
+"""
+Export the QC metrics stored by the QCChecker as a tab-separated matrix, with one row per SampleApp and one column per metric.
+
+Useful for looking at trends across a cohort and for tuning QC thresholds, without going back to BaseSpace.
+"""
+
+import os
+import sys
+import csv
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import Repository
+
+ROW_HEADERS = [ "SampleAppId", "Sample", "Project", "App", "Status" ]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='export stored QC metrics as a matrix')
+    # arguments that affect the query, as for ListSampleApps.py
+    parser.add_argument('-i', '--id', type=str, dest="id", help='just export a specific SampleApp id')
+    parser.add_argument('-n', '--name', type=str, dest="name", help='filter by name of app')
+    parser.add_argument('-p', '--project', type=str, dest="project", help='filter by name of project')
+    parser.add_argument('-s', '--sample', type=str, dest="sample", help='filter by name of sample')
+    parser.add_argument('-u', '--status', type=str, dest="status", help='filter by SampleApp status')
+    parser.add_argument('-x', '--exact', dest="exact", action="store_true", default=False, help='use exact matching of search terms')
+    parser.add_argument('-y', '--type', type=str, dest="type", help='filter by app type')
+    # arguments that affect the output
+    parser.add_argument('-m', '--metrics', type=str, dest="metrics", help='comma separated list of metrics to export (default: all)')
+    parser.add_argument('-o', '--output', type=str, dest="output", help='file to write to (default: stdout)')
+
+    args = parser.parse_args()
+
+    constraints = {}
+    if args.name:
+        constraints["name"] = args.name
+    if args.project:
+        constraints["project"] = args.project
+    if args.sample:
+        constraints["sample"] = args.sample
+    if args.status:
+        constraints["status"] = [ args.status ]
+    if args.type:
+        constraints["type"] = args.type
+    if args.id:
+        constraints["id"] = args.id
+    metricNames = args.metrics.split(",") if args.metrics else None
+
+    columns, rows = Repository.GetMetricsMatrix(constraints, metricNames, args.exact)
+
+    outfh = open(args.output, "wb") if args.output else sys.stdout
+    writer = csv.writer(outfh, delimiter="\t", lineterminator="\n")
+    writer.writerow(ROW_HEADERS + columns)
+    for rowDetails, metrics in rows:
+        writer.writerow([ unicode(x).encode("utf-8") for x in rowDetails ] + [ unicode(metrics.get(column, "")).encode("utf-8") for column in columns ])
+    if args.output:
+        outfh.close()
@@ -0,0 +1,47 @@
+"""
+Writes the QC results queued by the QCChecker to BaseSpace as app session properties.
+Designed to be run on a cron, but can be run manually for debugging purposes.
+
+Writes that fail stay queued and are retried on later runs, waiting longer after each failure.
+"""
+
+import os
+import sys
+import logging
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import QCServices
+import ConfigurationServices
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='write queued QC results to BaseSpace')
+    parser.add_argument('-a', '--all', dest="all", default=False, action="store_true", help='retry every queued write now, even those waiting after a failure')
+    parser.add_argument('-s', '--safe', dest="safe", default=False, action="store_true", help='safe mode - say what you would do without doing it')
+    parser.add_argument('-w', '--workers', type=int, dest="workers", default=ConfigurationServices.GetConfig("QC_WORKERS"), help='number of concurrent BaseSpace property writes')
+    parser.add_argument('-l', '--logtostdout', dest="logtostdout", default=False, action="store_true", help="log to stdout instead of default log file")
+    parser.add_argument("-L", "--loglevel", dest="loglevel", default="INFO", help="loglevel, default INFO. Choose from WARNING, INFO, DEBUG")
+    args = parser.parse_args()
+
+    if args.safe or args.logtostdout:
+        logging.basicConfig(level=args.loglevel, format=ConfigurationServices.GetConfig("LogFormat"))
+    else:
+        logfile = ConfigurationServices.GetConfig("QCPROPERTIES_LOG_FILE")
+        if not os.access(os.path.dirname(logfile), os.W_OK):
+            print "log directory: %s does not exist or is not writeable" % (logfile)
+            sys.exit(1)
+        logging.basicConfig(filename=logfile, level=args.loglevel, format=ConfigurationServices.GetConfig("LogFormat"))
+
+    pl = logging.getLogger("peewee")
+    pl.setLevel(logging.INFO)
+
+    logging.debug("Starting qc property flusher")
+
+    numSent, numFailed = QCServices.FlushQCPropertyUpdates(args.workers, args.all, args.safe)
+    if numSent or numFailed:
+        logging.info("wrote %d QC results to BaseSpace, %d failed and will be retried" % (numSent, numFailed))
+
+    logging.debug("Finished qc property flusher")
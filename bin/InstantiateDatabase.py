@@ -2,6 +2,7 @@
 Instantiates the local configuration database. 
 
 Should only need to be run once. Will give an error if one has already been instantiated.
+Use -u to add any new tables and columns to an existing database after upgrading LaunchSpace.
 """
 
 import os
@@ -16,7 +17,19 @@ import ConfigurationServices
 
 
 if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description='Instantiate the local configuration database')
+	parser.add_argument('-u', '--upgrade', dest="upgrade", default=False, action="store_true", help='add any missing tables and columns to an existing database')
+	args = parser.parse_args()
+
 	DBFile = ConfigurationServices.GetConfig("DBFile")
+	if args.upgrade:
+		if not os.path.exists(DBFile):
+			print "DBFile does not exist: %s" % (DBFile)
+			sys.exit(1)
+		DBOrm.upgrade_tables()
+		sys.exit(0)
+
 	if os.path.exists(DBFile):
 		print "DBFile already exists: %s" % (DBFile)
 		sys.exit(1)
@@ -29,6 +29,7 @@ if __name__ == "__main__":
 
     # arguments that affect the way the results are reported
     parser.add_argument('-e', '--showdetails', dest="showdetails", action="store_true", default=False, help='show status details, if any exist')
+    parser.add_argument('-m', '--manifest', dest="manifest", action="store_true", default=False, help='show the verified files downloaded for each SampleApp')
 
     # arguments that cause an update or deletion to the local database
     parser.add_argument('-D', '--delete', dest="delete", action="store_true", default=False, help='delete selected SampleApps')
@@ -65,3 +66,6 @@ if __name__ == "__main__":
             Repository.DeleteSampleApp(sampleApp)
             continue
         print Repository.SampleAppSummary(sampleApp, showDetails=args.showdetails)
+        if args.manifest:
+            for manifestEntry in Repository.GetDownloadManifest(sampleApp):
+                print "\t%s" % Repository.DownloadManifestSummary(manifestEntry)
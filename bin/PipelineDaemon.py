@@ -0,0 +1,52 @@
+"""
+Long-lived service that runs every stage of the pipeline - launcher, tracker, QC checker, QC property flusher and
+downloader - in one process, each on its own schedule (see PIPELINE_INTERVALS and PipelineStages.py).
+
+Use this instead of the cron jobs; the individual scripts still work for one-off runs.
+Stop it with SIGTERM or Ctrl-C; each stage finishes its current run, and downloads already running are allowed to finish.
+"""
+
+import os
+import sys
+import signal
+import logging
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import PipelineStages
+import ConfigurationServices
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='run every stage of the pipeline in one persistent process')
+    parser.add_argument('-s', '--safe', dest="safe", default=False, action="store_true", help='safe mode - say what you would do without doing it')
+    parser.add_argument('-l', '--logtostdout', dest="logtostdout", default=False, action="store_true", help="log to stdout instead of default log file")
+    parser.add_argument("-L", "--loglevel", dest="loglevel", default="INFO", help="loglevel, default INFO. Choose from WARNING, INFO, DEBUG")
+    args = parser.parse_args()
+
+    if args.safe or args.logtostdout:
+        logging.basicConfig(level=args.loglevel, format=ConfigurationServices.GetConfig("LogFormat"))
+    else:
+        logfile = ConfigurationServices.GetConfig("PIPELINE_LOG_FILE")
+        if not os.access(os.path.dirname(logfile), os.W_OK):
+            print "log directory: %s does not exist or is not writeable" % (logfile)
+            sys.exit(1)
+        logging.basicConfig(filename=logfile, level=args.loglevel, format=ConfigurationServices.GetConfig("LogFormat"))
+
+    pl = logging.getLogger("peewee")
+    pl.setLevel(logging.INFO)
+
+    daemon = PipelineStages.PipelineDaemon(safe=args.safe)
+
+    def stop(signum, frame):
+        logging.info("stopping pipeline once the current runs finish")
+        daemon.Stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info("Starting pipeline")
+    daemon.Start()
+    daemon.Wait()
+    logging.info("Stopped pipeline")
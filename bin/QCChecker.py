@@ -1,14 +1,20 @@
+"""
+Applies automated QC to finished apps. Designed to be run on a cron, but can be run manually for debugging purposes.
+
+Metrics downloads run concurrently on a pool of worker threads (see QCServices.py). The QC results are queued
+to be written to BaseSpace as properties by FlushQCProperties.py.
+"""
+
 import os
 import sys
 import logging
-from collections import defaultdict
 
 # Add relative path libraries
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
 
 import Repository
-import AppServices
+import PipelineStages
 import ConfigurationServices
 
 if __name__ == "__main__":
@@ -16,6 +22,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='update status of sample/apps')
     parser.add_argument('-i', '--id', type=str, dest="id", help='update just a specific SampleApp id')
     parser.add_argument('-s', '--safe', dest="safe", default=False, action="store_true", help='safe mode - say what you would do without doing it')
+    parser.add_argument('-w', '--workers', type=int, dest="workers", default=ConfigurationServices.GetConfig("QC_WORKERS"), help='number of concurrent metrics downloads')
+    parser.add_argument('-b', '--batchsize', type=int, dest="batchsize", default=ConfigurationServices.GetConfig("QC_BATCH_SIZE"), help='number of status changes to commit to the database at once')
     parser.add_argument('-l', '--logtostdout', dest="logtostdout", default=False, action="store_true", help="log to stdout instead of default log file")
     parser.add_argument("-L", "--loglevel", dest="loglevel", default="INFO", help="loglevel, default INFO. Choose from WARNING, INFO, DEBUG")
     args = parser.parse_args()
@@ -38,50 +46,8 @@ if __name__ == "__main__":
     if args.id:
         sampleApps = [ Repository.GetSampleAppByID(args.id) ]
     else:
-        # get all samples that are in the app-finished state
-        constraints = { "status" : [ "app-finished" ] }
-        sampleApps = Repository.GetSampleAppByConstraints(constraints)
-        logging.info("Working on %i samples" % len(sampleApps))
-
-    # record what transitions we make (state -> state for each SampleApp) so we can report at the end
-    # all SampleApps will end up in either "qc-failed" or "qc-passed" states
-    transitions = defaultdict(list)
-    for sampleApp in sampleApps:
-        # unpack the SampleApp a little
-        sampleName = Repository.SampleAppToSampleName(sampleApp)
-        appName = Repository.SampleAppToAppName(sampleApp)
-        sampleAppId = Repository.SampleAppToBaseSpaceId(sampleApp)
-        logging.debug("working on: %s %s" % (sampleName, appName))
-
-        if not sampleAppId:
-            logging.warn("No BaseSpace Id for SampleApp: %s" % Repository.SampleAppSummary(sampleApp))
-            continue
-        # apply automated QC to the SampleApp and record the failures
-        failures = AppServices.ApplyAutomatedQCToAppResult(sampleApp)
-        failuredetails = ";".join(failures)
-        # use the failures to determine whether the SampleApp is qc-passed or not
-        if failures:
-            logging.debug("failed: %s" % failures)
-            newstatus = "qc-failed"    
-        else:
-            newstatus = "qc-passed"
-        if args.safe:
-            logging.info("would update %s to: %s" % (Repository.SampleAppSummary(sampleApp), newstatus))
-        else:
-            transition = (Repository.SampleAppToStatus(sampleApp), newstatus)
-            # failuredetails will be a blank string if there are no failures
-            Repository.SetSampleAppStatus(sampleApp, newstatus, failuredetails)
-            AppServices.SetQCResultInBaseSpace(sampleApp, newstatus, failuredetails)
-            transitions[transition].append(sampleAppId)
-
-    # log how many of each transition we've made. If the number is low enough, report which apps have had each transition type
-    for transition in sorted(transitions):
-        if len(transitions[transition]) > 40:
-            logging.info("%s : %i" % (transition, len(transitions[transition])))
-        else:
-            logging.info(
-                "%s : %i (%s)" % (
-                    transition, len(transitions[transition]), ", ".join([str(x) for x in transitions[transition]])))
+        sampleApps = None
+    PipelineStages.RunQCChecker(sampleApps, args.workers, args.batchsize, args.safe)
 
     logging.debug("Finished qc-checker")
 
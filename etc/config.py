@@ -33,8 +33,15 @@ BaseSpaceBaseUri = urljoin(BaseSpaceHost, ApiVersion)
 # 105 Gigabases for a 30X genome
 MinimumYield = 105000000000
 #MinimumYield = 0
+# how to combine the yield from several BaseSpace samples (bundles) with the same sample name
+# "mostrecent" only uses the most recent bundle, "all" adds them all together so top-up sequencing counts
+YieldAggregation = "mostrecent"
+# hours before the Launcher re-checks a waiting SampleApp even if its BaseSpace samples have not changed
+READINESS_FINGERPRINT_EXPIRY = 24
 
 DBFile = os.path.join(SCRIPT_DIR, "../data/db.sqlite")
+# local copies of downloaded QC metrics files, so re-QC doesn't need to fetch them again
+METRICS_CACHE_DIR = os.path.join(SCRIPT_DIR, "../data/metricscache")
 
 # logging
 LogFormat = "%(asctime)s|%(levelname)s|%(message)s"
@@ -42,12 +49,83 @@ LOG_BASE = os.path.join(SCRIPT_DIR, "..", "log")
 LAUNCHER_LOG_FILE = os.path.join(LOG_BASE, "launcher.log")
 TRACKER_LOG_FILE = os.path.join(LOG_BASE, "tracker.log")
 QCCHECKER_LOG_FILE = os.path.join(LOG_BASE, "qcchecker.log")
+QCPROPERTIES_LOG_FILE = os.path.join(LOG_BASE, "qcproperties.log")
 DOWNLOADER_LOG_FILE = os.path.join(LOG_BASE, "downloader.log")
+PIPELINE_LOG_FILE = os.path.join(LOG_BASE, "pipeline.log")
 
 
 # constant values
 MAX_DOWNLOADS = 5
+# number of files from one deliverable downloaded at once
+MAX_FILE_DOWNLOADS_PER_DELIVERABLE = 4
+# files are downloaded in chunks of this many bytes; an interrupted download resumes from its last complete chunk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+# number of chunks of one file downloaded at once, for files of at least DOWNLOAD_PARALLEL_MIN_SIZE bytes
+DOWNLOAD_STREAMS_PER_FILE = 1
+DOWNLOAD_PARALLEL_MIN_SIZE = 1024 * 1024 * 1024
+# number of times a chunk is retried before the download of its file fails
+DOWNLOAD_CHUNK_RETRIES = 3
+# leave deliverable files that are already in the output directory and up to date, rather than downloading them again
+SYNC_DELIVERABLES = True
+# bytes per second all the downloads in one Downloader or DownloadService may use between them; 0 for no limit
+DOWNLOAD_BANDWIDTH_LIMIT = 0
+# bytes per second the link can sustain. If this (or DOWNLOAD_BANDWIDTH_LIMIT) is set, new downloads are only started while
+# the measured throughput is below DOWNLOAD_ADMIT_FRACTION of it, one at a time every DOWNLOAD_ADMIT_SETTLE seconds,
+# with MAX_DOWNLOADS as an upper limit; otherwise up to MAX_DOWNLOADS run at once
+DOWNLOAD_TARGET_BANDWIDTH = 0
+DOWNLOAD_ADMIT_FRACTION = 0.9
+DOWNLOAD_ADMIT_SETTLE = 30
+# order of queued downloads: projects with a higher priority go first (default 0); among projects of the same priority,
+# the one with the fewest downloads running relative to its share (default 1) goes next, and within a project the
+# SampleApp that has been waiting longest
+DOWNLOAD_PROJECT_PRIORITIES = {}
+DOWNLOAD_PROJECT_SHARES = {}
+# bytes to keep free on an output filesystem; downloads that would eat into this wait until space is freed
+DOWNLOAD_DISK_HEADROOM = 10 * 1024 * 1024 * 1024
+# seconds between checks for new qc-passed SampleApps in DownloadService.py
+DOWNLOAD_SERVICE_INTERVAL = 60
+# seconds between runs of each stage in PipelineDaemon.py; a stage with no interval is not run by the daemon
+PIPELINE_INTERVALS = {
+    "launcher" : 600,
+    "tracker" : 300,
+    "qcchecker" : 300,
+    "qcproperties" : 600,
+    "downloader" : 60,
+}
+# seconds a Launcher, Tracker or QCChecker run holds its claim on the SampleApps it is working on, so other runs leave them alone
+# a run that dies without releasing its claim holds them up until it runs out
+CLAIM_LEASE_DURATION = 2 * 60 * 60
+# number of SampleApps a run claims at a time; runs in several processes share out the work a batch at a time
+CLAIM_BATCH_SIZE = 100
+# seconds a Launcher, Tracker or QCChecker run may take before it stops, leaving the rest for the next run to carry on
+# from where it got to. Keep them shorter than the time between cron runs. A stage left out has no limit
+STAGE_TIME_BUDGETS = {
+    "launcher" : 50 * 60,
+    "tracker" : 50 * 60,
+    "qcchecker" : 50 * 60,
+}
+# each stage takes a lock file here while it runs, so a cron run that starts while the last is still going exits straight away
+STAGE_LOCK_DIR = os.path.join(SCRIPT_DIR, "../data")
+# seconds between the Tracker's polls of each live app session. A running session is polled as often as the runtimes of
+# the last TRACKER_RUNTIME_HISTORY finished sessions of the same app suggest, once there are TRACKER_MIN_RUNTIME_HISTORY of them
+TRACKER_MIN_POLL_INTERVAL = 300
+TRACKER_MAX_POLL_INTERVAL = 4 * 60 * 60
+TRACKER_RUNTIME_HISTORY = 50
+TRACKER_MIN_RUNTIME_HISTORY = 5
+# number of times the Downloader tries a SampleApp before marking it download-failed
 MAX_ATTEMPTS = 5
+# seconds a download lease lasts unless renewed, and seconds between renewals
+DOWNLOAD_LEASE_DURATION = 600
+DOWNLOAD_HEARTBEAT_INTERVAL = 60
+# number of concurrent metrics downloads (and BaseSpace property writes) in the QCChecker
+QC_WORKERS = 4
+# number of QC status changes the QCChecker commits to the database at once
+QC_BATCH_SIZE = 50
+# minutes to wait before retrying a failed BaseSpace QC property write, doubling with each failure up to the maximum
+QC_PROPERTY_RETRY_DELAY = 5
+QC_PROPERTY_MAX_RETRY_DELAY = 360
+# whether the QCChecker parses and stores every metric in a metrics file, or only those the app has thresholds for
+STORE_ALL_QC_METRICS = False
 
 # execution details
 PYTHON_EXE = sys.executable
@@ -4,10 +4,26 @@ Services to access BaseSpace App information using BaseSpace v1pre3 API
 
 import os, sys
 import jinja2
+import jinja2.meta
 import json
+import hashlib
+import codecs
 import operator
 import csv
 import logging
+import re
+import shutil
+import threading
+import time
+import datetime
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+# numpy is optional - it speeds up evaluating thresholds across many samples, but we can manage without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Add relative path libraries
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -18,6 +34,7 @@ from BaseSpacePy.api.BaseSpaceAPI import BaseSpaceAPI
 from BaseSpacePy.model.QueryParameters import QueryParameters
 import ConfigurationServices
 import SampleServices
+import TransferServices
 import Repository
 
 class AppServicesException(Exception):
@@ -53,14 +70,38 @@ def CheckConditionsOnSampleApp(sampleApp, ignoreYield=False):
         tumourReady, tumourDetails = CheckConditionsOnSample(tumourName, projectId, ignoreYield)
         if not tumourReady:
             return False, "(Tumour: %s)" % tumourDetails
-        normal = Repository.GetNormalForTumour(sampleName)
-        normalName = Repository.SampleToSampleName(normal)
+        normalName = Repository.GetNormalNameForTumour(sampleName)
         normalReady, normalDetails = CheckConditionsOnSample(normalName, projectId, ignoreYield)
         if not normalReady:
             return False, "(Normal: %s)" % normalDetails
         return True, None
     # FIXME: if this is a trio, look for completed individual builds on all three samples 
 
+def _SampleFingerprint(sampleName, projectId):
+    readiness = SampleServices.GetSampleReadiness(sampleName, projectId)
+    if not readiness.hasData:
+        return "%s:nodata" % sampleName
+    return "%s:%s:%s:%d" % (sampleName, readiness.mostRecent.Id, readiness.mostRecent.DateCreated, readiness.sampleYield)
+
+def GetReadinessFingerprint(sampleApp, ignoreYield=False):
+    """
+    Summarise everything that CheckConditionsOnSampleApp looks at, so the Launcher can tell
+    whether a waiting SampleApp could have changed since it was last checked
+
+    @param sampleApp: (DBOrm.SampleApp)
+    @param ignoreYield: (bool)
+
+    @return (str): a hash of the most recent bundles and yields of the samples behind this SampleApp
+    """
+    projectId = Repository.SampleAppToProjectId(sampleApp)
+    sampleName = Repository.SampleAppToSampleName(sampleApp)
+    appType = Repository.SampleAppToAppType(sampleApp)
+    parts = [ appType, str(ignoreYield), str(ConfigurationServices.GetConfig("MinimumYield")), _SampleFingerprint(sampleName, projectId) ]
+    if appType == "TumourNormal":
+        normalName = Repository.GetNormalNameForTumour(sampleName)
+        parts.append(_SampleFingerprint(normalName, projectId))
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
 def CheckConditionsOnSample(sampleName, projectId, ignoreYield):
     """
     check if the sample has any fastqs and if they are of enough yield
@@ -72,9 +113,10 @@ def CheckConditionsOnSample(sampleName, projectId, ignoreYield):
     @return (bool): whether the conditions are met, (str): any details about why conditions are not met
     """
     yieldThreshold = ConfigurationServices.GetConfig("MinimumYield")
-    if not SampleServices.SampleHasData(sampleName, projectId):
+    readiness = SampleServices.GetSampleReadiness(sampleName, projectId)
+    if not readiness.hasData:
         return False, "No data"
-    sampleYield = SampleServices.GetSampleYield(sampleName, projectId)
+    sampleYield = readiness.sampleYield
     if sampleYield > yieldThreshold:
         return True, None
     else:
@@ -82,27 +124,104 @@ def CheckConditionsOnSample(sampleName, projectId, ignoreYield):
             return True, "Ignoring low yield!"
         return False, "Not enough yield (%d < %d)" % (sampleYield, yieldThreshold)
 
+def _GetSampleReadinessWithData(sampleName, projectId):
+    """
+    @return (SampleServices.SampleReadiness): the readiness for a sample name
+
+    @raises AppServicesException if there is no data for the sample
+    """
+    readiness = SampleServices.GetSampleReadiness(sampleName, projectId)
+    if not readiness.hasData:
+        raise AppServicesException("No data for sample: %s" % sampleName)
+    return readiness
+
 ######
 # routines to build app launch json from templates
 ######
 
-def PopulateTemplate(template, template_vars):
+# compiled launch templates, keyed by (local app id, template hash)
+# every SampleApp of an App shares the same template, so we only compile it once per process
+_compiledTemplates = {}
+
+def _EscapeForJson(value):
+    """
+    jinja2 finalizer: escape a template variable so it can be dropped inside a json string literal
+    """
+    return json.dumps(unicode(value))[1:-1]
+
+class CompiledTemplate(object):
+    """
+    An app launch template that has been parsed and compiled once, ready to render for many SampleApps
+
+    If the template source is itself valid json (variables only appear inside json strings), it is compacted
+    before compilation so that rendering produces the final launch json directly, without a json round trip.
+    Otherwise the rendered output is reparsed as before.
+    """
+
+    def __init__(self, template):
+        try:
+            source = json.dumps(json.loads(template))
+            self.renderedIsJson = True
+            environment = jinja2.Environment(undefined=jinja2.StrictUndefined, finalize=_EscapeForJson)
+        except ValueError:
+            source = template
+            self.renderedIsJson = False
+            environment = jinja2.Environment(undefined=jinja2.StrictUndefined)
+        self.template = environment.from_string(source)
+        # work out which variables the template needs up front, so we don't discover them one render at a time
+        self.requiredVariables = frozenset(jinja2.meta.find_undeclared_variables(environment.parse(source)))
+
+    def Render(self, templateVars):
+        """
+        @param templateVars: (dict) a mapping from variable name to value
+
+        @return (str): json appropriate for an app launch
+
+        @raises AppServicesException if the template cannot be populated
+        """
+        missing = self.requiredVariables.difference(templateVars)
+        if missing:
+            raise AppServicesException("missing variables for template: %s" % ", ".join(sorted(missing)))
+        try:
+            rendered = self.template.render(templateVars)
+        except jinja2.exceptions.UndefinedError as err:
+            raise AppServicesException("missing variables for template: %s" % str(err))
+        if not self.renderedIsJson:
+            # loading and dumping the json removes one level of quoting,
+            # which seems to break the API call if present.
+            rendered = json.dumps(json.loads(rendered))
+        return rendered
+
+def GetCompiledTemplate(appKey, template):
+    """
+    Get the compiled version of an app launch template, compiling it if we haven't seen it before
+
+    @param appKey: (int) local ID of the App that owns the template
+    @param template: (str) a json file, but with {{ variables }} to be filled in
+
+    @return (CompiledTemplate)
+    """
+    templateHash = hashlib.sha1(template.encode("utf-8")).hexdigest()
+    cacheKey = (appKey, templateHash)
+    if cacheKey not in _compiledTemplates:
+        logging.debug("compiling launch template for app: %s (%s)" % (appKey, templateHash))
+        _compiledTemplates[cacheKey] = CompiledTemplate(template)
+    return _compiledTemplates[cacheKey]
+
+def PopulateTemplate(template, template_vars, appKey=None):
     """
     Use jinja2 to fill in an app launch template
 
     @param template: (str) a json file, but with {{ variables }} to be filled in
     @param template_vars: (dict) a mapping from variable name to value
+    @param appKey: (int) local ID of the App that owns the template, used to cache the compiled template
 
     @return (str): json appropriate for an app launch
 
     @raises AppServicesException if the template cannot be populated
     """
     template_vars["ApiVersion"] = ConfigurationServices.GetConfig("ApiVersion")
-    t = jinja2.Template(template, undefined=jinja2.StrictUndefined)
-    try:
-        return t.render(template_vars)
-    except jinja2.exceptions.UndefinedError as err:
-        raise AppServicesException("missing variables for template: %s" % str(err))
+    return GetCompiledTemplate(appKey, template).Render(template_vars)
 
 def SetupTemplateVariables(sampleApp):
     """
@@ -116,27 +235,32 @@ def SetupTemplateVariables(sampleApp):
     """
     projectId = Repository.SampleAppToProjectId(sampleApp)
     sampleName = Repository.SampleAppToSampleName(sampleApp)
-    # GetMostRecentSampleFromSampleName gets a BaseSpace Sample object and then we resolve the Id directly
-    sampleId = SampleServices.GetMostRecentSampleFromSampleName(sampleName, projectId).Id
+    # the readiness index holds the most recent BaseSpace Sample object and then we resolve the Id directly
+    # it also holds all the bundles that counted towards the yield, for templates that can take more than one
+    readiness = _GetSampleReadinessWithData(sampleName, projectId)
+    sampleId = readiness.mostRecent.Id
+    sampleIds = [ bundle.Id for bundle in readiness.bundles ]
     appType = Repository.SampleAppToAppType(sampleApp)
     appName = Repository.SampleAppToAppName(sampleApp)
     templateVars = {}
     if appType == "SingleGenome":
         templateVars["SampleName"] = sampleName
         templateVars["SampleID"] = sampleId
+        templateVars["SampleIDs"] = sampleIds
         templateVars["ProjectID"] = projectId
         templateVars["AppName"] = appName
     elif appType == "TumourNormal":
         # the main sampleName is the tumour in this case
         tumourSampleName = sampleName
         tumourSampleId = sampleId
-        normalSample = Repository.GetNormalForTumour(sampleName)
-        normalSampleName = Repository.SampleToSampleName(normalSample)
-        normalSampleId = SampleServices.GetMostRecentSampleFromSampleName(normalSampleName, projectId).Id
+        normalSampleName = Repository.GetNormalNameForTumour(sampleName)
+        normalReadiness = _GetSampleReadinessWithData(normalSampleName, projectId)
         templateVars["TumourSampleName"] = tumourSampleName
         templateVars["TumourSampleID"] = tumourSampleId
+        templateVars["TumourSampleIDs"] = sampleIds
         templateVars["NormalSampleName"] = normalSampleName
-        templateVars["NormalSampleID"] = normalSampleId
+        templateVars["NormalSampleID"] = normalReadiness.mostRecent.Id
+        templateVars["NormalSampleIDs"] = [ bundle.Id for bundle in normalReadiness.bundles ]
         templateVars["ProjectID"] = projectId
         templateVars["AppName"] = appName
     else:
@@ -153,7 +277,7 @@ def SampleAppToPopulatedTemplate(sampleApp):
     """
     template = Repository.SampleAppToTemplate(sampleApp)
     launchVars = SetupTemplateVariables(sampleApp)
-    return PopulateTemplate(template, launchVars)
+    return PopulateTemplate(template, launchVars, Repository.SampleAppToLocalAppId(sampleApp))
 
 ######
 # app launch and tracking
@@ -184,10 +308,8 @@ def ConfigureAndLaunchApp(sampleApp):
 
     @return (str): the app session ID of the launched app
     """
+    # the compiled template renders straight to compact json, so no need to reparse it here
     populatedTemplate = SampleAppToPopulatedTemplate(sampleApp)
-    # loading and dumping the json removes one level of quoting,
-    # which seems to break the API call if present.
-    populatedTemplate = json.dumps(json.loads(populatedTemplate))
     appId = Repository.SampleAppToAppId(sampleApp)
     return LaunchApp(appId, populatedTemplate)
 
@@ -219,138 +341,581 @@ def GetAppStatus(appSessionId):
         raise AppServicesException("Unknown app session status: %s" % bsStatus)
     return status
 
+# app session statuses the Tracker polls BaseSpace for
+LIVE_STATUSES = [ "submitted", "pending", "running" ]
+
+def GetAppRuntimes():
+    """
+    @return (dict): local app id -> runtimes in seconds of its most recently finished app sessions, shortest first
+    """
+    return Repository.GetAppRuntimes(ConfigurationServices.GetConfig("TRACKER_RUNTIME_HISTORY"))
+
+def NextPollTime(sampleApp, status, runtimes, now=None):
+    """
+    Work out when the Tracker should next ask BaseSpace about a live app session. A running session is left alone
+    until sessions of the same app that ran this long have started to finish, then polled more often as it goes on,
+    between TRACKER_MIN_POLL_INTERVAL and TRACKER_MAX_POLL_INTERVAL seconds apart.
+
+    @param sampleApp: (DBOrm.SampleApp)
+    @param status: (str) the status BaseSpace has just given for the session
+    @param runtimes: (list of float) runtimes in seconds of finished sessions of the same app, shortest first
+    @param now: (datetime) defaults to now
+
+    @return (datetime): when to poll the session next, or None if it is no longer live
+    """
+    if status not in LIVE_STATUSES:
+        return None
+    if now is None:
+        now = datetime.datetime.now()
+    minInterval = ConfigurationServices.GetConfig("TRACKER_MIN_POLL_INTERVAL")
+    maxInterval = ConfigurationServices.GetConfig("TRACKER_MAX_POLL_INTERVAL")
+    launched = Repository.SampleAppToLaunched(sampleApp)
+    interval = minInterval
+    # a session waiting to run could start and finish at any time, and without a history we can't tell when one will finish
+    if status == "running" and launched and len(runtimes) >= ConfigurationServices.GetConfig("TRACKER_MIN_RUNTIME_HISTORY"):
+        elapsed = (now - launched).total_seconds()
+        # the runtimes of past sessions that were still going at this point
+        remaining = [ runtime for runtime in runtimes if runtime > elapsed ]
+        if remaining:
+            # look again once the first tenth of those would have finished
+            interval = remaining[len(remaining) // 10] - elapsed
+        # otherwise this session has run longer than any before it, and could finish at any moment
+    interval = max(minInterval, min(maxInterval, interval))
+    return now + datetime.timedelta(seconds=interval)
+
 
 ######
 # Automated QC 
 ######
 
-def ValidateThresholdsJson(jsonText):
+# the comparisons a threshold can use, from the operator module
+THRESHOLD_OPERATORS = frozenset([ "lt", "le", "eq", "ne", "ge", "gt" ])
+
+# compiled QC thresholds, keyed by (local app id, thresholds hash)
+# every SampleApp of an App shares the same thresholds, so we only parse and validate them once per process
+_thresholdEvaluators = {}
+
+class QCFailure(namedtuple("QCFailure", [ "metric", "value", "operator", "threshold", "error" ])):
     """
-    unpack thresholds from a json string and raises an exception if they are not in the expected format
+    A metric that failed QC: the value found (None if it was missing), the comparison it failed,
+    and why the comparison could not be made (None if it simply did not meet the threshold)
+    """
+    __slots__ = ()
 
-    @param jsonText: (str) thresholds encoded as json
+    def __str__(self):
+        if self.value is None:
+            return "%s (missing)" % self.metric
+        description = "%s (%s %s %s)" % (self.metric, self.value, self.operator, self.threshold)
+        if self.error:
+            description += " (%s)" % self.error
+        return description
 
-    @raises AppServicesException: if the json string is not in the expected format.
+def _IsNumber(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def _ValidateThresholds(thresholds):
+    """
+    check that unpacked thresholds are in the expected format
+
+    @param thresholds: (dict) metric_name->metric_details
+
+    @raises AppServicesException: if the thresholds are not in the expected format.
     """
     REQUIRED_FIELDS = set([ "operator", "threshold" ])
-    thresholds = json.loads(jsonText)
+    if not isinstance(thresholds, dict):
+        raise AppServicesException("thresholds should be a mapping from metric name to threshold")
     for tname in thresholds:
         tdetails = thresholds[tname]
-        if set(tdetails.keys()) != REQUIRED_FIELDS:
+        if not tname.strip():
+            raise AppServicesException("threshold with blank metric name")
+        if not isinstance(tdetails, dict) or set(tdetails.keys()) != REQUIRED_FIELDS:
             raise AppServicesException("improperly specified threshold: %s" % tname)
+        if tdetails["operator"] not in THRESHOLD_OPERATORS:
+            raise AppServicesException("unknown operator for threshold: %s (%s)" % (tname, tdetails["operator"]))
+        if not _IsNumber(tdetails["threshold"]) and not isinstance(tdetails["threshold"], basestring):
+            raise AppServicesException("threshold should be a number or a string: %s (%s)" % (tname, tdetails["threshold"]))
 
-def _CompareQCResultToThresholds(qcResults, thresholds):
+def ValidateThresholdsJson(jsonText):
     """
-    compare the qcresults from a finished app to some appropriate thresholds
-    each threshold entry has a value and an operator. If $(<metric> <operator> <value>) (eg. insert_size ge 300)
-    the metric passes qc otherwise it fails
+    unpack thresholds from a json string and raises an exception if they are not in the expected format
 
-    @param qcResults: (dict) metric_name->value mapping for an app result
-    @param thresholds: (dict) metric_name->metric_details. 
+    @param jsonText: (str) thresholds encoded as json
 
-    @return (list of str): descriptions of the failing metrics
+    @return (dict): metric_name->metric_details
 
-    @raises AppServicesException: if a required metric is missing
+    @raises AppServicesException: if the json string is not in the expected format.
     """
-    failures = []
-    for metricName in thresholds:
-        if metricName not in qcResults:
-            raise AppServicesException("Metric missing from qc results: %s %s" % (metricName, qcResults))
-        thresholdDetails = thresholds[metricName]
-        metricOperator = thresholdDetails["operator"]
-        metricValue = thresholdDetails["threshold"]
-        operatorFunction = getattr(operator, metricOperator)
-        # try/except partly to catch problems with the metrics - eg. NA values
-        try:
-            if not operatorFunction(qcResults[metricName], metricValue):
-                failureMessage = "%s (%s %s %s)" % (metricName, qcResults[metricName], operatorFunction.__name__, metricValue)
-                failures.append(failureMessage)
-        except Exception as e:
-            failureMessage = "%s (%s %s %s) (%s)" % (metricName, qcResults[metricName], operatorFunction.__name__, metricValue, str(e))
-            failures.append(failureMessage)
-    return failures
+    try:
+        thresholds = json.loads(jsonText)
+    except ValueError as e:
+        raise AppServicesException("thresholds are not valid json: %s" % str(e))
+    _ValidateThresholds(thresholds)
+    return thresholds
 
-def _ReadQCResult(qcFile):
+class ThresholdEvaluator(object):
     """
-    business logic for reading metrics from a file and packing them into a dictionary
-    this business logic is currently selected by file extension and has been tested against the Isaac V2 app
-    and the tumour/normal app. This method may need to be extended to support QC for other app types.
+    The QC thresholds for an App, validated and compiled once, ready to evaluate against many sets of metrics
 
-    @param qcFile: (filepath)
+    Each threshold entry has a value and an operator. If $(<metric> <operator> <value>) (eg. insert_size ge 300)
+    the metric passes qc otherwise it fails. Where the threshold is a number the metric must be a number too
+    (numbers stored as strings are converted), so that values like NA fail rather than being compared as strings.
+    """
 
-    @return (dict): metric->value
+    def __init__(self, thresholds):
+        """
+        @param thresholds: (dict) metric_name->metric_details, as stored for an App
+
+        @raises AppServicesException: if the thresholds are not in the expected format.
+        """
+        _ValidateThresholds(thresholds)
+        # (metric name, operator name, operator function, threshold, whether the threshold is numeric)
+        self.checks = []
+        for metricName in sorted(thresholds):
+            thresholdDetails = thresholds[metricName]
+            threshold = thresholdDetails["threshold"]
+            self.checks.append((metricName, thresholdDetails["operator"], getattr(operator, thresholdDetails["operator"]),
+                                threshold, _IsNumber(threshold)))
+        self.metricNames = frozenset(thresholds)
+
+    def _Check(self, check, value):
+        metricName, operatorName, operatorFunction, threshold, numeric = check
+        if value is None:
+            return QCFailure(metricName, None, operatorName, threshold, "missing")
+        if numeric:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                return QCFailure(metricName, value, operatorName, threshold, "not a number")
+            if not operatorFunction(number, threshold):
+                return QCFailure(metricName, value, operatorName, threshold, None)
+        elif not operatorFunction(value, threshold):
+            return QCFailure(metricName, value, operatorName, threshold, None)
+        return None
+
+    def Evaluate(self, qcResults):
+        """
+        compare the qcresults from a finished app to the thresholds
+
+        @param qcResults: (dict) metric_name->value mapping for an app result
+
+        @return (list of QCFailure): the failing metrics, in metric name order
+
+        @raises AppServicesException: if a required metric is missing
+        """
+        missing = self.metricNames.difference(qcResults)
+        if missing:
+            raise AppServicesException("Metric missing from qc results: %s" % ", ".join(sorted(missing)))
+        failures = []
+        for check in self.checks:
+            failure = self._Check(check, qcResults[check[0]])
+            if failure:
+                failures.append(failure)
+        return failures
+
+    def EvaluateBatch(self, metricsList):
+        """
+        compare many sets of metrics to the thresholds, working through one metric at a time across all the sets
+        (vectorised with numpy if it is available)
+
+        @param metricsList: (list of dict) metric_name->value, one for each sample
+
+        @return (list of list of QCFailure): the failing metrics for each set of metrics. Missing metrics are reported as failures.
+        """
+        failures = [ [] for metrics in metricsList ]
+        for check in self.checks:
+            metricName, operatorName, operatorFunction, threshold, numeric = check
+            values = [ metrics.get(metricName) for metrics in metricsList ]
+            if numeric and numpy is not None and values:
+                numericIndexes = []
+                numbers = []
+                otherIndexes = []
+                for index, value in enumerate(values):
+                    try:
+                        numbers.append(float(value))
+                        numericIndexes.append(index)
+                    except (TypeError, ValueError):
+                        otherIndexes.append(index)
+                # only the numbers are compared in one go; anything missing or not a number is left to _Check,
+                # which reports why it can't be compared
+                if numbers:
+                    with numpy.errstate(invalid="ignore"):
+                        passes = operatorFunction(numpy.array(numbers), threshold).tolist()
+                    for index, passed in zip(numericIndexes, passes):
+                        if not passed:
+                            failures[index].append(self._Check(check, values[index]))
+                for index in otherIndexes:
+                    failure = self._Check(check, values[index])
+                    if failure:
+                        failures[index].append(failure)
+            else:
+                for index, value in enumerate(values):
+                    failure = self._Check(check, value)
+                    if failure:
+                        failures[index].append(failure)
+        return failures
 
-    @raises AppServicesException: if the metrics file is of unknown type (extension)
+def GetThresholdEvaluator(appKey, thresholdsJson):
     """
+    Get the compiled version of an App's QC thresholds, compiling them if we haven't seen them before
+
+    @param appKey: (int) local ID of the App that owns the thresholds
+    @param thresholdsJson: (str) thresholds encoded as json
+
+    @return (ThresholdEvaluator)
+
+    @raises AppServicesException: if the thresholds are not in the expected format.
+    """
+    thresholdsHash = hashlib.sha1(thresholdsJson.encode("utf-8")).hexdigest()
+    cacheKey = (appKey, thresholdsHash)
+    if cacheKey not in _thresholdEvaluators:
+        logging.debug("compiling QC thresholds for app: %s (%s)" % (appKey, thresholdsHash))
+        _thresholdEvaluators[cacheKey] = ThresholdEvaluator(ValidateThresholdsJson(thresholdsJson))
+    return _thresholdEvaluators[cacheKey]
+
+def SampleAppToThresholdEvaluator(sampleApp):
+    """
+    @param sampleApp: (DBOrm.SampleApp)
+
+    @return (ThresholdEvaluator): the compiled QC thresholds for the SampleApp's app
+    """
+    return GetThresholdEvaluator(Repository.SampleAppToLocalAppId(sampleApp), Repository.SampleAppToQCThresholdsJson(sampleApp))
+
+######
+# metrics file parsers
+# business logic for reading metrics from a file and packing them into a dictionary, selected by file extension.
+# These have been tested against the Isaac V2 app and the tumour/normal app; other app types may need a new parser,
+# registered with RegisterMetricsParser().
+######
+
+# metrics file extension -> parser
+# a parser takes (open file, set of wanted metric names or None for all of them) and returns metric->value
+_metricsParsers = {}
+
+def RegisterMetricsParser(extension, parser):
+    """
+    @param extension: (str) the end of the metrics file name that this parser handles, eg. ".json" or "metrics.json".
+        Where more than one extension matches a file, the longest wins.
+    @param parser: (function) (file, set of str or None) -> (dict) metric->value
+    """
+    _metricsParsers[extension] = parser
+
+def _MetricNamePrefixes(wantedMetrics):
+    """
+    every dot-separated prefix of the wanted metric names (eg. A and A.b for A.b.c),
+    so a parser can tell whether a table or column holds anything wanted without building every name
+    """
+    prefixes = set()
+    for metricName in wantedMetrics:
+        index = metricName.find(".")
+        while index != -1:
+            prefixes.add(metricName[:index])
+            index = metricName.find(".", index + 1)
+    return prefixes
+
+def _ReadCsvMetrics(fh, wantedMetrics):
+    # assumes each row is a key/value pair
     qcValues = {}
-    # really crude handling of different file types. Refactor later if desired.
-    if qcFile.endswith(".csv"):
-        # assumes each row is a key/value pair
-        reader = csv.reader(open(qcFile))
-        for row in reader:
-            if len(row) != 2:
-                continue
+    for row in csv.reader(fh):
+        if len(row) != 2:
+            continue
+        metricName = row[0].strip(":")
+        if wantedMetrics is not None and metricName not in wantedMetrics:
+            continue
+        try:
+            qcValues[metricName] = float(row[1].strip("%"))
+        except ValueError:
+            continue
+    return qcValues
+
+JSON_READ_SIZE = 1024 * 1024
+_jsonWhitespace = re.compile(r"\s*")
+# the characters that can follow a complete value inside an object
+_jsonValueEnds = ",}]:"
+
+class _JsonObjectReader(object):
+    """
+    Reads the (key, value) pairs of a json object one at a time from a file, so that only one top-level entry
+    (plus a read buffer) is held in memory at once rather than the whole decoded file
+    """
+
+    def __init__(self, fh, readSize=JSON_READ_SIZE):
+        # decode as we read, so multi-byte characters split across reads are handled
+        self.reader = codecs.getreader("utf-8")(fh)
+        self.readSize = readSize
+        self.decoder = json.JSONDecoder()
+        self.buf = u""
+        self.pos = 0
+        self.eof = False
+
+    def _ReadMore(self):
+        # read at least as much again as we already have, so retrying a partial decode stays linear
+        chunk = self.reader.read(max(self.readSize, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def _NextChar(self):
+        while True:
+            self.pos = _jsonWhitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise AppServicesException("unexpected end of json metrics file")
+            self._ReadMore()
+
+    def _Expect(self, chars, after):
+        char = self._NextChar()
+        if char not in chars:
+            raise AppServicesException("invalid json metrics file: expected one of '%s' after %s" % (chars, after))
+        self.pos += 1
+        return char
+
+    def _Decode(self):
+        self._NextChar()
+        while True:
             try:
-                qcValues[row[0].strip(":")] = float(row[1].strip("%"))
-            except ValueError:
-                continue
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value is only complete if it is followed by something that can't continue it (a number split
+                # across reads as "-2." or "-2.5e" decodes as a shorter number), otherwise it might go on in the next read
+                if self.eof or (end < len(self.buf) and (self.buf[end] in _jsonValueEnds or self.buf[end].isspace())):
+                    self.pos = end
+                    return value
+            except ValueError as e:
+                if self.eof:
+                    raise AppServicesException("invalid json metrics file: %s" % str(e))
+            self._ReadMore()
+
+    def _ExpectEnd(self):
+        while True:
+            self.pos = _jsonWhitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                raise AppServicesException("invalid json metrics file: extra data after the end of the object")
+            if self.eof:
+                return
+            self._ReadMore()
+
+    def Items(self):
+        """
+        @return (generator of (unicode, object)): the key and decoded value of each entry in the object
+
+        @raises AppServicesException: if the file does not contain a json object
+        """
+        self._Expect("{", "start of file")
+        if self._NextChar() == "}":
+            self.pos += 1
+            self._ExpectEnd()
+            return
+        while True:
+            key = self._Decode()
+            self._Expect(":", key)
+            yield key, self._Decode()
+            if self._Expect(",}", key) == "}":
+                self._ExpectEnd()
+                return
+
+def _ReadJsonTableMetrics(fh, wantedMetrics):
     # this assumes a specific format of json based on the tumour/normal output
     # the tumour/normal output has several top-level entries, each of which is a table.
-    # this code "flattens" these tables into namespaced elements like 
+    # this code "flattens" these tables into namespaced elements like
     # VariantStatsTable.Insertions.dbSNP
-    elif qcFile.endswith(".json"):
-        metrics = json.load(open(qcFile))
-        for metricType in metrics:
-            metricDetails = metrics[metricType]
-            if "header" in metricDetails:
-                headers = metricDetails["header"]
-            elif "tableColumns" in metricDetails:
-                headers = metricDetails["tableColumns"]
-            else:
+    # tables and columns that contain none of the wanted metrics are skipped
+    qcValues = {}
+    prefixes = _MetricNamePrefixes(wantedMetrics) if wantedMetrics is not None else None
+    for metricType, metricDetails in _JsonObjectReader(fh).Items():
+        if prefixes is not None and metricType not in prefixes:
+            continue
+        if not isinstance(metricDetails, dict):
+            continue
+        if "header" in metricDetails:
+            headers = metricDetails["header"]
+        elif "tableColumns" in metricDetails:
+            headers = metricDetails["tableColumns"]
+        else:
+            continue
+        assert "rows" in metricDetails, "expected to find rows in metrics details"
+        rows = metricDetails["rows"]
+        for colIndex in range(1, len(headers)):
+            columnName = headers[colIndex]
+            if prefixes is not None and "%s.%s" % (metricType, columnName) not in prefixes:
                 continue
-            assert "rows" in metricDetails, "expected to find rows in metrics details"
-            rows = metricDetails["rows"]
             for row in rows:
-                for colIndex in range(1, len(headers)):
-                    columnName = headers[colIndex]
-                    rowName = row[0]
-                    rowColValue = row[colIndex]
-                    flatName = "%s.%s.%s" % (metricType, columnName, rowName)
-                    qcValues[flatName] = rowColValue
-    else:
-        raise AppServicesException("unknown extension on QC file: %s" % qcFile)
+                flatName = "%s.%s.%s" % (metricType, columnName, row[0])
+                if wantedMetrics is None or flatName in wantedMetrics:
+                    qcValues[flatName] = row[colIndex]
     return qcValues
 
+RegisterMetricsParser(".csv", _ReadCsvMetrics)
+RegisterMetricsParser(".json", _ReadJsonTableMetrics)
 
-def ApplyAutomatedQCToAppResult(sampleApp):
+def _ReadQCResult(qcFile, wantedMetrics=None):
     """
-    Assesses the QC status of an app result from a SampleApp
+    read metrics from a file using the parser registered for its extension
 
-    @param sampleApp: (DBOrm.SampleApp)
+    @param qcFile: (filepath)
+    @param wantedMetrics: (set of str) only read these metrics, or None to read everything in the file
 
-    @return (list of str): descriptions of the failing metrics
+    @return (dict): metric->value
 
-    @raises AppServicesException: if the app results do not look as expected
+    @raises AppServicesException: if the metrics file is of unknown type (extension) or cannot be parsed
+    """
+    extensions = [ extension for extension in _metricsParsers if qcFile.endswith(extension) ]
+    if not extensions:
+        raise AppServicesException("unknown extension on QC file: %s" % qcFile)
+    parser = _metricsParsers[max(extensions, key=len)]
+    with open(qcFile, "rb") as fh:
+        return parser(fh, wantedMetrics)
+
+
+# everything needed to fetch the metrics file for a SampleApp, unpacked from the database objects
+# so the fetch can happen away from the database (eg. on a worker thread)
+QCDownloadJob = namedtuple("QCDownloadJob", [ "basespaceId", "metricsFile", "qcPath", "appResultName" ])
+
+def SampleAppToQCDownloadJob(sampleApp):
+    """
+    @param sampleApp: (DBOrm.SampleApp)
+
+    @return (QCDownloadJob)
     """
-    thresholds = Repository.SampleAppToQCThresholds(sampleApp)
-    metricsFile = Repository.SampleAppToMetricsFile(sampleApp)
     outputDir = Repository.SampleAppToOutputDirectory(sampleApp)
-    basespaceId = Repository.SampleAppToBaseSpaceId(sampleApp)
-    appResultName = Repository.SampleAppToAppResultName(sampleApp)
     qcDirName = ConfigurationServices.GetConfig("SAMPLE_LOG_DIR_NAME")
-    qcPath = os.path.join(outputDir, qcDirName)
+    return QCDownloadJob(
+        basespaceId=Repository.SampleAppToBaseSpaceId(sampleApp),
+        metricsFile=Repository.SampleAppToMetricsFile(sampleApp),
+        qcPath=os.path.join(outputDir, qcDirName),
+        appResultName=Repository.SampleAppToAppResultName(sampleApp)
+    )
+
+def GetAppResultFiles(basespaceId, appResultName):
+    """
+    List the files in the app result of an app session, without downloading them
+
+    @param basespaceId: (str) app session ID
+    @param appResultName: (str) which app result to use, if the app session has more than one
+
+    @return (list of BaseSpace file objects)
+    """
+    appResult = baseSpaceAPI.getAppResultFromAppSessionId(basespaceId, appResultName)
+    return baseSpaceAPI.getAppResultFiles(appResult.Id, noLimitQP)
+
+def _MakeDirectory(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # another thread may have beaten us to it
+            if not os.path.isdir(path):
+                raise
+
+def _GetCachedMetricsFile(basespaceId, appResultName, qcFile):
+    """
+    Get a local copy of a metrics file from the metrics cache, downloading it only if we don't already have it.
+    The cache is keyed by app session, app result name, file ID and size, so a given metrics file only ever
+    needs to be fetched once, however many times the SampleApp is re-QC'd.
+
+    @param basespaceId: (str) app session ID
+    @param appResultName: (str)
+    @param qcFile: (BaseSpace file object)
+
+    @return (str): path to the cached file
+    """
+    cacheKey = hashlib.sha1(("%s|%s|%s|%s" % (basespaceId, appResultName, qcFile.Id, qcFile.Size)).encode("utf-8")).hexdigest()
+    cacheDir = os.path.join(ConfigurationServices.GetConfig("METRICS_CACHE_DIR"), cacheKey[:2], cacheKey)
+    fileName = os.path.basename(qcFile.Path)
+    cachedPath = os.path.join(cacheDir, fileName)
+    if os.path.exists(cachedPath) and os.path.getsize(cachedPath) == qcFile.Size:
+        logging.debug("reusing cached metrics file: %s" % cachedPath)
+        return cachedPath
+    # download somewhere private and then move into place, so a half-downloaded file is never picked up from the cache
+    downloadDir = "%s.%d.%d.partial" % (cacheDir, os.getpid(), threading.current_thread().ident)
+    _MakeDirectory(downloadDir)
+    _MakeDirectory(cacheDir)
+    logging.debug("downloading metrics file %s from appsession Id %s" % (fileName, basespaceId))
+    qcFile.downloadFile(baseSpaceAPI, downloadDir)
+    os.rename(os.path.join(downloadDir, qcFile.Name), cachedPath)
+    os.rmdir(downloadDir)
+    return cachedPath
+
+def DownloadQCMetricsFile(qcDownloadJob):
+    """
+    Download the metrics file for a finished app, reusing a cached copy if the file has not changed
+
+    @param qcDownloadJob: (QCDownloadJob)
+
+    @return (str): the path of the downloaded metrics file
+
+    @raises AppServicesException: if the app results do not look as expected
+    """
+    basespaceId, metricsFile, qcPath, appResultName = qcDownloadJob
     # make directory to write qc file into
-    if not os.path.exists(qcPath):
-        os.makedirs(qcPath)
+    _MakeDirectory(qcPath)
     logging.debug("retrieving basespace files with extension %s from appsession Id %s" % (metricsFile, basespaceId))
-    qcFiles = baseSpaceAPI.downloadAppResultFilesByExtension(basespaceId, metricsFile, qcPath, appResultName, noLimitQP)
+    qcFiles = [ qcFile for qcFile in GetAppResultFiles(basespaceId, appResultName) if qcFile.Name.endswith(metricsFile) ]
     if len(qcFiles) != 1:
         raise AppServicesException("did not get exactly one metrics file for QC!")
     qcFile = qcFiles[0]
+    cachedPath = _GetCachedMetricsFile(basespaceId, appResultName, qcFile)
+    # keep a copy of the metrics alongside the sample output, as we always have
     qcFilePath = os.path.join(qcPath, os.path.basename(qcFile.Path))
+    if not (os.path.exists(qcFilePath) and os.path.samefile(cachedPath, qcFilePath)):
+        if os.path.exists(qcFilePath):
+            os.remove(qcFilePath)
+        try:
+            os.link(cachedPath, qcFilePath)
+        except OSError:
+            # probably on a different filesystem to the cache
+            shutil.copyfile(cachedPath, qcFilePath)
     logging.debug("got file: %s" % qcFilePath)
-    qcResults = _ReadQCResult(qcFilePath)
-    failures = _CompareQCResultToThresholds(qcResults, thresholds)
+    return qcFilePath
+
+def EvaluateQCMetricsFile(sampleApp, qcFilePath):
+    """
+    Parse a downloaded metrics file and compare it to the thresholds for the SampleApp's app
+
+    @param sampleApp: (DBOrm.SampleApp)
+    @param qcFilePath: (str)
+
+    @return (dict): metric->value for the metrics in the file (just those with thresholds, unless STORE_ALL_QC_METRICS is set),
+        (list of QCFailure): the failing metrics
+
+    @raises AppServicesException: if the metrics file does not look as expected
+    """
+    evaluator = SampleAppToThresholdEvaluator(sampleApp)
+    wantedMetrics = None if ConfigurationServices.GetConfig("STORE_ALL_QC_METRICS") else evaluator.metricNames
+    qcResults = _ReadQCResult(qcFilePath, wantedMetrics)
+    failures = evaluator.Evaluate(qcResults)
+    return qcResults, failures
+
+def ReadLocalQCMetrics(sampleApp, wantedMetrics=None):
+    """
+    Read the metrics for a SampleApp from the copy of its metrics file kept in the sample output log directory,
+    without going to BaseSpace
+
+    @param sampleApp: (DBOrm.SampleApp)
+    @param wantedMetrics: (set of str) only read these metrics, or None to read everything in the file
+
+    @return (dict): metric->value, or None if there is no local metrics file for this SampleApp
+    """
+    qcDownloadJob = SampleAppToQCDownloadJob(sampleApp)
+    if not os.path.isdir(qcDownloadJob.qcPath):
+        return None
+    qcFileNames = [ fileName for fileName in os.listdir(qcDownloadJob.qcPath) if fileName.endswith(qcDownloadJob.metricsFile) ]
+    if len(qcFileNames) != 1:
+        return None
+    return _ReadQCResult(os.path.join(qcDownloadJob.qcPath, qcFileNames[0]), wantedMetrics)
+
+def ApplyAutomatedQCToAppResult(sampleApp):
+    """
+    Assesses the QC status of an app result from a SampleApp
+
+    @param sampleApp: (DBOrm.SampleApp)
+
+    @return (list of QCFailure): the failing metrics
+
+    @raises AppServicesException: if the app results do not look as expected
+    """
+    qcFilePath = DownloadQCMetricsFile(SampleAppToQCDownloadJob(sampleApp))
+    qcResults, failures = EvaluateQCMetricsFile(sampleApp, qcFilePath)
     return failures
 
 def SetQCResultInBaseSpace(sampleApp, qcResult, details=""):
@@ -365,7 +930,18 @@ def SetQCResultInBaseSpace(sampleApp, qcResult, details=""):
 
     @raises AppServicesException: if the BaseSpace call fails for any reason
     """
-    basespaceId = Repository.SampleAppToBaseSpaceId(sampleApp)
+    SetQCResultForAppSession(Repository.SampleAppToBaseSpaceId(sampleApp), qcResult, details)
+
+def SetQCResultForAppSession(basespaceId, qcResult, details=""):
+    """
+    as SetQCResultInBaseSpace(), but given the app session ID directly so it can be called away from the database
+
+    @param basespaceId: (str) app session ID
+    @param qcResult: (bool)
+    @param details: (str) why the qc failed
+
+    @raises AppServicesException: if the BaseSpace call fails for any reason
+    """
     namespace = ConfigurationServices.GetConfig("QC_NAMESPACE")
     try:
         qcPayload = { "QCResult" : str(qcResult) }
@@ -379,22 +955,191 @@ def SetQCResultInBaseSpace(sampleApp, qcResult, details=""):
 # Download
 ######
 
-def DownloadDeliverable(sampleApp):
+# everything needed to download the deliverable for a SampleApp, unpacked from the database objects
+# so the download can happen away from the database (eg. on a worker thread)
+# if sync is set, files already in place and up to date are skipped; manifest is the SampleApp's download manifest,
+# as a dict of file name -> TransferServices.DownloadedFile
+DeliverableDownloadJob = namedtuple("DeliverableDownloadJob", [ "basespaceId", "deliverableList", "outputDir", "appResultName", "sync", "manifest" ])
+
+def _SampleAppToDownloadedFiles(sampleApp):
+    """
+    @return (dict): file name -> TransferServices.DownloadedFile, from the download manifest of the SampleApp
+    """
+    return dict((Repository.DownloadManifestToName(manifestEntry), TransferServices.DownloadedFile(
+        fileId=Repository.DownloadManifestToFileId(manifestEntry),
+        name=Repository.DownloadManifestToName(manifestEntry),
+        path=Repository.DownloadManifestToPath(manifestEntry),
+        size=Repository.DownloadManifestToSize(manifestEntry),
+        etag=Repository.DownloadManifestToEtag(manifestEntry),
+        checksum=Repository.DownloadManifestToChecksum(manifestEntry),
+        verification=Repository.DownloadManifestToVerification(manifestEntry),
+        transferred=0,
+        skipped=True)) for manifestEntry in Repository.GetDownloadManifest(sampleApp))
+
+def SampleAppToDeliverableDownloadJob(sampleApp, sync=None):
+    """
+    @param sampleApp: (DBOrm.SampleApp)
+    @param sync: (bool) skip files that are already in place and up to date (defaults to SYNC_DELIVERABLES)
+
+    @return (DeliverableDownloadJob)
+    """
+    if sync is None:
+        sync = ConfigurationServices.GetConfig("SYNC_DELIVERABLES")
+    return DeliverableDownloadJob(
+        basespaceId=Repository.SampleAppToBaseSpaceId(sampleApp),
+        deliverableList=Repository.SampleAppToDeliverableList(sampleApp),
+        outputDir=Repository.SampleAppToOutputDirectory(sampleApp),
+        appResultName=Repository.SampleAppToAppResultName(sampleApp),
+        sync=sync,
+        manifest=_SampleAppToDownloadedFiles(sampleApp) if sync else {})
+
+def FormatBytes(numBytes):
+    """
+    @return (str): eg. "1.2 GB"
+    """
+    for unit in [ "B", "KB", "MB", "GB" ]:
+        if numBytes < 1024:
+            return "%.1f %s" % (numBytes, unit)
+        numBytes /= 1024.0
+    return "%.1f TB" % numBytes
+
+def FormatThroughput(numBytes, seconds):
+    """
+    @return (str): eg. "1.2 GB in 35.0s (35.1 MB/s)"
+    """
+    rate = numBytes / seconds if seconds > 0 else 0
+    return "%s in %.1fs (%s/s)" % (FormatBytes(numBytes), seconds, FormatBytes(rate))
+
+def SummariseDownload(downloadedFiles, seconds):
+    """
+    @param downloadedFiles: (list of TransferServices.DownloadedFile)
+    @param seconds: (float) how long the download took
+
+    @return (str): eg. "3 files, 1 already present (1.5 GB skipped), 2.4 GB in 70.0s (35.1 MB/s)"
+    """
+    skippedFiles = [ downloadedFile for downloadedFile in downloadedFiles if downloadedFile.skipped ]
+    throughput = FormatThroughput(sum(downloadedFile.transferred for downloadedFile in downloadedFiles), seconds)
+    if not skippedFiles:
+        return "%d files, %s" % (len(downloadedFiles), throughput)
+    return "%d files, %d already present (%s skipped), %s" % (len(downloadedFiles), len(skippedFiles),
+                                                             FormatBytes(sum(downloadedFile.size for downloadedFile in skippedFiles)), throughput)
+
+def _SelectDeliverableFiles(appResultFiles, deliverableList):
+    """
+    @param appResultFiles: (list of BaseSpace file objects) all the files in an app result
+    @param deliverableList: (list of str) file extensions
+
+    @return (list of BaseSpace file objects): the files with any of the extensions, each only once
+    """
+    selected = []
+    seenIds = set()
+    for deliverableExtension in deliverableList:
+        matching = [ appResultFile for appResultFile in appResultFiles if appResultFile.Name.endswith(deliverableExtension) ]
+        if not matching:
+            logging.warn("no files found with extension: %s" % deliverableExtension)
+        for appResultFile in matching:
+            if appResultFile.Id not in seenIds:
+                seenIds.add(appResultFile.Id)
+                selected.append(appResultFile)
+    return selected
+
+def ListDeliverableFiles(downloadJob):
+    """
+    @param downloadJob: (DeliverableDownloadJob)
+
+    @return (list of BaseSpace file objects): the files in the app result that make up the deliverable
+
+    @raises AppServicesException: if the app result can't be listed
+    """
+    try:
+        appResultFiles = GetAppResultFiles(downloadJob.basespaceId, downloadJob.appResultName)
+    except Exception as e:
+        raise AppServicesException("failed to list files for appsession: %s (%s)" % (downloadJob.basespaceId, str(e)))
+    return _SelectDeliverableFiles(appResultFiles, downloadJob.deliverableList)
+
+def EstimateDownloadSize(deliverableFiles, outputDir):
+    """
+    estimate the disk space a deliverable still needs, not counting files already in place at their full size
+
+    @param deliverableFiles: (list of BaseSpace file objects)
+    @param outputDir: (str)
+
+    @return (int): bytes
+    """
+    numBytes = 0
+    for deliverableFile in deliverableFiles:
+        path = os.path.join(outputDir, deliverableFile.Name)
+        if not os.path.exists(path) or os.path.getsize(path) != deliverableFile.Size:
+            numBytes += deliverableFile.Size
+    return numBytes
+
+def _DownloadDeliverableFile(fileJob):
+    # runs on a worker thread
+    appResultFile, outputDir, sync, previous = fileJob
+    started = time.time()
+    try:
+        downloadedFile = TransferServices.DownloadFile(baseSpaceAPI, appResultFile, outputDir, sync=sync, previous=previous)
+    except Exception as e:
+        return appResultFile, None, "failed to download file: %s (%s)" % (appResultFile.Name, str(e))
+    seconds = time.time() - started
+    numBytes = downloadedFile.transferred
+    if downloadedFile.skipped:
+        logging.info("skipped %s: already present and up to date (%s)" % (appResultFile.Name, FormatBytes(appResultFile.Size)))
+    elif numBytes < appResultFile.Size:
+        logging.info("downloaded %s: resumed with %s already downloaded, %s, verified by %s" % (appResultFile.Name, FormatBytes(appResultFile.Size - numBytes), FormatThroughput(numBytes, seconds), downloadedFile.verification))
+    else:
+        logging.info("downloaded %s: %s, verified by %s" % (appResultFile.Name, FormatThroughput(numBytes, seconds), downloadedFile.verification))
+    return appResultFile, downloadedFile, None
+
+def DownloadDeliverableFiles(downloadJob, workers=None):
+    """
+    download the configured deliverable file extensions for an app session. Does not touch the database
+
+    The app result is listed once and the files with any of the extensions are downloaded concurrently.
+    Each file is downloaded in chunks to a .partial file and only renamed into place once complete and verified
+    against its size and ETag; a file whose download was interrupted carries on from its last checkpoint.
+    When syncing, files already in the output directory that are up to date are not downloaded again.
+
+    @param downloadJob: (DeliverableDownloadJob)
+    @param workers: (int) maximum number of files to download at once (defaults to MAX_FILE_DOWNLOADS_PER_DELIVERABLE)
+
+    @return (list of TransferServices.DownloadedFile): the files downloaded or skipped, for the download manifest
+
+    @raises AppServicesException: if any parts of the download fail
+    """
+    if workers is None:
+        workers = ConfigurationServices.GetConfig("MAX_FILE_DOWNLOADS_PER_DELIVERABLE")
+    deliverableFiles = ListDeliverableFiles(downloadJob)
+    if not deliverableFiles:
+        return []
+    _MakeDirectory(downloadJob.outputDir)
+    logging.info("downloading %d files (%s) with %d workers" % (len(deliverableFiles), FormatBytes(sum(deliverableFile.Size for deliverableFile in deliverableFiles)), workers))
+
+    started = time.time()
+    filePool = ThreadPool(min(workers, len(deliverableFiles)))
+    try:
+        results = filePool.map(_DownloadDeliverableFile, [ (deliverableFile, downloadJob.outputDir, downloadJob.sync, downloadJob.manifest.get(deliverableFile.Name))
+                                                           for deliverableFile in deliverableFiles ])
+    finally:
+        filePool.close()
+        filePool.join()
+    errors = [ error for appResultFile, downloadedFile, error in results if error ]
+    if errors:
+        raise AppServicesException("; ".join(errors))
+    downloadedFiles = [ downloadedFile for appResultFile, downloadedFile, error in results ]
+    logging.info("downloaded %s" % SummariseDownload(downloadedFiles, time.time() - started))
+    return downloadedFiles
+
+def DownloadDeliverable(sampleApp, sync=None):
     """
     download the configured deliverable file extensions for a given SampleApp
 
     @param sampleApp: (DBOrm.SampleApp)
+    @param sync: (bool) skip files that are already in place and up to date (defaults to SYNC_DELIVERABLES)
+
+    @return (list of TransferServices.DownloadedFile): the files downloaded
 
     @raises AppServicesException: if any parts of the download fail 
     """
-    outputDir = Repository.SampleAppToOutputDirectory(sampleApp)
-    deliverableList = Repository.SampleAppToDeliverableList(sampleApp)
-    basespaceId = Repository.SampleAppToBaseSpaceId(sampleApp)
-    appResultName = Repository.SampleAppToAppResultName(sampleApp)
-    for deliverableExtension in deliverableList:
-        logging.info("downloading extension: %s" % deliverableExtension)
-        try:
-            downloadFiles = baseSpaceAPI.downloadAppResultFilesByExtension(basespaceId, deliverableExtension, outputDir, appResultName, noLimitQP)
-        except Exception as e:
-            raise AppServicesException("failed to download file: %s (%s)" % (deliverableExtension, str(e)))
+    return DownloadDeliverableFiles(SampleAppToDeliverableDownloadJob(sampleApp, sync))
 
@@ -2,6 +2,7 @@
 Database routines (DAL)
 """
 
+import datetime
 import DBOrm
 from peewee import DoesNotExist, IntegrityError, JOIN_LEFT_OUTER
 import ConfigurationServices
@@ -182,19 +183,10 @@ def GetSampleAppByID(sampleAppId):
     except DoesNotExist:
         raise DBMissingException("missing SampleApp: %s" % sampleAppId)
 
-def GetSampleAppByConstraints(constraints, exact=False):
-    # if we've selected by a particular ID, we don't need to check the other constraints
-    if "id" in constraints:
-        return [ GetSampleAppByID(constraints["id"]) ]
-    # if we join here then it pulls down all the foreign key connections into the objects
-    # this prevents excessive object dereference queries occuring in any downstream code
-    # the peewee syntax is pretty gnarly. Hopefully it makes the query efficient
-    # http://peewee.readthedocs.org/en/latest/peewee/querying.html#joining-on-multiple-tables
-    query = (DBOrm.SampleApp.select(DBOrm.Sample, DBOrm.Project, DBOrm.SampleApp, DBOrm.App)
-                    .join(DBOrm.Sample)
-                    .join(DBOrm.Project)
-                    .switch(DBOrm.SampleApp)
-                    .join(DBOrm.App))
+def _ConstrainSampleAppQuery(query, constraints, exact):
+    """
+    add the conditions from a constraints dict to a query that has been joined across SampleApp, Sample, Project and App
+    """
     # a fair amount of repetition here
     # but I decided I preferred this to a more convoluted generic mechanism
     if "project" in constraints:
@@ -212,7 +204,22 @@ def GetSampleAppByConstraints(constraints, exact=False):
     if "name" in constraints:
         queryField = DBOrm.App.name
         query = AugmentQuery(query, queryField, constraints["name"], exact)
+    return query
 
+def GetSampleAppByConstraints(constraints, exact=False):
+    # if we've selected by a particular ID, we don't need to check the other constraints
+    if "id" in constraints:
+        return [ GetSampleAppByID(constraints["id"]) ]
+    # if we join here then it pulls down all the foreign key connections into the objects
+    # this prevents excessive object dereference queries occuring in any downstream code
+    # the peewee syntax is pretty gnarly. Hopefully it makes the query efficient
+    # http://peewee.readthedocs.org/en/latest/peewee/querying.html#joining-on-multiple-tables
+    query = (DBOrm.SampleApp.select(DBOrm.Sample, DBOrm.Project, DBOrm.SampleApp, DBOrm.App)
+                    .join(DBOrm.Sample)
+                    .join(DBOrm.Project)
+                    .switch(DBOrm.SampleApp)
+                    .join(DBOrm.App))
+    query = _ConstrainSampleAppQuery(query, constraints, exact)
     return [ x for x in query ]
 
 def GetSampleRelationship(sample):
@@ -224,6 +231,28 @@ def GetSampleRelationship(sample):
     except:
         raise DBMissingException("sample relationship could not be found")
 
+@memoized
+def GetTumourNormalMapping():
+    """
+    preload every tumour -> normal relationship with a single query
+
+    @return (dict): tumour sample name -> normal sample name
+    """
+    Tumour = DBOrm.Sample.alias()
+    Normal = DBOrm.Sample.alias()
+    query = (DBOrm.SampleRelationship.select(Tumour.name, Normal.name)
+                    .join(Tumour, on=(DBOrm.SampleRelationship.fromsample == Tumour.id))
+                    .switch(DBOrm.SampleRelationship)
+                    .join(Normal, on=(DBOrm.SampleRelationship.tosample == Normal.id))
+                    .where(DBOrm.SampleRelationship.relationship == ConfigurationServices.GetConfig("TN_RELATIONSHIP_NAME")))
+    return dict(query.tuples())
+
+def GetNormalNameForTumour(sampleName):
+    try:
+        return GetTumourNormalMapping()[sampleName]
+    except KeyError:
+        raise DBMissingException("missing normal for tumour: %s" % sampleName)
+
 def GetNormalForTumour(sampleName):
     sample = GetSampleByName(sampleName)
     sr = DBOrm.SampleRelationship.get(
@@ -232,6 +261,127 @@ def GetNormalForTumour(sampleName):
     return sr.tosample
 
 
+def GetSampleAppMetrics(constraints, metricNames=None, exact=False):
+    """
+    get the stored QC metrics for all the SampleApps matching some constraints, in a single query
+
+    @param constraints: (dict) as for GetSampleAppByConstraints
+    @param metricNames: (list of str) only get these metrics, if provided
+    @param exact: (bool)
+
+    @return (iterable of tuples): (SampleApp id, sample name, project name, app name, status, metric name, numeric value, text value)
+    """
+    query = (DBOrm.SampleAppMetric.select(DBOrm.SampleApp.id, DBOrm.Sample.name, DBOrm.Project.name, DBOrm.App.name, DBOrm.SampleApp.status,
+                                          DBOrm.SampleAppMetric.name, DBOrm.SampleAppMetric.numericvalue, DBOrm.SampleAppMetric.textvalue)
+                    .join(DBOrm.SampleApp)
+                    .join(DBOrm.Sample)
+                    .join(DBOrm.Project)
+                    .switch(DBOrm.SampleApp)
+                    .join(DBOrm.App))
+    if "id" in constraints:
+        query = query.where(DBOrm.SampleApp.id == constraints["id"])
+    query = _ConstrainSampleAppQuery(query, constraints, exact)
+    if metricNames:
+        query = query.where(DBOrm.SampleAppMetric.name << metricNames)
+    return query.order_by(DBOrm.SampleApp.id).tuples()
+
+def GetReadinessFingerprints():
+    """
+    @return (dict): SampleApp id -> (fingerprint, time last checked)
+    """
+    query = DBOrm.SampleAppReadiness.select(DBOrm.SampleAppReadiness.sampleapp, DBOrm.SampleAppReadiness.fingerprint, DBOrm.SampleAppReadiness.checked)
+    return dict((sampleAppId, (fingerprint, checked)) for sampleAppId, fingerprint, checked in query.tuples())
+
+def GetStageCursor(stage):
+    """
+    @return (int): the id of the last SampleApp the stage got through before running out of time, or 0 to start from the beginning
+    """
+    try:
+        return DBOrm.StageCursor.get(DBOrm.StageCursor.stage == stage).sampleappid
+    except DoesNotExist:
+        return 0
+
+def GetPendingQCPropertyUpdates(dueBy=None, limit=None):
+    """
+    @param dueBy: (datetime) only return entries due for an attempt by this time, or all of them if None
+    @param limit: (int) maximum number of entries to return
+
+    @return (list of DBOrm.QCPropertyUpdate): oldest first
+    """
+    query = DBOrm.QCPropertyUpdate.select()
+    if dueBy is not None:
+        query = query.where(DBOrm.QCPropertyUpdate.nextattempt <= dueBy)
+    query = query.order_by(DBOrm.QCPropertyUpdate.id)
+    if limit:
+        query = query.limit(limit)
+    return list(query)
+
+def GetDownloadManifest(sampleApp):
+    """
+    @param sampleApp: (DBOrm.SampleApp)
+
+    @return (list of DBOrm.DownloadManifest): the files downloaded for the SampleApp, by name
+    """
+    query = DBOrm.DownloadManifest.select().where(DBOrm.DownloadManifest.sampleapp == sampleApp)
+    return list(query.order_by(DBOrm.DownloadManifest.name))
+
+def _JoinedSampleAppQuery():
+    return (DBOrm.SampleApp.select(DBOrm.Sample, DBOrm.Project, DBOrm.SampleApp, DBOrm.App)
+                    .join(DBOrm.Sample)
+                    .join(DBOrm.Project)
+                    .switch(DBOrm.SampleApp)
+                    .join(DBOrm.App))
+
+def _DueForPoll(now):
+    return (DBOrm.SampleApp.nextpoll <= now) | (DBOrm.SampleApp.nextpoll >> None)
+
+def GetSampleAppsDueForPoll(statuses, now):
+    """
+    @param statuses: (list of str) only look at SampleApps with these statuses
+    @param now: (datetime)
+
+    @return (list of DBOrm.SampleApp): those the Tracker should poll now, with their sample, project and app joined in
+    """
+    query = (_JoinedSampleAppQuery()
+                    .where(DBOrm.SampleApp.status << list(statuses))
+                    .where(_DueForPoll(now)))
+    return list(query)
+
+def GetAppRuntimes(limit):
+    """
+    the runtimes of recently finished app sessions
+
+    @param limit: (int) the most runtimes to return per app
+
+    @return (dict): local app id -> list of runtimes in seconds, shortest first
+    """
+    query = (DBOrm.SampleApp.select(DBOrm.SampleApp.app, DBOrm.SampleApp.launched, DBOrm.SampleApp.finished)
+             .where(~(DBOrm.SampleApp.launched >> None))
+             .where(~(DBOrm.SampleApp.finished >> None))
+             .order_by(DBOrm.SampleApp.finished.desc())
+             .tuples())
+    runtimes = {}
+    for appId, launched, finished in query:
+        appRuntimes = runtimes.setdefault(appId, [])
+        if len(appRuntimes) < limit:
+            appRuntimes.append((finished - launched).total_seconds())
+    for appRuntimes in runtimes.itervalues():
+        appRuntimes.sort()
+    return runtimes
+
+def GetSampleAppsWithExpiredLeases(status, now):
+    """
+    @param status: (str) only look at SampleApps with this status
+    @param now: (datetime)
+
+    @return (list of DBOrm.SampleApp): those whose lease has expired, or that have no lease at all
+    """
+    query = (DBOrm.SampleApp.select()
+             .where(DBOrm.SampleApp.status == status)
+             .where((DBOrm.SampleApp.leaseexpiry < now) | (DBOrm.SampleApp.leaseexpiry >> None)))
+    return list(query)
+
+
 ######
 # Update
 ######
@@ -240,3 +390,175 @@ def SetSampleAppStatus(sampleApp, status):
     assert status in PERMITTED_STATUSES, "bad status: %s" % status
     sampleApp.status = status
     sampleApp.save()
+
+def SetUnclaimedStatusDetails(sampleAppId, status, details):
+    """
+    update the status details of a SampleApp in a single update, only if it still has the status and nobody holds a lease
+    on it, so a copy read earlier can't overwrite changes made since by whoever has claimed it
+
+    @param sampleAppId: (int)
+    @param status: (str) the status it should still have
+    @param details: (str)
+
+    @return (int): 1 if the details were changed, otherwise 0
+    """
+    query = (DBOrm.SampleApp.update(statusdetails=details)
+             .where(DBOrm.SampleApp.id == sampleAppId)
+             .where(DBOrm.SampleApp.status == status)
+             .where(DBOrm.SampleApp.leaseowner >> None)
+             .where((DBOrm.SampleApp.statusdetails >> None) | (DBOrm.SampleApp.statusdetails != details)))
+    return query.execute()
+
+def RenewSampleAppLeases(sampleAppIds, owner, expiry):
+    """
+    extend the leases held by an owner
+
+    @param sampleAppIds: (list of int)
+    @param owner: (str)
+    @param expiry: (datetime) the new expiry time
+
+    @return (int): the number of leases renewed - any missing have been reclaimed by someone else
+    """
+    if not sampleAppIds:
+        return 0
+    query = (DBOrm.SampleApp.update(leaseexpiry=expiry)
+             .where(DBOrm.SampleApp.id << list(sampleAppIds))
+             .where(DBOrm.SampleApp.leaseowner == owner))
+    return query.execute()
+
+def ClaimSampleApps(statuses, limit, owner, expiry, now, sampleAppIds=None, dueForPoll=False, afterId=0, upToId=None):
+    """
+    lease up to limit SampleApps that nobody else holds a lease on. The lease is taken in a single update, so two
+    processes (or hosts sharing the database file) claiming at once can't both get the same SampleApp
+
+    @param statuses: (list of str) only claim SampleApps with these statuses
+    @param limit: (int) the most to claim, or None for all that are free
+    @param owner: (str) who is claiming them
+    @param expiry: (datetime) when the leases run out unless renewed
+    @param now: (datetime) leases that ran out before this are free to claim
+    @param sampleAppIds: (list of int) only claim from these SampleApps, if provided
+    @param dueForPoll: (bool) only claim SampleApps that are due for the Tracker to poll
+    @param afterId: (int) only claim SampleApps with a higher id than this
+    @param upToId: (int) only claim SampleApps with this id or lower, if provided
+
+    @return (list of DBOrm.SampleApp): the SampleApps claimed, with their sample, project and app joined in, in id order
+    """
+    candidates = (DBOrm.SampleApp.select(DBOrm.SampleApp.id)
+                  .where(DBOrm.SampleApp.status << list(statuses))
+                  .where((DBOrm.SampleApp.leaseexpiry >> None) | (DBOrm.SampleApp.leaseexpiry < now))
+                  .order_by(DBOrm.SampleApp.id))
+    if sampleAppIds is not None:
+        if not sampleAppIds:
+            return []
+        candidates = candidates.where(DBOrm.SampleApp.id << list(sampleAppIds))
+    if dueForPoll:
+        candidates = candidates.where(_DueForPoll(now))
+    if afterId:
+        candidates = candidates.where(DBOrm.SampleApp.id > afterId)
+    if upToId is not None:
+        candidates = candidates.where(DBOrm.SampleApp.id <= upToId)
+    if limit:
+        candidates = candidates.limit(limit)
+    DBOrm.SampleApp.update(leaseowner=owner, leaseexpiry=expiry).where(DBOrm.SampleApp.id << candidates).execute()
+    # this claim's expiry tells its SampleApps apart from any the owner claimed earlier
+    query = (_JoinedSampleAppQuery()
+             .where(DBOrm.SampleApp.leaseowner == owner)
+             .where(DBOrm.SampleApp.leaseexpiry == expiry)
+             .where(DBOrm.SampleApp.status << list(statuses))
+             .order_by(DBOrm.SampleApp.id))
+    return list(query)
+
+def ReleaseSampleApps(sampleAppIds, owner):
+    """
+    give up the leases held by an owner, leaving the SampleApps free for anyone to claim
+
+    @param sampleAppIds: (list of int)
+    @param owner: (str)
+
+    @return (int): the number of leases released - any missing had already been released, or reclaimed by someone else
+    """
+    sampleAppIds = list(sampleAppIds)
+    numReleased = 0
+    # stay well inside sqlite's limit on the number of variables in one statement
+    for start in range(0, len(sampleAppIds), 500):
+        query = (DBOrm.SampleApp.update(leaseowner=None, leaseexpiry=None)
+                 .where(DBOrm.SampleApp.id << sampleAppIds[start:start + 500])
+                 .where(DBOrm.SampleApp.leaseowner == owner))
+        numReleased += query.execute()
+    return numReleased
+
+def SetReadinessFingerprints(fingerprints):
+    """
+    @param fingerprints: (list of (DBOrm.SampleApp, str))
+    """
+    now = datetime.datetime.now()
+    with DBOrm.database.transaction():
+        for sampleApp, fingerprint in fingerprints:
+            DBOrm.SampleAppReadiness.insert(sampleapp=sampleApp, fingerprint=fingerprint, checked=now).upsert().execute()
+
+def SetStageCursor(stage, sampleAppId):
+    """
+    @param stage: (str)
+    @param sampleAppId: (int) the last SampleApp the stage got through, or 0 to start from the beginning next time
+    """
+    DBOrm.StageCursor.insert(stage=stage, sampleappid=sampleAppId, updated=datetime.datetime.now()).upsert().execute()
+
+def SetSampleAppMetrics(sampleApp, metricRows):
+    """
+    replace the stored QC metrics for a SampleApp. Callers should wrap this in a transaction
+
+    @param sampleApp: (DBOrm.SampleApp)
+    @param metricRows: (list of (str, float, str)) metric name, numeric value, text value
+    """
+    DBOrm.SampleAppMetric.delete().where(DBOrm.SampleAppMetric.sampleapp == sampleApp).execute()
+    rows = [ { "sampleapp" : sampleApp, "name" : name, "numericvalue" : numericValue, "textvalue" : textValue } for name, numericValue, textValue in metricRows ]
+    # stay well inside sqlite's limit on the number of variables in one statement
+    for start in range(0, len(rows), 200):
+        DBOrm.SampleAppMetric.insert_many(rows[start:start + 200]).execute()
+
+def SetDownloadManifest(sampleApp, manifestRows):
+    """
+    replace the download manifest for a SampleApp. Callers should wrap this in a transaction with the status change
+
+    @param sampleApp: (DBOrm.SampleApp)
+    @param manifestRows: (list of (str, str, str, int, str, str, str)) file id, name, path, size, etag, checksum, verification
+    """
+    DBOrm.DownloadManifest.delete().where(DBOrm.DownloadManifest.sampleapp == sampleApp).execute()
+    rows = [ { "sampleapp" : sampleApp, "fileid" : fileId, "name" : name, "path" : path, "size" : size, "etag" : etag, "checksum" : checksum, "verification" : verification }
+             for fileId, name, path, size, etag, checksum, verification in manifestRows ]
+    # stay well inside sqlite's limit on the number of variables in one statement
+    for start in range(0, len(rows), 100):
+        DBOrm.DownloadManifest.insert_many(rows[start:start + 100]).execute()
+
+def EnqueueQCPropertyUpdate(sampleApp, qcResult, details):
+    """
+    queue a QC result to be written to BaseSpace, replacing any earlier result for the same SampleApp still waiting to be sent.
+    Callers should wrap this in a transaction with the status change
+
+    @param sampleApp: (DBOrm.SampleApp)
+    @param qcResult: (str) the QC status
+    @param details: (str) why the qc failed
+    """
+    DBOrm.QCPropertyUpdate.delete().where(DBOrm.QCPropertyUpdate.sampleapp == sampleApp).execute()
+    DBOrm.QCPropertyUpdate.create(sampleapp=sampleApp, basespaceid=sampleApp.basespaceid, qcresult=qcResult, details=details)
+
+def SetQCPropertyUpdateFailed(propertyUpdate, error, nextAttempt):
+    """
+    @param propertyUpdate: (DBOrm.QCPropertyUpdate)
+    @param error: (str)
+    @param nextAttempt: (datetime) when to try again
+    """
+    propertyUpdate.attempts += 1
+    propertyUpdate.lasterror = error
+    propertyUpdate.nextattempt = nextAttempt
+    propertyUpdate.save()
+
+######
+# Delete
+######
+
+def DeleteQCPropertyUpdate(propertyUpdate):
+    DBOrm.QCPropertyUpdate.delete().where(DBOrm.QCPropertyUpdate.id == propertyUpdate.id).execute()
+
+def ClearReadinessFingerprint(sampleApp):
+    DBOrm.SampleAppReadiness.delete().where(DBOrm.SampleAppReadiness.sampleapp == sampleApp).execute()
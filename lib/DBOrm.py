@@ -5,6 +5,7 @@ http://peewee.readthedocs.org/en/latest/
 """
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
 import datetime
 
@@ -20,7 +21,10 @@ DBFile = ConfigurationServices.GetConfig("DBFile")
 database = SqliteDatabase(DBFile)
 
 
-UPDATE_TRIGGER = """create trigger set_lastupdated after update on SampleApp
+# lastupdated is the time of the last change of status (or status details), so claims, leases and the like leave it alone
+# peewee's save() sets every column, so the columns named are checked for an actual change too
+UPDATE_TRIGGER = """create trigger if not exists set_lastupdated after update of status, statusdetails on SampleApp
+ when old.status is not new.status or old.statusdetails is not new.statusdetails
  begin
     update SampleApp set lastupdated = datetime('NOW') where id = new.id;
 end;"""
@@ -33,12 +37,35 @@ def create_tables():
     """
     print "instantiating into file: %s" % DBFile
     database.connect()
-    database.create_tables([Sample, Project, App, SampleApp, SampleRelationship])
+    database.create_tables(TABLES)
     cursor = database.get_cursor()
     print "adding update trigger..."
     cursor.execute(UPDATE_TRIGGER)
     database.close()
 
+def upgrade_tables():
+    """
+    brings an existing database up to date with the peewee objects by adding any tables and columns that are missing
+    called by InstantiateDatabase.py -u
+    """
+    print "upgrading database in file: %s" % DBFile
+    database.connect()
+    database.create_tables(TABLES, safe=True)
+    migrator = SqliteMigrator(database)
+    for model in TABLES:
+        tableName = model._meta.db_table
+        existingColumns = set(column.name for column in database.get_columns(tableName))
+        for field in model._meta.sorted_fields:
+            if field.db_column not in existingColumns:
+                print "adding column: %s.%s" % (tableName, field.db_column)
+                migrate(migrator.add_column(tableName, field.db_column, field))
+    # sqlite can only add a not null column by rebuilding the table, which loses the update trigger
+    # an existing trigger may be out of date, and "if not exists" won't replace it
+    cursor = database.get_cursor()
+    cursor.execute("drop trigger if exists set_lastupdated")
+    cursor.execute(UPDATE_TRIGGER)
+    database.close()
+
 
 # def before_request_handler():
 #     database.connect()
@@ -98,11 +125,26 @@ class SampleApp(BaseModel):
     status = CharField()
     statusdetails = TextField(null=True)
     lastupdated = DateTimeField(default=datetime.datetime.now)
+    # set while a process is working on the SampleApp (eg. downloading it): who holds it and until when
+    # the holder renews leaseexpiry periodically; once it has passed, the SampleApp can be reclaimed
+    leaseowner = CharField(null=True)
+    leaseexpiry = DateTimeField(null=True)
+    # number of attempts at the current status (eg. downloads); reset when the status is changed by other means
+    attempts = IntegerField(default=0)
+    # when the current app session was launched and, once it has completed, when the Tracker saw it finish
+    # the runtimes of finished sessions tell the Tracker how often to poll those still running
+    launched = DateTimeField(null=True)
+    finished = DateTimeField(null=True)
+    # when the Tracker should next ask BaseSpace about the app session; null for its next run
+    nextpoll = DateTimeField(null=True)
 
     class Meta:
         indexes = (
             (('sample', 'app'), True),
         )
+        # save() writes only the fields that have been set, so a SampleApp read before the trigger last set
+        # lastupdated (or before another process claimed it) doesn't write the old values back
+        only_save_dirty = True
 
 class SampleRelationship(BaseModel):
     fromsample = ForeignKeyField(Sample, related_name="fromsample", on_delete="CASCADE")
@@ -113,3 +155,62 @@ class SampleRelationship(BaseModel):
         indexes = (
             (('fromsample', 'tosample', 'relationship'), True),
         )
+
+class SampleAppReadiness(BaseModel):
+    # what the launch conditions for a waiting SampleApp looked like the last time the Launcher checked it
+    # the Launcher skips SampleApps whose fingerprint has not changed since
+    sampleapp = ForeignKeyField(SampleApp, on_delete="CASCADE", unique=True)
+    fingerprint = CharField()
+    checked = DateTimeField(default=datetime.datetime.now)
+
+class SampleAppMetric(BaseModel):
+    # the QC metrics parsed from the metrics file for a SampleApp, stored so they can be queried across samples
+    # numericvalue is set if the metric could be read as a number, otherwise textvalue holds the raw value
+    sampleapp = ForeignKeyField(SampleApp, on_delete="CASCADE")
+    name = CharField()
+    numericvalue = FloatField(null=True)
+    textvalue = TextField(null=True)
+
+    class Meta:
+        indexes = (
+            (('name', 'sampleapp'), True),
+        )
+
+class QCPropertyUpdate(BaseModel):
+    # an outbox of QC results waiting to be written to BaseSpace as app session properties
+    # entries are added in the same transaction as the QC status change, and removed once the write succeeds
+    sampleapp = ForeignKeyField(SampleApp, on_delete="CASCADE")
+    basespaceid = CharField()
+    qcresult = CharField()
+    details = TextField(null=True)
+    created = DateTimeField(default=datetime.datetime.now)
+    attempts = IntegerField(default=0)
+    nextattempt = DateTimeField(default=datetime.datetime.now)
+    lasterror = TextField(null=True)
+
+class DownloadManifest(BaseModel):
+    # the deliverable files downloaded for a SampleApp, and how each was verified as it was downloaded
+    # checksum is in the same form as the ETag, or null if the ETag couldn't be reproduced and only the size was checked
+    sampleapp = ForeignKeyField(SampleApp, on_delete="CASCADE")
+    fileid = CharField()
+    name = CharField()
+    path = CharField()
+    size = BigIntegerField()
+    etag = CharField(null=True)
+    checksum = CharField(null=True)
+    verification = CharField()
+    downloaded = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('sampleapp', 'fileid'), True),
+        )
+
+class StageCursor(BaseModel):
+    # where a Launcher, Tracker or QCChecker run got to when it ran out of time, so the next run can carry on from there
+    # sampleappid is the last SampleApp the run got through, or 0 if the last run finished
+    stage = CharField(unique=True)
+    sampleappid = IntegerField(default=0)
+    updated = DateTimeField(default=datetime.datetime.now)
+
+TABLES = [Sample, Project, App, SampleApp, SampleRelationship, SampleAppReadiness, SampleAppMetric, QCPropertyUpdate, DownloadManifest, StageCursor]
@@ -0,0 +1,384 @@
+"""
+Services to download the deliverables for qc-passed SampleApps on a pool of worker threads in one long-lived process
+
+Rather than starting a new interpreter for each SampleApp, a DownloadService keeps a fixed pool of worker threads
+and hands them work from the database as slots free up, so the number of downloads in flight never exceeds
+MAX_DOWNLOADS. The workers only talk to BaseSpace; claiming SampleApps and recording the outcome of each download
+happens on the thread that calls Tick().
+
+Each download holds a lease on its SampleApp that the service renews every DOWNLOAD_HEARTBEAT_INTERVAL seconds.
+If the process dies the lease runs out after DOWNLOAD_LEASE_DURATION seconds, and the next service to look
+puts the SampleApp back to qc-passed, or marks it download-failed once it has had MAX_ATTEMPTS attempts.
+
+Queued SampleApps are taken in order of project priority, then per-project fair share, then how long they have
+been waiting. If a target bandwidth is configured, downloads are admitted one at a time while the measured
+throughput leaves room for another, rather than filling a fixed number of slots.
+
+A download is only started if the filesystem it goes to has room for it. Downloads in flight reserve the space they
+need, so those started together don't all count on the same free space. A SampleApp that doesn't fit stays
+qc-passed, with status details saying so, until space is freed.
+"""
+
+import os
+import time
+import socket
+import datetime
+import logging
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import AppServices
+import Repository
+import TransferServices
+import ConfigurationServices
+
+# a download handed to a worker: a description of the SampleApp for logging, its project, the filesystem it is writing to
+# and the bytes reserved there, and the pending result from the worker
+RunningDownload = namedtuple("RunningDownload", [ "summary", "project", "device", "reserved", "result" ])
+
+def _DownloadWorker(downloadJob):
+    # must not touch the database - everything it needs is in the job
+    started = time.time()
+    try:
+        downloadedFiles = AppServices.DownloadDeliverableFiles(downloadJob)
+        return downloadedFiles, time.time() - started, None
+    except Exception as e:
+        return [], time.time() - started, str(e)
+
+def OrderDownloadQueue(sampleApps, runningPerProject, priorities=None, shares=None):
+    """
+    order queued SampleApps for download: by project priority, then by fair share between projects, then oldest first
+
+    Fair share means the next download goes to the project with the fewest downloads (running, and ahead of it in the
+    queue) relative to its share, so a project with many SampleApps queued can't keep the others waiting.
+
+    @param sampleApps: (list of DBOrm.SampleApp) the queued SampleApps
+    @param runningPerProject: (dict) project name -> number of downloads already running
+    @param priorities: (dict) project name -> priority, higher first (defaults to DOWNLOAD_PROJECT_PRIORITIES; 0 if not listed)
+    @param shares: (dict) project name -> relative share of the downloads (defaults to DOWNLOAD_PROJECT_SHARES; 1 if not listed)
+
+    @return (list of DBOrm.SampleApp)
+    """
+    if priorities is None:
+        priorities = ConfigurationServices.GetConfig("DOWNLOAD_PROJECT_PRIORITIES")
+    if shares is None:
+        shares = ConfigurationServices.GetConfig("DOWNLOAD_PROJECT_SHARES")
+    queues = {}
+    for sampleApp in sorted(sampleApps, key=Repository.SampleAppToLastUpdated):
+        queues.setdefault(Repository.SampleAppToProjectName(sampleApp), []).append(sampleApp)
+    numPerProject = dict(runningPerProject)
+    ordered = []
+    while queues:
+        project = min(queues, key=lambda project: (-priorities.get(project, 0),
+                                                   numPerProject.get(project, 0) / float(shares.get(project, 1)),
+                                                   Repository.SampleAppToLastUpdated(queues[project][0])))
+        ordered.append(queues[project].pop(0))
+        numPerProject[project] = numPerProject.get(project, 0) + 1
+        if not queues[project]:
+            del queues[project]
+    return ordered
+
+class DownloadService(object):
+    """
+    Pulls qc-passed SampleApps from the database and downloads their deliverables, at most maxDownloads at a time.
+
+    Call Tick() periodically (RunForever() does this) to record finished downloads and start new ones.
+    """
+
+    def __init__(self, maxDownloads=None, safe=False):
+        """
+        @param maxDownloads: (int) maximum number of downloads in flight, including any started by other processes (defaults to MAX_DOWNLOADS)
+        @param safe: (bool) say what would happen without doing it
+        """
+        if maxDownloads is None:
+            maxDownloads = ConfigurationServices.GetConfig("MAX_DOWNLOADS")
+        self.maxDownloads = maxDownloads
+        self.safe = safe
+        # admit downloads by measured throughput if we know what the link (or our share of it) can take
+        self.targetBandwidth = ConfigurationServices.GetConfig("DOWNLOAD_TARGET_BANDWIDTH") or ConfigurationServices.GetConfig("DOWNLOAD_BANDWIDTH_LIMIT")
+        self.admitFraction = ConfigurationServices.GetConfig("DOWNLOAD_ADMIT_FRACTION")
+        self.admitSettle = ConfigurationServices.GetConfig("DOWNLOAD_ADMIT_SETTLE")
+        self.lastAdmitted = 0
+        self.diskHeadroom = ConfigurationServices.GetConfig("DOWNLOAD_DISK_HEADROOM")
+        # filesystem device id -> bytes reserved by our downloads in flight
+        self.reservations = {}
+        # SampleApp id -> deliverable files, so queued SampleApps aren't listed again every time round
+        self.deliverableFiles = {}
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.leaseDuration = datetime.timedelta(seconds=ConfigurationServices.GetConfig("DOWNLOAD_LEASE_DURATION"))
+        self.heartbeatInterval = ConfigurationServices.GetConfig("DOWNLOAD_HEARTBEAT_INTERVAL")
+        self.maxAttempts = ConfigurationServices.GetConfig("MAX_ATTEMPTS")
+        self.lastHeartbeat = time.time()
+        self.pool = ThreadPool(maxDownloads)
+        # SampleApp id -> RunningDownload
+        self.running = {}
+        # if set, only these SampleApp ids are downloaded
+        self.onlySampleAppIds = None
+        self.stopping = False
+        # set by Wake() to check for new work before the interval is up
+        self.wakeup = threading.Event()
+
+    def _LeaseExpiry(self):
+        return datetime.datetime.now() + self.leaseDuration
+
+    def _RequeueOrFail(self, sampleApp, reason):
+        """
+        put a SampleApp back to qc-passed to be tried again, or mark it download-failed if it has used up its attempts
+        """
+        attempts = Repository.SampleAppToAttempts(sampleApp)
+        if attempts >= self.maxAttempts:
+            logging.error("giving up on %s after %d attempts: %s" % (Repository.SampleAppSummary(sampleApp), attempts, reason))
+            Repository.SetSampleAppStatus(sampleApp, "download-failed", "gave up after %d attempts: %s" % (attempts, reason))
+        else:
+            logging.warn("requeueing %s after %d of %d attempts: %s" % (Repository.SampleAppSummary(sampleApp), attempts, self.maxAttempts, reason))
+            Repository.RequeueSampleApp(sampleApp, "qc-passed", "attempt %d failed: %s" % (attempts, reason))
+
+    def ReclaimExpiredLeases(self):
+        """
+        Requeue SampleApps whose download lease has run out, because whoever was downloading them has died.
+        SampleApps left downloading without a lease (by an older version of the Downloader) are given one,
+        so they are reclaimed in turn if nothing finishes them.
+
+        @return (int): the number of SampleApps reclaimed
+        """
+        numReclaimed = 0
+        for sampleApp in Repository.GetSampleAppsWithExpiredLeases("downloading", datetime.datetime.now()):
+            owner = Repository.SampleAppToLeaseOwner(sampleApp)
+            if self.safe:
+                logging.info("would reclaim download held by %s: %s" % (owner, Repository.SampleAppSummary(sampleApp)))
+            elif Repository.SampleAppToLeaseExpiry(sampleApp) is None:
+                Repository.LeaseSampleApp(sampleApp, "downloading", "unknown", self._LeaseExpiry(), Repository.SampleAppToStatusDetails(sampleApp))
+                continue
+            else:
+                self._RequeueOrFail(sampleApp, "lease held by %s expired" % owner)
+            numReclaimed += 1
+        return numReclaimed
+
+    def Heartbeat(self, force=False):
+        """
+        renew the leases on the downloads in flight, if it is time to
+
+        @param force: (bool) renew them now, whenever they were last renewed
+        """
+        if not self.running or self.safe:
+            return
+        if not force and time.time() - self.lastHeartbeat < self.heartbeatInterval:
+            return
+        numRenewed = Repository.RenewSampleAppLeases(self.running.keys(), self.owner, self._LeaseExpiry())
+        self.lastHeartbeat = time.time()
+        if numRenewed < len(self.running):
+            logging.warn("%d of %d download leases have been reclaimed by someone else" % (len(self.running) - numRenewed, len(self.running)))
+
+    def _CollectFinished(self):
+        """
+        record the outcome of any downloads that have finished
+
+        @return (int): the number of downloads collected
+        """
+        finished = [ sampleAppId for sampleAppId, runningDownload in self.running.iteritems() if runningDownload.result.ready() ]
+        for sampleAppId in finished:
+            runningDownload = self.running.pop(sampleAppId)
+            self.reservations[runningDownload.device] -= runningDownload.reserved
+            self.deliverableFiles.pop(sampleAppId, None)
+            downloadedFiles, seconds, error = runningDownload.result.get()
+            sampleApp = Repository.GetSampleAppByID(sampleAppId)
+            if Repository.SampleAppToLeaseOwner(sampleApp) != self.owner:
+                # our lease ran out and the SampleApp has been requeued, so it's no longer ours to update
+                logging.warn("lost the lease on %s, not recording the download" % runningDownload.summary)
+            elif error:
+                logging.error("download failed for %s after %.1fs: %s" % (runningDownload.summary, seconds, error))
+                self._RequeueOrFail(sampleApp, error)
+            else:
+                summary = AppServices.SummariseDownload(downloadedFiles, seconds)
+                logging.info("downloaded %s: %s" % (runningDownload.summary, summary))
+                Repository.SetDeliverableDownloaded(sampleApp, downloadedFiles, summary)
+        return len(finished)
+
+    def _FreeSlots(self, numRunning):
+        """
+        @param numRunning: (int) downloads running here and elsewhere
+
+        @return (int): how many more downloads to start now
+        """
+        freeSlots = self.maxDownloads - numRunning
+        if freeSlots <= 0 or not self.targetBandwidth:
+            return freeSlots
+        if self.running:
+            # give the last download we started time to show up in the throughput before deciding on another
+            if time.time() - self.lastAdmitted < self.admitSettle:
+                return 0
+            throughput = TransferServices.MeasuredThroughput()
+            if throughput >= self.admitFraction * self.targetBandwidth:
+                logging.debug("not starting another download: throughput %s/s of a target %s/s" % (AppServices.FormatBytes(throughput), AppServices.FormatBytes(self.targetBandwidth)))
+                return 0
+        # ramp up one download at a time
+        return 1
+
+    def _ReserveDiskSpace(self, sampleApp, downloadJob):
+        """
+        check the output filesystem has room for a deliverable, and if so reserve it
+
+        @return (int, int): the device id of the filesystem and the bytes reserved, or None if the SampleApp has to wait
+        """
+        sampleAppId = Repository.SampleAppToId(sampleApp)
+        if sampleAppId not in self.deliverableFiles:
+            try:
+                self.deliverableFiles[sampleAppId] = AppServices.ListDeliverableFiles(downloadJob)
+            except AppServices.AppServicesException as ae:
+                # let the download itself fail and be retried
+                logging.warn("can't estimate the size of %s: %s" % (Repository.SampleAppSummary(sampleApp), str(ae)))
+                self.deliverableFiles[sampleAppId] = []
+        needed = AppServices.EstimateDownloadSize(self.deliverableFiles[sampleAppId], downloadJob.outputDir)
+        device, free = TransferServices.FreeDiskSpace(downloadJob.outputDir)
+        reserved = self.reservations.get(device, 0)
+        if needed + self.diskHeadroom > free - reserved:
+            # the free space changes all the time, so it is logged but left out of the status details, which are only
+            # written when the reason for waiting changes
+            details = "waiting for disk space: needs %s (plus %s kept free)" % (AppServices.FormatBytes(needed), AppServices.FormatBytes(self.diskHeadroom))
+            logging.warn("not starting %s: %s, %s free with %s reserved by running downloads" % (
+                Repository.SampleAppSummary(sampleApp), details, AppServices.FormatBytes(free), AppServices.FormatBytes(reserved)))
+            if not self.safe and Repository.SampleAppToStatusDetails(sampleApp) != details:
+                Repository.SetUnclaimedStatusDetails(sampleApp, "qc-passed", details)
+            return None
+        self.reservations[device] = reserved + needed
+        return device, needed
+
+    def _StartDownloads(self):
+        """
+        claim qc-passed SampleApps and hand them to the workers, in priority and fair share order, as far as the limits allow
+
+        @return (int): the number of downloads started
+        """
+        # downloads started by other processes count against the limit and towards their project's share too
+        downloading = Repository.GetSampleAppByConstraints({ "status" : [ "downloading" ] })
+        runningPerProject = {}
+        numElsewhere = 0
+        for sampleApp in downloading:
+            project = Repository.SampleAppToProjectName(sampleApp)
+            runningPerProject[project] = runningPerProject.get(project, 0) + 1
+            if Repository.SampleAppToLeaseOwner(sampleApp) != self.owner:
+                numElsewhere += 1
+        freeSlots = self._FreeSlots(len(self.running) + numElsewhere)
+        if freeSlots <= 0:
+            return 0
+        queued = [ sampleApp for sampleApp in Repository.GetSampleAppByConstraints({ "status" : [ "qc-passed" ] })
+                   if Repository.SampleAppToId(sampleApp) not in self.running
+                   and (self.onlySampleAppIds is None or Repository.SampleAppToId(sampleApp) in self.onlySampleAppIds) ]
+        # forget the listings of SampleApps that have left the queue
+        queuedIds = set(Repository.SampleAppToId(sampleApp) for sampleApp in queued) | set(self.running)
+        for sampleAppId in [ sampleAppId for sampleAppId in self.deliverableFiles if sampleAppId not in queuedIds ]:
+            del self.deliverableFiles[sampleAppId]
+        numStarted = 0
+        for sampleApp in OrderDownloadQueue(queued, runningPerProject):
+            if numStarted >= freeSlots:
+                break
+            sampleAppId = Repository.SampleAppToId(sampleApp)
+            downloadJob = AppServices.SampleAppToDeliverableDownloadJob(sampleApp)
+            reservation = self._ReserveDiskSpace(sampleApp, downloadJob)
+            if reservation is None:
+                continue
+            if self.safe:
+                logging.info("would download: %s" % Repository.SampleAppSummary(sampleApp))
+                numStarted += 1
+                continue
+            device, reserved = reservation
+            # claim the SampleApp before handing it over, so nothing else picks it up
+            claimed = Repository.ClaimSampleApps("qc-passed", 1, self.owner, self.leaseDuration.total_seconds(), [ sampleAppId ])
+            if not claimed:
+                logging.info("not starting %s: claimed by someone else" % Repository.SampleAppSummary(sampleApp))
+                self.reservations[device] -= reserved
+                continue
+            # carry on with the row as it is now, rather than as it was when the queue was read
+            sampleApp = claimed[0]
+            attempt = Repository.SampleAppToAttempts(sampleApp) + 1
+            Repository.LeaseSampleApp(sampleApp, "downloading", self.owner, self._LeaseExpiry(), "attempt %d of %d" % (attempt, self.maxAttempts))
+            summary = Repository.SampleAppSummary(sampleApp)
+            logging.info("starting download: %s" % summary)
+            result = self.pool.apply_async(_DownloadWorker, [ downloadJob ])
+            self.running[sampleAppId] = RunningDownload(summary, Repository.SampleAppToProjectName(sampleApp), device, reserved, result)
+            self.lastAdmitted = time.time()
+            numStarted += 1
+        return numStarted
+
+    def Tick(self):
+        """
+        renew our leases, record finished downloads, reclaim abandoned ones and start new ones to fill the free slots
+
+        @return (int, int): the number of downloads finished and started
+        """
+        self.Heartbeat()
+        numFinished = self._CollectFinished()
+        if self.stopping:
+            return numFinished, 0
+        self.ReclaimExpiredLeases()
+        numStarted = self._StartDownloads()
+        return numFinished, numStarted
+
+    def NumRunning(self):
+        return len(self.running)
+
+    def Wake(self):
+        """
+        check for new work now, eg. because a SampleApp has just passed QC, rather than at the next interval
+        """
+        self.wakeup.set()
+
+    def Stop(self):
+        """
+        stop starting new downloads; those already running carry on until they finish
+        """
+        self.stopping = True
+
+    def Close(self):
+        """
+        wait for running downloads to finish, record them and shut down the workers
+        """
+        self.stopping = True
+        # keep our leases alive while we wait
+        while self.running:
+            self.Heartbeat()
+            self._CollectFinished()
+            time.sleep(1)
+        self.pool.close()
+        self.pool.join()
+
+    def RunForever(self, interval=None):
+        """
+        keep downloading until Stop() is called (eg. from a signal handler), checking for new work every interval seconds
+
+        @param interval: (int) seconds between checks for new work (defaults to DOWNLOAD_SERVICE_INTERVAL)
+        """
+        if interval is None:
+            interval = ConfigurationServices.GetConfig("DOWNLOAD_SERVICE_INTERVAL")
+        try:
+            while not self.stopping:
+                self.Tick()
+                # wake up early if a download finishes, so its slot is refilled promptly
+                deadline = time.time() + interval
+                while not self.stopping and time.time() < deadline:
+                    if any(runningDownload.result.ready() for runningDownload in self.running.itervalues()):
+                        break
+                    self.Heartbeat()
+                    if self.wakeup.wait(1):
+                        break
+                self.wakeup.clear()
+        finally:
+            self.Close()
+
+    def RunUntilDone(self, sampleAppIds=None, pollInterval=1):
+        """
+        download everything that is currently qc-passed, keeping the workers busy, then return
+
+        @param sampleAppIds: (list of int) only download these SampleApps, if provided
+        @param pollInterval: (int) seconds between checks for finished downloads
+        """
+        if sampleAppIds is not None:
+            self.onlySampleAppIds = set(sampleAppIds)
+        try:
+            self.Tick()
+            while self.running and not self.stopping:
+                time.sleep(pollInterval)
+                self.Tick()
+        finally:
+            self.Close()
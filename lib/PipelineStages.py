@@ -0,0 +1,569 @@
+"""
+The stages of the LaunchSpace pipeline - launching, tracking, QC and download - as functions that can be run once
+(by the bin scripts) or over and over in one long-lived process (by a PipelineDaemon).
+
+Running the stages in one process means the BaseSpace client, the database connection, compiled templates and
+threshold evaluators are set up once and kept warm, and each stage can run as often as suits it rather than once an
+hour. Caches of things that change between runs (BaseSpace samples, projects and sample relationships) are cleared
+at the start of each run.
+
+Each stage runs on its own thread in the daemon, so a long launcher run doesn't hold up downloads. The stages are
+chained through Repository status listeners: a SampleApp that the tracker sees finish is queued for QC straight
+away, and one that passes QC wakes the downloader, rather than each waiting for the next stage's scan. The periodic
+scans still run, to pick up anything changed by other processes or by hand. Stop() lets the current run of each
+stage finish, and lets downloads in flight complete, before the daemon exits.
+"""
+
+import os
+import time
+import fcntl
+import socket
+import datetime
+import logging
+import threading
+from collections import defaultdict
+
+import AppServices
+import SampleServices
+import QCServices
+import DownloadServices
+import Repository
+import DBApi
+import ConfigurationServices
+
+# memoized lookups whose answers can change between runs
+_PER_RUN_CACHES = [ SampleServices.GetSamplesInProject, SampleServices.GetReadinessIndex, DBApi.GetProjectByName, DBApi.GetTumourNormalMapping ]
+
+def ClearCaches():
+    """
+    forget memoized BaseSpace samples, projects and sample relationships, so the next run sees any changes
+    """
+    for memoizedFunction in _PER_RUN_CACHES:
+        memoizedFunction.cache.clear()
+
+def LogTransitions(transitions):
+    """
+    log how many of each transition we've made. If the number is low enough, report which apps have had each transition type
+
+    @param transitions: (dict) (old status, new status) -> list of app session IDs
+    """
+    for transition in sorted(transitions):
+        if len(transitions[transition]) > 40:
+            logging.info("%s : %i" % (transition, len(transitions[transition])))
+        else:
+            logging.info(
+                "%s : %i (%s)" % (
+                    transition, len(transitions[transition]), ", ".join([str(x) for x in transitions[transition]])))
+
+class StageRun(object):
+    """
+    One run of a stage over the SampleApps waiting for it.
+
+    The run takes the stage's lock file, so a second run of the same stage on this host exits straight away rather than
+    doing the same work. It claims the SampleApps it works on in the database, so runs in other processes, or on other
+    hosts sharing the database, leave them alone. It has a time budget: once that runs out it stops at the next
+    SampleApp, and records how far through the queue it got so that the next run carries on from there rather than
+    going over the same SampleApps again.
+    """
+
+    def __init__(self, stage, safe=False, budget=None):
+        """
+        @param stage: (str) the stage name, for the lock file, the cursor and to tell claims made by different stages of one process apart
+        @param safe: (bool) look at the SampleApps without claiming them or recording progress
+        @param budget: (int) seconds the run may take (defaults to the stage's entry in STAGE_TIME_BUDGETS; None for no limit)
+        """
+        self.stage = stage
+        self.owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(), stage)
+        self.leaseDuration = ConfigurationServices.GetConfig("CLAIM_LEASE_DURATION")
+        self.safe = safe
+        if budget is None:
+            budget = ConfigurationServices.GetConfig("STAGE_TIME_BUDGETS").get(stage)
+        self.deadline = time.time() + budget if budget else None
+        self.lockFile = None
+        self.claimed = []
+        self.resuming = False
+        self.lastSampleAppId = 0
+        self.outOfTime = False
+
+    def Lock(self):
+        """
+        take the stage's lock file. Safe runs don't need it
+
+        @return (bool): whether we got it, rather than another run of the stage holding it
+        """
+        if self.safe:
+            return True
+        lockFile = open(os.path.join(ConfigurationServices.GetConfig("STAGE_LOCK_DIR"), "%s.lock" % self.stage), "a")
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockFile.close()
+            logging.warn("another %s run is still going, leaving the work to it" % self.stage)
+            return False
+        self.lockFile = lockFile
+        return True
+
+    def OutOfTime(self):
+        """
+        @return (bool): whether the run has used up its time budget and should stop before the next SampleApp
+        """
+        if not self.outOfTime and self.deadline is not None and time.time() >= self.deadline:
+            logging.info("%s has run out of time, leaving the rest for the next run" % self.stage)
+            self.outOfTime = True
+        return self.outOfTime
+
+    def Reached(self, sampleApp):
+        """
+        record that the run has got as far as this SampleApp
+        """
+        self.lastSampleAppId = Repository.SampleAppToId(sampleApp)
+
+    def Batches(self, statuses, sampleAppIds=None, dueForPoll=False):
+        """
+        claim SampleApps CLAIM_BATCH_SIZE at a time, in id order, until there are none left or the run is out of time,
+        so runs of the stage in several processes share the work out between them. Each batch carries on after the last
+        one, so a SampleApp is handed out at most once per run, even if its claim is let go of or its status changes to
+        another of the statuses along the way.
+
+        A run over the whole queue (no sampleAppIds) starts after the SampleApp the last run got to, then goes back to
+        the start once, up to and including that SampleApp.
+
+        @param statuses: (list of str) claim SampleApps with these statuses
+        @param sampleAppIds: (list of int) only claim from these SampleApps, if provided
+        @param dueForPoll: (bool) only claim SampleApps that are due for the Tracker to poll
+
+        @return (generator of list of DBOrm.SampleApp): the batches of SampleApps claimed
+        """
+        if self.safe:
+            if dueForPoll:
+                sampleApps = Repository.GetSampleAppsDueForPoll(statuses)
+            else:
+                sampleApps = Repository.GetSampleAppByConstraints({ "status" : statuses })
+            if sampleAppIds is not None:
+                sampleApps = [ sampleApp for sampleApp in sampleApps if Repository.SampleAppToId(sampleApp) in sampleAppIds ]
+            if sampleApps:
+                yield sampleApps
+            return
+        batchSize = ConfigurationServices.GetConfig("CLAIM_BATCH_SIZE")
+        startId = 0
+        if sampleAppIds is None:
+            self.resuming = True
+            startId = Repository.GetStageCursor(self.stage)
+            if startId:
+                logging.info("%s carrying on after SampleApp %d" % (self.stage, startId))
+        afterId = startId
+        upToId = None
+        while not self.OutOfTime():
+            sampleApps = Repository.ClaimSampleApps(statuses, batchSize, self.owner, self.leaseDuration, sampleAppIds, dueForPoll, afterId, upToId)
+            if not sampleApps:
+                if not startId or upToId is not None:
+                    return
+                # go back round to the SampleApps up to where the last run got to
+                afterId = 0
+                upToId = startId
+                continue
+            afterId = Repository.SampleAppToId(sampleApps[-1])
+            self.claimed.extend(Repository.SampleAppToId(sampleApp) for sampleApp in sampleApps)
+            yield sampleApps
+
+    def StillHeld(self, sampleApp):
+        """
+        renew the claim on a SampleApp, eg. before doing something that can't be undone
+
+        @return (bool): whether it is still ours, rather than having run out and been claimed by someone else
+        """
+        if self.safe:
+            return True
+        expiry = datetime.datetime.now() + datetime.timedelta(seconds=self.leaseDuration)
+        return Repository.RenewSampleAppLeases([ Repository.SampleAppToId(sampleApp) ], self.owner, expiry) == 1
+
+    def SaveProgress(self):
+        """
+        record where a run over the whole queue got to, so the next run carries on from there, or starts from the
+        beginning if this one finished
+        """
+        if self.safe or not self.resuming:
+            return
+        if self.outOfTime:
+            Repository.SetStageCursor(self.stage, self.lastSampleAppId)
+        else:
+            Repository.SetStageCursor(self.stage, 0)
+
+    def Release(self):
+        """
+        let go of the SampleApps still claimed, and of the lock
+        """
+        if self.claimed:
+            Repository.ReleaseSampleApps(self.claimed, self.owner)
+            self.claimed = []
+        if self.lockFile:
+            self.lockFile.close()
+            self.lockFile = None
+
+######
+# stages
+######
+
+def RunLauncher(sampleApps=None, safe=False, ignoreYield=False, full=False, budget=None):
+    """
+    launch the waiting SampleApps that are ready
+
+    @param sampleApps: (list of DBOrm.SampleApp) the SampleApps to consider (defaults to all those waiting)
+    @param safe: (bool) say what would be launched without doing it
+    @param ignoreYield: (bool) ignore any missing yield
+    @param full: (bool) re-check every SampleApp, even if its samples have not changed since the last run
+    @param budget: (int) seconds the run may take (see StageRun)
+
+    @return (int): the number of SampleApps launched
+    """
+    run = StageRun("launcher", safe, budget)
+    if not run.Lock():
+        return 0
+    ClearCaches()
+    if sampleApps is None:
+        # claim the SampleApps with the waiting status, a batch at a time, leaving alone any another Launcher is working on
+        logging.debug("Finding samples")
+        batches = run.Batches([ "waiting" ])
+    else:
+        # a specific SampleApp is always checked
+        batches = [ sampleApps ]
+        full = True
+    numSampleApps = numSkipped = numLaunched = 0
+    try:
+        for batch in batches:
+            logging.debug("working on %d samples" % len(batch))
+            batchChecked, batchSkipped, batchLaunched = _LaunchSampleApps(batch, run, safe, ignoreYield, full)
+            numSampleApps += batchChecked
+            numSkipped += batchSkipped
+            numLaunched += batchLaunched
+        run.SaveProgress()
+    finally:
+        run.Release()
+    logging.info("%d waiting SampleApps: %d skipped as unchanged, %d checked, %d launched" % (numSampleApps, numSkipped, numSampleApps - numSkipped, numLaunched))
+    return numLaunched
+
+def _LaunchSampleApps(sampleApps, run, safe, ignoreYield, full):
+    # build the readiness index for each project once up front, along with the tumour/normal pairings
+    # every SampleApp is then checked against these rather than going back to BaseSpace or the database
+    projectIds = set([ Repository.SampleAppToProjectId(sampleApp) for sampleApp in sampleApps ])
+    for projectId in projectIds:
+        SampleServices.GetReadinessIndex(projectId)
+    Repository.GetTumourNormalMapping()
+    logging.debug("built readiness index for %d projects" % len(projectIds))
+
+    # fingerprints of the SampleApps that were still waiting last time, so we can skip those where nothing has changed
+    if full:
+        previousFingerprints = {}
+    else:
+        previousFingerprints = Repository.GetReadinessFingerprints()
+    fingerprintExpiry = datetime.timedelta(hours=ConfigurationServices.GetConfig("READINESS_FINGERPRINT_EXPIRY"))
+    newFingerprints = []
+    numChecked = 0
+    numSkipped = 0
+    numLaunched = 0
+
+    for sampleApp in sampleApps:
+        if run.OutOfTime():
+            break
+        run.Reached(sampleApp)
+        numChecked += 1
+        # if the samples behind this SampleApp look the same as last time, it will still be waiting for the same reason
+        fingerprint = AppServices.GetReadinessFingerprint(sampleApp, ignoreYield)
+        previous = previousFingerprints.get(Repository.SampleAppToId(sampleApp))
+        if previous and previous[0] == fingerprint and datetime.datetime.now() - previous[1] < fingerprintExpiry:
+            logging.debug("unchanged since %s: %s" % (previous[1], Repository.SampleAppSummary(sampleApp)))
+            numSkipped += 1
+            continue
+        # check whether the SampleApp is ready to launch, including getting a reason if it isn't ready
+        ready, reason = AppServices.CheckConditionsOnSampleApp(sampleApp, ignoreYield)
+        newstatus = ""
+        details = ""
+        if ready:
+            if safe:
+                logging.info("would launch: %s" % Repository.SampleAppSummary(sampleApp))
+                logging.debug(AppServices.SimulateLaunch(sampleApp))
+            elif run.claimed and not run.StillHeld(sampleApp):
+                logging.warn("lost the claim on %s, not launching it" % Repository.SampleAppSummary(sampleApp))
+                continue
+            else:
+                # if we're ready, configure and launch
+                logging.info("launching: %s" % Repository.SampleAppSummary(sampleApp))
+                appSessionId = AppServices.ConfigureAndLaunchApp(sampleApp)
+                logging.info("got app session id: %s" % appSessionId)
+                Repository.SetNewSampleAppSessionId(sampleApp, appSessionId)
+                Repository.ClearReadinessFingerprint(sampleApp)
+                newstatus = "submitted"
+                details = "submission time: %s" % datetime.datetime.now()
+                numLaunched += 1
+        else:
+            newstatus = "waiting"
+            details = reason
+            newFingerprints.append((sampleApp, fingerprint))
+            logging.debug("cannot launch: %s" % reason)
+        if not safe:
+            # this will only set the status if something has changed
+            Repository.SetSampleAppStatus(sampleApp, newstatus, details)
+
+    if not safe:
+        Repository.SetReadinessFingerprints(newFingerprints)
+
+    return numChecked, numSkipped, numLaunched
+
+def RunTracker(sampleApps=None, safe=False, pollAll=False, budget=None):
+    """
+    update the status of the SampleApps whose apps are live in BaseSpace
+
+    Each app session is only polled when it is due (see AppServices.NextPollTime), so long runs aren't polled over and
+    over while they're unlikely to have finished.
+
+    @param sampleApps: (list of DBOrm.SampleApp) the SampleApps to track (defaults to those submitted, pending or running that are due a poll)
+    @param safe: (bool) say what would be updated without doing it
+    @param pollAll: (bool) poll every submitted, pending or running SampleApp, whether or not it is due
+    @param budget: (int) seconds the run may take (see StageRun)
+
+    @return (dict): (old status, new status) -> list of app session IDs
+    """
+    # record what transitions we make (state -> state for each SampleApp) so we can report at the end
+    transitions = defaultdict(list)
+    run = StageRun("tracker", safe, budget)
+    if not run.Lock():
+        return transitions
+    if sampleApps is None:
+        # claim the SampleApps with statuses that the Tracker will be able to update, a batch at a time,
+        # leaving alone any another Tracker is working on. These represent "live" statuses on BaseSpace
+        batches = run.Batches(AppServices.LIVE_STATUSES, dueForPoll=not pollAll)
+    else:
+        batches = [ sampleApps ]
+    try:
+        runtimes = AppServices.GetAppRuntimes()
+        for batch in batches:
+            logging.debug("Working on %i samples" % len(batch))
+            _TrackSampleApps(batch, run, safe, runtimes, transitions)
+        run.SaveProgress()
+    finally:
+        run.Release()
+    LogTransitions(transitions)
+    return transitions
+
+def _TrackSampleApps(sampleApps, run, safe, runtimes, transitions):
+    for sampleApp in sampleApps:
+        if run.OutOfTime():
+            break
+        run.Reached(sampleApp)
+        # unpack the SampleApp a little
+        sampleName = Repository.SampleAppToSampleName(sampleApp)
+        appName = Repository.SampleAppToAppName(sampleApp)
+        sampleAppId = Repository.SampleAppToBaseSpaceId(sampleApp)
+        logging.debug("working on: %s %s" % (sampleName, appName))
+
+        if not sampleAppId:
+            logging.warn("No BaseSpace Id for SampleApp: %s" % Repository.SampleAppSummary(sampleApp))
+            continue
+        # get the new status, and work out when to look again if it's still live
+        newstatus = AppServices.GetAppStatus(sampleAppId)
+        nextPoll = AppServices.NextPollTime(sampleApp, newstatus, runtimes.get(Repository.SampleAppToLocalAppId(sampleApp), []))
+        if safe:
+            logging.info("would update %s to: %s" % (Repository.SampleAppSummary(sampleApp), newstatus))
+        else:
+            # record the transition and update in the db
+            transition = (Repository.SampleAppToStatus(sampleApp), newstatus)
+            Repository.SetTrackedStatus(sampleApp, newstatus, nextPoll)
+            transitions[transition].append(sampleAppId)
+            if nextPoll:
+                logging.debug("next poll of %s at %s" % (sampleAppId, nextPoll))
+
+def RunQCChecker(sampleApps=None, workers=None, batchSize=None, safe=False, sampleAppIds=None, budget=None):
+    """
+    apply automated QC to finished apps
+
+    @param sampleApps: (list of DBOrm.SampleApp) the SampleApps to check (defaults to all those app-finished)
+    @param workers: (int) number of concurrent metrics downloads (defaults to QC_WORKERS)
+    @param batchSize: (int) number of status changes to commit to the database at once (defaults to QC_BATCH_SIZE)
+    @param safe: (bool) say what would be updated without doing it
+    @param sampleAppIds: (list of int) only check these SampleApps, if they are still app-finished (eg. those just queued by the tracker)
+    @param budget: (int) seconds the run may take (see StageRun). Each batch is checked as a whole, so a run can go over by up to one batch
+
+    @return (dict): (old status, new status) -> list of app session IDs
+    """
+    # all SampleApps will end up in either "qc-failed" or "qc-passed" states
+    transitions = defaultdict(list)
+    run = StageRun("qcchecker", safe, budget)
+    if not run.Lock():
+        return transitions
+    if sampleApps is None:
+        # claim the samples that are in the app-finished state, a batch at a time, leaving alone any another QCChecker is working on
+        batches = run.Batches([ "app-finished" ], sampleAppIds)
+    else:
+        batches = [ sampleApps ]
+
+    try:
+        for batch in batches:
+            logging.info("Working on %i samples" % len(batch))
+            for transition, appSessionIds in QCServices.RunQC(batch, workers, batchSize, safe).iteritems():
+                transitions[transition].extend(appSessionIds)
+            run.Reached(batch[-1])
+        run.SaveProgress()
+    finally:
+        run.Release()
+    LogTransitions(transitions)
+    return transitions
+
+def RunQCPropertyFlush(safe=False):
+    """
+    write queued QC results to BaseSpace
+
+    @return (int, int): the number of writes sent and the number that failed
+    """
+    numSent, numFailed = QCServices.FlushQCPropertyUpdates(safe=safe)
+    if numSent or numFailed:
+        logging.info("wrote %d QC results to BaseSpace, %d failed and will be retried" % (numSent, numFailed))
+    return numSent, numFailed
+
+######
+# daemon
+######
+
+class StageLoop(threading.Thread):
+    """
+    Runs one stage on its own thread: over every SampleApp waiting for it each interval seconds, and in between over
+    SampleApps pushed onto its queue (eg. by an earlier stage) as soon as they arrive
+    """
+
+    def __init__(self, name, runOnce, interval):
+        """
+        @param name: (str) the stage name, for logging
+        @param runOnce: (function) runs the stage once, given a list of SampleApp ids to work on, or None for all those waiting
+        @param interval: (int) seconds from the end of one run over every waiting SampleApp to the start of the next
+        """
+        threading.Thread.__init__(self, name=name)
+        self.runOnce = runOnce
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.queueLock = threading.Lock()
+        self.queue = []
+        self.stopping = False
+
+    def _TakeQueue(self):
+        with self.queueLock:
+            queued = self.queue
+            self.queue = []
+        return queued
+
+    def run(self):
+        nextScan = time.time()
+        while not self.stopping:
+            started = time.time()
+            queued = self._TakeQueue()
+            try:
+                if started >= nextScan:
+                    # the full scan also covers anything queued, and anything a push was missed for
+                    self.runOnce(None)
+                    nextScan = None
+                elif queued:
+                    logging.debug("%s running on %d queued SampleApps" % (self.name, len(queued)))
+                    self.runOnce(queued)
+            except Exception:
+                # keep going - the next run may well succeed
+                logging.exception("%s run failed" % self.name)
+            logging.debug("%s run took %.1fs" % (self.name, time.time() - started))
+            if nextScan is None:
+                nextScan = time.time() + self.interval
+            self.wakeup.wait(max(0, nextScan - time.time()))
+            self.wakeup.clear()
+
+    def Push(self, sampleAppId):
+        """
+        queue a SampleApp to be worked on now, rather than at the next scan
+        """
+        with self.queueLock:
+            self.queue.append(sampleAppId)
+        self.wakeup.set()
+
+    def Stop(self):
+        """
+        finish the current run, if any, and stop
+        """
+        self.stopping = True
+        self.wakeup.set()
+
+class DownloadStageLoop(threading.Thread):
+    """
+    Runs a DownloadService on its own thread, which keeps its workers busy and checks for new work every interval seconds
+    """
+
+    def __init__(self, interval, safe=False):
+        threading.Thread.__init__(self, name="downloader")
+        self.interval = interval
+        self.service = DownloadServices.DownloadService(safe=safe)
+
+    def run(self):
+        try:
+            self.service.RunForever(self.interval)
+        except Exception:
+            logging.exception("download service failed")
+
+    def Push(self, sampleAppId):
+        """
+        a SampleApp is ready to download. The service takes qc-passed SampleApps in priority order, so rather than
+        downloading this one in particular, have it look for new work now
+        """
+        self.service.Wake()
+
+    def Stop(self):
+        """
+        stop starting downloads; those already running carry on until they finish
+        """
+        self.service.Stop()
+
+class PipelineDaemon(object):
+    """
+    Hosts every stage of the pipeline in one process, each running on its own thread every PIPELINE_INTERVALS seconds.
+    Stages with no interval configured are not run.
+    """
+
+    def __init__(self, intervals=None, safe=False):
+        """
+        @param intervals: (dict) stage name -> seconds between runs (defaults to PIPELINE_INTERVALS)
+        @param safe: (bool) say what each stage would do without doing it
+        """
+        if intervals is None:
+            intervals = ConfigurationServices.GetConfig("PIPELINE_INTERVALS")
+        self.stages = {}
+        runners = {
+            "launcher" : lambda sampleAppIds: RunLauncher(safe=safe),
+            "tracker" : lambda sampleAppIds: RunTracker(safe=safe),
+            "qcchecker" : lambda sampleAppIds: RunQCChecker(safe=safe, sampleAppIds=sampleAppIds),
+            "qcproperties" : lambda sampleAppIds: RunQCPropertyFlush(safe=safe),
+        }
+        for name, runOnce in runners.iteritems():
+            if intervals.get(name):
+                self.stages[name] = StageLoop(name, runOnce, intervals[name])
+        if intervals.get("downloader"):
+            self.stages["downloader"] = DownloadStageLoop(intervals["downloader"], safe)
+        # chain the stages, so a SampleApp moves on as soon as it reaches the status the next stage is waiting for
+        # rather than at that stage's next scan
+        for status, name in [ ("app-finished", "qcchecker"), ("qc-passed", "downloader") ]:
+            if name in self.stages:
+                Repository.AddStatusListener(status, self.stages[name].Push)
+
+    def Start(self):
+        for name in sorted(self.stages):
+            logging.info("starting %s, every %ds" % (name, self.stages[name].interval))
+            self.stages[name].start()
+
+    def Stop(self):
+        """
+        stop every stage once its current run is over; running downloads are allowed to finish
+        """
+        for stage in self.stages.itervalues():
+            stage.Stop()
+
+    def IsRunning(self):
+        return any(stage.is_alive() for stage in self.stages.itervalues())
+
+    def Wait(self):
+        """
+        wait for every stage to stop. Polls rather than joining, so signal handlers still run on the main thread
+        """
+        while self.IsRunning():
+            time.sleep(1)
@@ -0,0 +1,195 @@
+"""
+Services to run automated QC over many SampleApps at once
+
+Fetching metrics files and writing QC properties back to BaseSpace are dominated by network waits,
+so these run concurrently on bounded pools of worker threads. Parsing, threshold evaluation and database
+updates stay on the calling thread and are pipelined behind the downloads in the order they finish,
+with status changes committed to the database in batches.
+
+QC properties are not written to BaseSpace during the QC run. Each status change queues its property write
+in the same transaction, and FlushQCPropertyUpdates() sends the queue separately, retrying failures with backoff,
+so a slow or failing property endpoint does not hold up or break QC.
+"""
+
+import datetime
+import logging
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import AppServices
+import Repository
+import ConfigurationServices
+
+######
+# worker thread routines
+# these must not touch the database - everything they need is unpacked beforehand
+######
+
+def _DownloadWorker(indexedJob):
+    index, qcDownloadJob = indexedJob
+    try:
+        return index, AppServices.DownloadQCMetricsFile(qcDownloadJob), None
+    except Exception as e:
+        return index, None, str(e)
+
+def _PropertyWorker(propertyJob):
+    basespaceId, qcResult, details = propertyJob
+    try:
+        AppServices.SetQCResultForAppSession(basespaceId, qcResult, details)
+        return basespaceId, None
+    except Exception as e:
+        return basespaceId, str(e)
+
+######
+# QC engine
+######
+
+def _CommitBatch(batch, transitions, safe):
+    """
+    save a batch of QC outcomes, their metrics and their queued BaseSpace property writes in one transaction
+
+    @param batch: (list of (DBOrm.SampleApp, str, str, dict)) SampleApp, new status, failure details and parsed metrics
+    @param transitions: (dict) (old status, new status) -> list of app session IDs, updated in place
+    @param safe: (bool) only log what would happen
+    """
+    if not batch:
+        return
+    if safe:
+        for sampleApp, newstatus, failuredetails, metrics in batch:
+            logging.info("would update %s to: %s" % (Repository.SampleAppSummary(sampleApp), newstatus))
+        return
+    batchTransitions = [ (Repository.SampleAppToStatus(sampleApp), newstatus) for sampleApp, newstatus, failuredetails, metrics in batch ]
+    Repository.SetQCResults(batch)
+    for transition, (sampleApp, newstatus, failuredetails, metrics) in zip(batchTransitions, batch):
+        transitions[transition].append(Repository.SampleAppToBaseSpaceId(sampleApp))
+    logging.debug("committed batch of %d QC results" % len(batch))
+
+def RunQC(sampleApps, workers=None, batchSize=None, safe=False):
+    """
+    Apply automated QC to a list of SampleApps, downloading metrics files concurrently
+    and queueing the results to be written to BaseSpace by FlushQCPropertyUpdates()
+
+    A SampleApp whose metrics cannot be fetched or evaluated is logged and left in its current status,
+    so it will be picked up again on the next run.
+
+    @param sampleApps: (list of DBOrm.SampleApp)
+    @param workers: (int) maximum number of concurrent metrics downloads (defaults to QC_WORKERS)
+    @param batchSize: (int) number of status changes to commit at once (defaults to QC_BATCH_SIZE)
+    @param safe: (bool) say what would happen without doing it
+
+    @return (dict): (old status, new status) -> list of app session IDs
+    """
+    if workers is None:
+        workers = ConfigurationServices.GetConfig("QC_WORKERS")
+    if batchSize is None:
+        batchSize = ConfigurationServices.GetConfig("QC_BATCH_SIZE")
+    transitions = defaultdict(list)
+
+    toCheck = []
+    for sampleApp in sampleApps:
+        if not Repository.SampleAppToBaseSpaceId(sampleApp):
+            logging.warn("No BaseSpace Id for SampleApp: %s" % Repository.SampleAppSummary(sampleApp))
+            continue
+        toCheck.append(sampleApp)
+    if not toCheck:
+        return transitions
+    jobs = [ AppServices.SampleAppToQCDownloadJob(sampleApp) for sampleApp in toCheck ]
+    logging.debug("running QC on %d SampleApps with %d workers" % (len(toCheck), workers))
+
+    downloadPool = ThreadPool(workers)
+    batch = []
+    try:
+        # results come back in the order the downloads finish, so parsing overlaps with the downloads still running
+        for index, qcFilePath, error in downloadPool.imap_unordered(_DownloadWorker, enumerate(jobs)):
+            sampleApp = toCheck[index]
+            if error:
+                logging.error("failed to get metrics for %s: %s" % (Repository.SampleAppSummary(sampleApp), error))
+                continue
+            logging.debug("working on: %s %s" % (Repository.SampleAppToSampleName(sampleApp), Repository.SampleAppToAppName(sampleApp)))
+            # apply automated QC to the SampleApp and record the failures
+            # anything can go wrong with a malformed or unreadable metrics file - leave just this SampleApp for the next run
+            try:
+                metrics, failures = AppServices.EvaluateQCMetricsFile(sampleApp, qcFilePath)
+            except Exception as e:
+                logging.error("failed to evaluate metrics for %s: %s" % (Repository.SampleAppSummary(sampleApp), str(e)))
+                continue
+            # use the failures to determine whether the SampleApp is qc-passed or not
+            # failuredetails will be a blank string if there are no failures
+            failuredetails = ";".join([ str(failure) for failure in failures ])
+            if failures:
+                logging.debug("failed: %s" % failuredetails)
+                newstatus = "qc-failed"
+            else:
+                newstatus = "qc-passed"
+            batch.append((sampleApp, newstatus, failuredetails, metrics))
+            if len(batch) >= batchSize:
+                committing, batch = batch, []
+                _CommitBatch(committing, transitions, safe)
+    finally:
+        # commit the results we have even if the run is stopping on an error, so the work isn't lost
+        try:
+            _CommitBatch(batch, transitions, safe)
+        finally:
+            downloadPool.close()
+            downloadPool.join()
+    return transitions
+
+######
+# BaseSpace QC property writes
+######
+
+def _RetryDelay(attempts):
+    """
+    @param attempts: (int) number of failed attempts so far, including the one just made
+
+    @return (datetime.timedelta): how long to wait before trying again, doubling with each failure up to a limit
+    """
+    delay = ConfigurationServices.GetConfig("QC_PROPERTY_RETRY_DELAY") * (2 ** (attempts - 1))
+    return datetime.timedelta(minutes=min(delay, ConfigurationServices.GetConfig("QC_PROPERTY_MAX_RETRY_DELAY")))
+
+def FlushQCPropertyUpdates(workers=None, retryAll=False, safe=False):
+    """
+    Write queued QC results to BaseSpace as app session properties, concurrently.
+    Successful writes are removed from the queue; failed ones stay queued and are retried later, backing off each time.
+
+    @param workers: (int) maximum number of concurrent property writes (defaults to QC_WORKERS)
+    @param retryAll: (bool) send every queued write now, including those still backing off after a failure
+    @param safe: (bool) say what would happen without doing it
+
+    @return (int, int): the number of writes that succeeded and failed
+    """
+    if workers is None:
+        workers = ConfigurationServices.GetConfig("QC_WORKERS")
+    now = datetime.datetime.now()
+    if safe:
+        for propertyUpdate in Repository.GetPendingQCPropertyUpdates():
+            if retryAll or Repository.QCPropertyUpdateToNextAttempt(propertyUpdate) <= now:
+                logging.info("would write QC result: %s" % Repository.QCPropertyUpdateSummary(propertyUpdate))
+            else:
+                logging.info("waiting to retry QC result: %s" % Repository.QCPropertyUpdateSummary(propertyUpdate))
+        return 0, 0
+    propertyUpdates = Repository.GetPendingQCPropertyUpdates(None if retryAll else now)
+    if not propertyUpdates:
+        return 0, 0
+    logging.debug("writing %d queued QC results with %d workers" % (len(propertyUpdates), workers))
+
+    jobs = [ (Repository.QCPropertyUpdateToBaseSpaceId(propertyUpdate), Repository.QCPropertyUpdateToQCResult(propertyUpdate),
+              Repository.QCPropertyUpdateToDetails(propertyUpdate)) for propertyUpdate in propertyUpdates ]
+    numSent = numFailed = 0
+    propertyPool = ThreadPool(workers)
+    try:
+        # imap hands back the results in queue order, so each can be matched to its entry
+        for propertyUpdate, (basespaceId, error) in zip(propertyUpdates, propertyPool.imap(_PropertyWorker, jobs)):
+            if error:
+                attempts = Repository.QCPropertyUpdateToAttempts(propertyUpdate) + 1
+                nextAttempt = datetime.datetime.now() + _RetryDelay(attempts)
+                logging.error("%s (attempt %d, will retry after %s)" % (error, attempts, nextAttempt))
+                Repository.SetQCPropertyUpdateFailed(propertyUpdate, error, nextAttempt)
+                numFailed += 1
+            else:
+                Repository.DeleteQCPropertyUpdate(propertyUpdate)
+                numSent += 1
+    finally:
+        propertyPool.close()
+        propertyPool.join()
+    return numSent, numFailed
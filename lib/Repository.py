@@ -11,6 +11,9 @@ http://stackoverflow.com/questions/31875/is-there-a-simple-elegant-way-to-define
 import csv
 import json
 import os
+import datetime
+import threading
+import contextlib
 import DBApi
 import ConfigurationServices
 
@@ -46,11 +49,35 @@ def SampleAppSummary(sampleApp, showDetails=False):
 def SampleAppToStatusDetails(sampleApp):
     return sampleApp.statusdetails
 
+def SampleAppToLeaseOwner(sampleApp):
+    return sampleApp.leaseowner
+
+def SampleAppToLeaseExpiry(sampleApp):
+    return sampleApp.leaseexpiry
+
+def SampleAppToAttempts(sampleApp):
+    return sampleApp.attempts
+
+def SampleAppToLastUpdated(sampleApp):
+    return sampleApp.lastupdated
+
+def SampleAppToLaunched(sampleApp):
+    return sampleApp.launched
+
+def SampleAppToFinished(sampleApp):
+    return sampleApp.finished
+
+def SampleAppToNextPoll(sampleApp):
+    return sampleApp.nextpoll
+
 # SampleApp members via at least one join, but not to the App table
 
 def SampleAppToProjectId(sampleApp):
     return sampleApp.sample.project.basespaceid
 
+def SampleAppToProjectName(sampleApp):
+    return sampleApp.sample.project.name
+
 def SampleAppToOutputDirectory(sampleApp):
     # maybe I shouldn't encode this here...
     outputpath = sampleApp.sample.project.outputpath
@@ -65,6 +92,9 @@ def SampleAppToSampleName(sampleApp):
 def SampleAppToAppId(sampleApp):
     return sampleApp.app.basespaceid
 
+def SampleAppToLocalAppId(sampleApp):
+    return sampleApp.app.id
+
 def SampleAppToMetricsFile(sampleApp):
     return sampleApp.app.metricsfile
 
@@ -86,6 +116,9 @@ def SampleAppToTemplate(sampleApp):
 def SampleAppToQCThresholds(sampleApp):
     return json.loads(sampleApp.app.qcthresholds)
 
+def SampleAppToQCThresholdsJson(sampleApp):
+    return sampleApp.app.qcthresholds
+
 # Project
 
 def ProjectToName(project):
@@ -119,6 +152,9 @@ def SampleToSampleName(sample):
 def AppToName(app):
     return app.name
 
+def AppToLocalId(app):
+    return app.id
+
 def AppToType(app):
     return app.type
 
@@ -145,6 +181,55 @@ def AppToDeliverableList(app):
 def AppToAppResultName(app):
     return app.resultname
 
+# QCPropertyUpdate
+
+def QCPropertyUpdateToBaseSpaceId(propertyUpdate):
+    return propertyUpdate.basespaceid
+
+def QCPropertyUpdateToQCResult(propertyUpdate):
+    return propertyUpdate.qcresult
+
+def QCPropertyUpdateToDetails(propertyUpdate):
+    return propertyUpdate.details
+
+def QCPropertyUpdateToAttempts(propertyUpdate):
+    return propertyUpdate.attempts
+
+def QCPropertyUpdateToNextAttempt(propertyUpdate):
+    return propertyUpdate.nextattempt
+
+def QCPropertyUpdateSummary(propertyUpdate):
+    summary = "%s (%s) queued %s, %d attempts" % (propertyUpdate.basespaceid, propertyUpdate.qcresult, propertyUpdate.created, propertyUpdate.attempts)
+    if propertyUpdate.lasterror:
+        summary += ", next attempt %s (last error: %s)" % (propertyUpdate.nextattempt, propertyUpdate.lasterror)
+    return summary
+
+# DownloadManifest
+
+def DownloadManifestToFileId(manifestEntry):
+    return manifestEntry.fileid
+
+def DownloadManifestToName(manifestEntry):
+    return manifestEntry.name
+
+def DownloadManifestToPath(manifestEntry):
+    return manifestEntry.path
+
+def DownloadManifestToSize(manifestEntry):
+    return manifestEntry.size
+
+def DownloadManifestToEtag(manifestEntry):
+    return manifestEntry.etag
+
+def DownloadManifestToChecksum(manifestEntry):
+    return manifestEntry.checksum
+
+def DownloadManifestToVerification(manifestEntry):
+    return manifestEntry.verification
+
+def DownloadManifestSummary(manifestEntry):
+    return "%s\t%d\t%s\t%s" % (manifestEntry.path, manifestEntry.size, manifestEntry.checksum or "-", manifestEntry.verification)
+
 ######
 # create entities
 ######
@@ -305,6 +390,21 @@ def GetSampleAppByID(sampleAppId):
 def GetSampleAppByConstraints(constraints, exact=False):
     return DBApi.GetSampleAppByConstraints(constraints, exact)
 
+def ClaimSampleApps(statuses, limit, owner, leaseDuration, sampleAppIds=None, dueForPoll=False, afterId=0, upToId=None):
+    # lease up to limit SampleApps in any of the statuses (a str or a list) for leaseDuration seconds, skipping any held by someone else
+    # so several processes can work through the same stage's queue without doing anything twice
+    if isinstance(statuses, basestring):
+        statuses = [ statuses ]
+    now = datetime.datetime.now()
+    expiry = now + datetime.timedelta(seconds=leaseDuration)
+    return DBApi.ClaimSampleApps(statuses, limit, owner, expiry, now, sampleAppIds, dueForPoll, afterId, upToId)
+
+def GetSampleAppsDueForPoll(statuses):
+    return DBApi.GetSampleAppsDueForPoll(statuses, datetime.datetime.now())
+
+def GetAppRuntimes(limit):
+    return DBApi.GetAppRuntimes(limit)
+
 def GetSampleAppMapping():
     return DBApi.GetSampleAppMapping()
 
@@ -332,27 +432,226 @@ def GetAllSamplesWithRelationships():
 def GetNormalForTumour(tumourSampleName):
     return DBApi.GetNormalForTumour(tumourSampleName)
 
+def GetTumourNormalMapping():
+    return DBApi.GetTumourNormalMapping()
+
+def GetNormalNameForTumour(tumourSampleName):
+    return DBApi.GetNormalNameForTumour(tumourSampleName)
+
+def GetMetricsMatrix(constraints, metricNames=None, exact=False):
+    """
+    pivot the stored QC metrics for the SampleApps matching some constraints into a matrix
+    with one row per SampleApp and one column per metric
+
+    @param constraints: (dict) as for GetSampleAppByConstraints
+    @param metricNames: (list of str) only include these metrics, if provided
+    @param exact: (bool)
+
+    @return (list of str): metric names (the columns), (list of (tuple, dict)): one entry per row,
+            (SampleApp id, sample name, project name, app name, status) and metric name -> value
+    """
+    rows = []
+    allMetricNames = set()
+    lastSampleAppId = None
+    for sampleAppId, sampleName, projectName, appName, status, metricName, numericValue, textValue in DBApi.GetSampleAppMetrics(constraints, metricNames, exact):
+        # the query is ordered by SampleApp, so each SampleApp's metrics arrive together
+        if sampleAppId != lastSampleAppId:
+            rows.append(((sampleAppId, sampleName, projectName, appName, status), {}))
+            lastSampleAppId = sampleAppId
+        rows[-1][1][metricName] = numericValue if numericValue is not None else textValue
+        allMetricNames.add(metricName)
+    if metricNames:
+        columns = [ metricName for metricName in metricNames if metricName in allMetricNames ]
+    else:
+        columns = sorted(allMetricNames)
+    return columns, rows
+
+def GetReadinessFingerprints():
+    return DBApi.GetReadinessFingerprints()
+
+def GetStageCursor(stage):
+    return DBApi.GetStageCursor(stage)
+
+def GetPendingQCPropertyUpdates(dueBy=None, limit=None):
+    return DBApi.GetPendingQCPropertyUpdates(dueBy, limit)
+
+def GetSampleAppsWithExpiredLeases(status, now):
+    return DBApi.GetSampleAppsWithExpiredLeases(status, now)
+
+def GetDownloadManifest(sampleApp):
+    return DBApi.GetDownloadManifest(sampleApp)
+
 ######
 # update values of entities
 ######
 
 def SetNewSampleAppSessionId(sampleApp, appSessionId):
     sampleApp.basespaceid = appSessionId
+    sampleApp.launched = datetime.datetime.now()
+    sampleApp.finished = None
+    sampleApp.nextpoll = None
     sampleApp.save()
 
+def SetTrackedStatus(sampleApp, newStatus, nextPoll):
+    # record what the Tracker found out about an app session: its status, when it finished if it just has, and when to ask again
+    if newStatus == "app-finished" and sampleApp.status != newStatus:
+        sampleApp.finished = datetime.datetime.now()
+    sampleApp.nextpoll = nextPoll
+    SetSampleAppStatus(sampleApp, newStatus)
+    if sampleApp.is_dirty():
+        # the status hasn't changed, so SetSampleAppStatus hasn't saved
+        sampleApp.save()
+
 def SetSampleAppStatus(sampleApp, newStatus, details=""):
+    # a status change made this way releases any lease and starts the attempt count afresh
     PERMITTED_STATUSES = ConfigurationServices.GetConfig("PERMITTED_STATUSES")
     if newStatus not in PERMITTED_STATUSES:
         raise RepositoryException("invalid status: %s" % newStatus)
-    if sampleApp.status != newStatus or sampleApp.statusdetails != details:
+    statusChanged = sampleApp.status != newStatus
+    if statusChanged or sampleApp.statusdetails != details:
+        if statusChanged:
+            sampleApp.leaseowner = None
+            sampleApp.leaseexpiry = None
+            sampleApp.attempts = 0
         sampleApp.status = newStatus
         sampleApp.statusdetails = details
         sampleApp.save()
+        if statusChanged:
+            _NotifyStatusChange(sampleApp)
+
+def LeaseSampleApp(sampleApp, newStatus, owner, expiry, details=""):
+    # set the status and take a lease on the SampleApp, counting this as another attempt
+    PERMITTED_STATUSES = ConfigurationServices.GetConfig("PERMITTED_STATUSES")
+    if newStatus not in PERMITTED_STATUSES:
+        raise RepositoryException("invalid status: %s" % newStatus)
+    sampleApp.status = newStatus
+    sampleApp.statusdetails = details
+    sampleApp.leaseowner = owner
+    sampleApp.leaseexpiry = expiry
+    sampleApp.attempts += 1
+    sampleApp.save()
+
+def SetUnclaimedStatusDetails(sampleApp, status, details):
+    # note why a SampleApp is still waiting, without touching it if it has moved on or been claimed since we read it
+    return DBApi.SetUnclaimedStatusDetails(sampleApp.id, status, details)
+
+def RenewSampleAppLeases(sampleAppIds, owner, expiry):
+    return DBApi.RenewSampleAppLeases(sampleAppIds, owner, expiry)
+
+def ReleaseSampleApps(sampleAppIds, owner):
+    # let go of claimed SampleApps without changing them
+    return DBApi.ReleaseSampleApps(sampleAppIds, owner)
+
+def RequeueSampleApp(sampleApp, newStatus, details=""):
+    # release the lease on a SampleApp and put it back to be tried again, keeping count of the attempts so far
+    PERMITTED_STATUSES = ConfigurationServices.GetConfig("PERMITTED_STATUSES")
+    if newStatus not in PERMITTED_STATUSES:
+        raise RepositoryException("invalid status: %s" % newStatus)
+    sampleApp.status = newStatus
+    sampleApp.statusdetails = details
+    sampleApp.leaseowner = None
+    sampleApp.leaseexpiry = None
+    sampleApp.save()
+
+def SetReadinessFingerprints(fingerprints):
+    DBApi.SetReadinessFingerprints(fingerprints)
+
+def SetStageCursor(stage, sampleAppId):
+    DBApi.SetStageCursor(stage, sampleAppId)
+
+def _MetricsToRows(metrics):
+    # split each metric into a numeric value if we can read it as a number, or a text value if not
+    metricRows = []
+    for metricName, value in metrics.iteritems():
+        if value is None:
+            metricRows.append((metricName, None, None))
+            continue
+        try:
+            metricRows.append((metricName, float(value), None))
+        except (TypeError, ValueError):
+            metricRows.append((metricName, None, unicode(value)))
+    return metricRows
+
+def SetQCResults(qcResults):
+    # qcResults is a list of (sampleApp, newStatus, details, metrics), all saved in one transaction
+    # metrics is a dict of metric name -> value, as parsed from the metrics file, and replaces any stored previously
+    # each result is also queued to be written to BaseSpace, so it can't be lost between the status change and the property write
+    with _Transaction():
+        for sampleApp, newStatus, details, metrics in qcResults:
+            SetSampleAppStatus(sampleApp, newStatus, details)
+            DBApi.SetSampleAppMetrics(sampleApp, _MetricsToRows(metrics))
+            DBApi.EnqueueQCPropertyUpdate(sampleApp, newStatus, details)
+
+def SetQCPropertyUpdateFailed(propertyUpdate, error, nextAttempt):
+    DBApi.SetQCPropertyUpdateFailed(propertyUpdate, error, nextAttempt)
+
+def SetDeliverableDownloaded(sampleApp, downloadedFiles, details=""):
+    # mark a SampleApp downloaded and record the verified files in its download manifest, in one transaction
+    # downloadedFiles is a list of TransferServices.DownloadedFile
+    manifestRows = [ (downloadedFile.fileId, downloadedFile.name, downloadedFile.path, downloadedFile.size, downloadedFile.etag,
+                      downloadedFile.checksum, downloadedFile.verification) for downloadedFile in downloadedFiles ]
+    with _Transaction():
+        SetSampleAppStatus(sampleApp, "downloaded", details)
+        DBApi.SetDownloadManifest(sampleApp, manifestRows)
+
+######
+# status change listeners
+######
+
+# status -> functions called with the id of each SampleApp that changes to that status (eg. to start the next pipeline stage on it)
+_statusListeners = {}
+# status changes made inside a transaction on this thread, held back until it commits so listeners see the new status
+_pendingStatusChanges = threading.local()
+
+def AddStatusListener(status, listener):
+    _statusListeners.setdefault(status, []).append(listener)
+
+def RemoveStatusListeners():
+    _statusListeners.clear()
+
+def _PendingStatusChanges():
+    if not hasattr(_pendingStatusChanges, "changes"):
+        _pendingStatusChanges.changes = []
+    return _pendingStatusChanges.changes
+
+def _NotifyStatusChange(sampleApp):
+    if sampleApp.status not in _statusListeners:
+        return
+    if DBApi.DBOrm.database.transaction_depth():
+        _PendingStatusChanges().append((sampleApp.status, sampleApp.id))
+    else:
+        _CallStatusListeners(sampleApp.status, sampleApp.id)
+
+def _CallStatusListeners(status, sampleAppId):
+    for listener in _statusListeners.get(status, []):
+        listener(sampleAppId)
+
+@contextlib.contextmanager
+def _Transaction():
+    # a database transaction that tells the status listeners about the changes made in it once it has committed
+    pending = _PendingStatusChanges()
+    try:
+        with DBApi.DBOrm.database.transaction():
+            yield
+    except:
+        del pending[:]
+        raise
+    if not DBApi.DBOrm.database.transaction_depth():
+        changes = pending[:]
+        del pending[:]
+        for status, sampleAppId in changes:
+            _CallStatusListeners(status, sampleAppId)
 
 ######
 # delete entities
 ######
 
+def ClearReadinessFingerprint(sampleApp):
+    DBApi.ClearReadinessFingerprint(sampleApp)
+
+def DeleteQCPropertyUpdate(propertyUpdate):
+    DBApi.DeleteQCPropertyUpdate(propertyUpdate)
+
 def DeleteSampleApp(sampleApp):
     sampleApp.delete_instance()
 
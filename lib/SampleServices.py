@@ -11,83 +11,169 @@ sys.path.insert(0, os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "..", "ba
 
 from BaseSpacePy.api.BaseSpaceAPI import BaseSpaceAPI
 from BaseSpacePy.model.QueryParameters import QueryParameters
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from memoize import memoized
 from operator import attrgetter
 import Repository
+import ConfigurationServices
 
 NUMREADS_ATTR = "NumReadsPF"
 READ1_ATTR = "Read1"
 READ2_ATTR = "Read2"
 PAIRED_END_ATTR = "IsPairedEnd"
 
+# ways of turning the yields of several bundles with the same sample name into a single sample yield
+# "mostrecent" only counts the most recent bundle, "all" adds up every bundle (eg. for top-up sequencing)
+YIELD_AGGREGATIONS = set([ "mostrecent", "all" ])
+
+yieldAttrs = attrgetter(NUMREADS_ATTR, READ1_ATTR, PAIRED_END_ATTR)
+
+# compact record of a BaseSpace sample (bundle), holding only the fields LaunchSpace uses
+# the full SDK model objects are much bigger and we cache these for the life of the process
+SampleBundle = namedtuple("SampleBundle", [ "Id", "SampleId", "DateCreated", NUMREADS_ATTR, READ1_ATTR, READ2_ATTR, PAIRED_END_ATTR ])
+bundleAttrs = attrgetter(*SampleBundle._fields)
+
+# readiness of a single sample name within a project, as used by the Launcher
+# mostRecent is the most recent SampleBundle for this name, or None if there is no data
+# bundles are the SampleBundles that contributed to sampleYield, most recent first
+SampleReadiness = namedtuple("SampleReadiness", [ "hasData", "mostRecent", "sampleYield", "bundles" ])
+NO_DATA = SampleReadiness(False, None, 0.0, [])
+
 baseSpaceAPI = BaseSpaceAPI()
 noLimitQP = QueryParameters({ "Limit" : 1000 })
 
 def OrganiseSamples(allSampleList):
     """
     GetSamplesInProject() returns a flat list of samples. 
-    This rearranges it a little to make it easier to work with
+    This rearranges it a little to make it easier to work with, and converts each
+    BaseSpace sample object into a compact SampleBundle
 
     @param allSampleList: (list of BaseSpace sample objects)
 
-    @return (dict): sample_name -> list of BaseSpace sample objects
+    @return (dict): sample_name -> list of SampleBundles, with the most recent first (the rest are in no particular order)
     """
     sampleListsByName = defaultdict(list)
     for sample in allSampleList:
+        bundle = SampleBundle(*bundleAttrs(sample))
         # don't forget! a BaseSpace "Sample" is a bundle of fastq files
         # there could be more than one bundle with the same sample name
         # but these are distinct as far as BaseSpace is concerned
         # so we make a list of all the BaseSpace samples with the same samplename
-        sampleListsByName[sample.SampleId].append(sample)
-    # sort each list by date so we can easily get the most recent
-    for sampleName, sampleList in sampleListsByName.iteritems():
-        sampleList.sort(key=attrgetter("DateCreated"), reverse=True)
-    return sampleListsByName
+        sampleList = sampleListsByName[bundle.SampleId]
+        sampleList.append(bundle)
+        # keep the most recent at the front as we go, so we don't need to sort each list
+        if bundle.DateCreated > sampleList[0].DateCreated:
+            sampleList[0], sampleList[-1] = sampleList[-1], sampleList[0]
+    return dict(sampleListsByName)
 
 
 @memoized
 def GetSamplesInProject(projectId):
     """
-    get all the basespace sample objects for a given project projectId
+    get all the basespace samples for a given project projectId, as compact SampleBundles
     note the use of the "noLimitQP", a BaseSpaceAPI QueryParameters object that ensures we get as many as we can (up to 1000)
 
     @param projectId: (str) BaseSpace ID for project
 
-    @return (dict): sample_name -> list of BaseSpace sample objects
+    @return (dict): sample_name -> list of SampleBundles, most recent first
     """
     logging.debug("retrieving samples from BaseSpace")
     sampleList = baseSpaceAPI.getSamplesByProject(projectId, noLimitQP)
     organised = OrganiseSamples(sampleList)
+    # drop our reference to the SDK objects straight away, we only keep the compact bundles
+    del sampleList
     logging.debug("Found: %s" % (organised.keys()))
     return organised
 
 def GetMostRecentSampleFromSampleName(sampleName, projectId):
     """
-    Get the most recent BaseSpace sampel object from the sample name.
-    Relies on date ordering provided by OrganiseSamples()
+    Get the most recent BaseSpace sample (as a SampleBundle) from the sample name.
+    Relies on the most-recent-first ordering provided by OrganiseSamples()
 
     @param sampleName: (str)
     @param projectId: (str)
     """
     samples = GetSamplesInProject(projectId)
-    # uses the sort-by-date to return the most recent!
+    # OrganiseSamples() keeps the most recent at the front!
     return samples[sampleName][0]
 
-def GetSampleYield(sampleName, projectId):
-    sample = GetMostRecentSampleFromSampleName(sampleName, projectId)
-    readLength = getattr(sample, READ1_ATTR)
-    numReads = getattr(sample, NUMREADS_ATTR)
-    if getattr(sample, PAIRED_END_ATTR):
-        assert getattr(sample, READ1_ATTR) == getattr(sample, READ1_ATTR), "cannot measure yield on sample with unequal read lengths!"
+class SampleServicesException(Exception):
+    pass
+
+def _BundleYield(bundle):
+    """
+    @param bundle: (SampleBundle)
+
+    @return (float): the yield of a bundle in bases, or 0 if BaseSpace hasn't given its number of reads or read length
+    """
+    numReads, readLength, paired = yieldAttrs(bundle)
+    if numReads is None or readLength is None:
+        return 0.0
+    if paired:
         # number of reads * 2 for paired end and * by readlength gives yield in bases
-        sampleYield = float(numReads) * 2 * readLength
-    else:
-        # TODO: do we even want to support single-end runs like this?
-        sampleYield = float(numReads) * readLength
-    return sampleYield
+        # read2 isn't counted separately: read1's length stands for both reads, even where they differ
+        return float(numReads) * 2 * readLength
+    # TODO: do we even want to support single-end runs like this?
+    return float(numReads) * readLength
 
-def SampleHasData(sampleName, projectId):
+def _YieldBundles(sampleList, aggregation="mostrecent"):
+    """
+    @param sampleList: (list of SampleBundles) the bundles for one sample name, most recent first
+    @param aggregation: (str) one of YIELD_AGGREGATIONS
+
+    @return (list of SampleBundles): the bundles that count towards the sample yield, most recent first
+    """
+    if aggregation == "all":
+        return list(sampleList)
+    return sampleList[:1]
+
+def ComputeYields(sampleListsByName, aggregation="mostrecent"):
+    """
+    compute the aggregated yield of every sample name in a project in one pass
+
+    @param sampleListsByName: (dict) sample_name -> list of SampleBundles, most recent first (see OrganiseSamples())
+    @param aggregation: (str) one of YIELD_AGGREGATIONS
+
+    @return (dict): sample_name -> aggregated yield
+
+    @raises SampleServicesException if the aggregation is unknown
+    """
+    if aggregation not in YIELD_AGGREGATIONS:
+        raise SampleServicesException("unknown yield aggregation: %s" % aggregation)
+    return dict((sampleName, sum(_BundleYield(bundle) for bundle in _YieldBundles(sampleList, aggregation)))
+                for sampleName, sampleList in sampleListsByName.iteritems())
+
+@memoized
+def GetReadinessIndex(projectId):
+    """
+    build the readiness of every sample name in a project in one go, so the Launcher doesn't
+    have to recompute it for each SampleApp (or each time a normal is shared between tumours)
+
+    @param projectId: (str) BaseSpace ID for project
+
+    @return (dict): sample_name -> SampleReadiness
+    """
+    aggregation = ConfigurationServices.GetConfig("YieldAggregation")
     sampleListsByName = GetSamplesInProject(projectId)
-    return sampleName in sampleListsByName
+    sampleYields = ComputeYields(sampleListsByName, aggregation)
+    readinessIndex = {}
+    for sampleName, sampleList in sampleListsByName.iteritems():
+        # OrganiseSamples() keeps the most recent at the front!
+        readinessIndex[sampleName] = SampleReadiness(True, sampleList[0], sampleYields[sampleName], _YieldBundles(sampleList, aggregation))
+    logging.debug("built readiness index for project %s (%d samples, %s yield)" % (projectId, len(readinessIndex), aggregation))
+    return readinessIndex
 
+def GetSampleReadiness(sampleName, projectId):
+    """
+    @param sampleName: (str)
+    @param projectId: (str)
+
+    @return (SampleReadiness): NO_DATA if there is no data for this sample name
+    """
+    return GetReadinessIndex(projectId).get(sampleName, NO_DATA)
+
+def GetSampleYield(sampleName, projectId):
+    return GetSampleReadiness(sampleName, projectId).sampleYield
+
+def SampleHasData(sampleName, projectId):
+    return GetSampleReadiness(sampleName, projectId).hasData
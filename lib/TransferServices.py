@@ -0,0 +1,570 @@
+"""
+Resumable, ranged downloads of BaseSpace files
+
+A file is fetched in fixed-size chunks with HTTP range requests, straight from the storage URL that BaseSpace
+gives for it. Chunks are written into a .partial file next to the destination, and a checkpoint file alongside
+records which chunks are safely on disk, so an interrupted download carries on from where it stopped rather than
+starting again. Large files can have several chunks in flight at once. Only once every chunk is in place is the
+.partial file renamed to its final name, so a file with its final name is always complete.
+
+Files are checksummed as they stream in and checked against the ETag BaseSpace's storage holds for them, so a
+completed download needs no second read from disk to verify it. For a file uploaded in one piece the ETag is the
+md5 of the whole file, which has to be computed in order, so such files are fetched one chunk at a time. For a file
+uploaded in parts the ETag is the md5 of the md5s of the parts; chunks are then whole numbers of parts and can be
+fetched in any order. The part size has to be guessed, so if the parts don't match with the likeliest size, the file is
+read back and checked with every other size that fits; if none matches, or the ETag is neither kind of md5, only the
+file's size can be checked.
+
+When syncing, a file already in the output directory is left alone if it matches the size and ETag recorded in the
+download manifest, or failing that if its checksum on disk matches the ETag.
+
+All the downloads in a process share one token bucket, which holds them to DOWNLOAD_BANDWIDTH_LIMIT bytes per second
+between them, and one throughput meter, which schedulers can use to decide whether there is room for another download.
+
+Nothing here touches the database, so downloads can run on worker threads.
+"""
+
+import os
+import re
+import json
+import hashlib
+import binascii
+import time
+import logging
+import threading
+import urllib2
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import ConfigurationServices
+
+class TransferServicesException(Exception):
+    pass
+
+# bytes to read from the network at a time
+READ_SIZE = 1024 * 1024
+
+PARTIAL_SUFFIX = ".partial"
+CHECKPOINT_SUFFIX = ".partial.checkpoint"
+
+MEGABYTE = 1024 * 1024
+
+# how a downloaded file was verified: its checksum matched the ETag, or only its size could be checked
+VERIFIED_BY_ETAG = "etag"
+VERIFIED_BY_SIZE = "size"
+
+# a file that has been downloaded and verified
+# checksum is in the same form as the ETag (or None if only the size was checked); transferred is the bytes fetched this time,
+# and skipped is set if the file was already present and up to date, so nothing was fetched
+DownloadedFile = namedtuple("DownloadedFile", [ "fileId", "name", "path", "size", "etag", "checksum", "verification", "transferred", "skipped" ])
+
+# part sizes that uploaders commonly use, tried first when working out how a multipart ETag was made
+COMMON_PART_SIZES = [ 8 * MEGABYTE, 16 * MEGABYTE, 64 * MEGABYTE, 100 * MEGABYTE ]
+
+def _ParseEtag(etag, size):
+    """
+    work out how to check a file against its ETag
+
+    The part size of a multipart ETag isn't recorded. Uploaders use a whole number of megabytes, but as the last part
+    can be short, several sizes can give the same number of parts; any of them may be the one that was used.
+
+    @return (int, list of int): the number of parts the file was uploaded in and the possible sizes of each part, the
+        common sizes first (empty for a single part), or (None, []) if the ETag is not an md5 we can reproduce
+    """
+    match = re.match(r"^([0-9a-f]{32})(?:-(\d+))?$", (etag or "").strip('"').lower())
+    if not match:
+        return None, []
+    if match.group(2) is None:
+        return 1, []
+    numParts = int(match.group(2))
+    if numParts < 1 or size < 1:
+        return None, []
+    # numParts parts of partSize bytes, the last of them short, need (numParts - 1) * partSize < size <= numParts * partSize
+    smallest = max(1, (size + numParts * MEGABYTE - 1) // (numParts * MEGABYTE))
+    if numParts == 1:
+        largest = smallest
+    else:
+        largest = (size - 1) // ((numParts - 1) * MEGABYTE)
+    partSizes = [ megabytes * MEGABYTE for megabytes in range(smallest, largest + 1)
+                  if (size + megabytes * MEGABYTE - 1) // (megabytes * MEGABYTE) == numParts ]
+    if not partSizes:
+        return None, []
+    common = [ partSize for partSize in COMMON_PART_SIZES if partSize in partSizes ]
+    return numParts, common + [ partSize for partSize in partSizes if partSize not in common ]
+
+class _PartHasher(object):
+    """
+    md5s of the fixed-size parts of a file, fed with its bytes in order starting at a part boundary
+    """
+
+    def __init__(self, partSize, offset):
+        self.partSize = partSize
+        self.offset = offset
+        self.current = hashlib.md5()
+        # part index -> hex md5
+        self.digests = {}
+
+    def Update(self, data):
+        while data:
+            partIndex = self.offset // self.partSize
+            take = (partIndex + 1) * self.partSize - self.offset
+            piece = data[:take]
+            self.current.update(piece)
+            self.offset += len(piece)
+            data = data[take:]
+            if self.offset % self.partSize == 0:
+                self.digests[partIndex] = self.current.hexdigest()
+                self.current = hashlib.md5()
+
+    def Finish(self):
+        # the last part of the file may be short
+        if self.offset % self.partSize:
+            self.digests[self.offset // self.partSize] = self.current.hexdigest()
+        return self.digests
+
+class TokenBucket(object):
+    """
+    Limits the rate of bytes across all the threads that share it. Tokens accrue at the given rate up to a burst
+    of one second's worth (or one read, if bigger); a thread that takes more than are available sleeps off the debt.
+    """
+
+    def __init__(self, bytesPerSecond):
+        """
+        @param bytesPerSecond: (int) the rate to allow, or 0 for no limit
+        """
+        self.lock = threading.Lock()
+        self.SetRate(bytesPerSecond)
+
+    def SetRate(self, bytesPerSecond):
+        with self.lock:
+            self.rate = float(bytesPerSecond)
+            self.burst = max(self.rate, READ_SIZE)
+            self.tokens = self.burst
+            self.lastRefill = time.time()
+
+    def Consume(self, numBytes):
+        """
+        take tokens for some bytes, waiting if they have to be paid for
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate)
+            self.lastRefill = now
+            self.tokens -= numBytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class ThroughputMeter(object):
+    """
+    Bytes per second across all the threads that share it, averaged over the last few seconds
+    """
+
+    def __init__(self, window=10):
+        """
+        @param window: (int) seconds to average over
+        """
+        self.lock = threading.Lock()
+        self.window = window
+        # whole second -> bytes in that second
+        self.buckets = {}
+
+    def Add(self, numBytes):
+        second = int(time.time())
+        with self.lock:
+            self.buckets[second] = self.buckets.get(second, 0) + numBytes
+
+    def Rate(self):
+        """
+        @return (float): bytes per second over the last window seconds, not counting the current, incomplete second
+        """
+        now = int(time.time())
+        with self.lock:
+            for second in [ second for second in self.buckets if second < now - self.window ]:
+                del self.buckets[second]
+            numBytes = sum(numBytes for second, numBytes in self.buckets.iteritems() if second < now)
+        return numBytes / float(self.window)
+
+# shared by every download in the process
+bandwidthLimiter = TokenBucket(ConfigurationServices.GetConfig("DOWNLOAD_BANDWIDTH_LIMIT"))
+throughputMeter = ThroughputMeter()
+
+def SetBandwidthLimit(bytesPerSecond):
+    """
+    @param bytesPerSecond: (int) the most all the downloads in this process may use between them, or 0 for no limit
+    """
+    bandwidthLimiter.SetRate(bytesPerSecond)
+
+def MeasuredThroughput():
+    """
+    @return (float): bytes per second downloaded by this process recently
+    """
+    return throughputMeter.Rate()
+
+def FreeDiskSpace(path):
+    """
+    @param path: (str) a directory, which need not exist yet
+
+    @return (int, int): the device id of the filesystem it is (or would be) on, and the bytes free there for ordinary users
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stats = os.statvfs(path)
+    return os.stat(path).st_dev, stats.f_bavail * stats.f_frsize
+
+def _GetFileUrl(api, fileId):
+    """
+    @return (str, str): a URL the file content can be fetched from with range requests, and the file's ETag
+    """
+    try:
+        metadata = api.fileS3metadata(fileId)
+    except Exception as e:
+        raise TransferServicesException("failed to get download URL for file: %s (%s)" % (fileId, str(e)))
+    return metadata["url"], metadata.get("etag")
+
+def _WriteJsonAtomically(path, data):
+    tmpPath = "%s.tmp" % path
+    with open(tmpPath, "w") as fh:
+        json.dump(data, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmpPath, path)
+
+def _CombinePartMd5s(partMd5s, numParts):
+    # a multipart ETag is the md5 of the binary md5s of the parts, and the number of parts
+    digests = "".join(binascii.unhexlify(partMd5s[partIndex]) for partIndex in range(numParts))
+    return "%s-%d" % (hashlib.md5(digests).hexdigest(), numParts)
+
+def _ChecksumLocalFile(path, numParts, partSize):
+    """
+    checksum a file on disk in the same form as an ETag
+
+    @param numParts: (int) the number of parts the file was uploaded in
+    @param partSize: (int) the size of each part, or None for a single part
+
+    @return (str): the checksum
+    """
+    wholeMd5 = hashlib.md5()
+    partHasher = _PartHasher(partSize, 0) if partSize else None
+    with open(path, "rb") as fh:
+        while True:
+            data = fh.read(READ_SIZE)
+            if not data:
+                break
+            if partHasher is not None:
+                partHasher.Update(data)
+            else:
+                wholeMd5.update(data)
+    if partHasher is None:
+        return wholeMd5.hexdigest()
+    return _CombinePartMd5s(partHasher.Finish(), numParts)
+
+def _MatchLocalFile(path, etag, size, triedPartSize=None):
+    """
+    checksum a file on disk against its ETag, trying each part size that could have been used
+
+    @param triedPartSize: (int) a part size already checked, which needn't be tried again
+
+    @return (str): the checksum in the same form as the ETag if it matches, otherwise None (including where the ETag
+        is not an md5 we can reproduce)
+    """
+    numParts, partSizes = _ParseEtag(etag, size)
+    if numParts is None:
+        return None
+    expected = etag.strip('"').lower()
+    for partSize in partSizes or [ None ]:
+        if partSize is not None and partSize == triedPartSize:
+            continue
+        checksum = _ChecksumLocalFile(path, numParts, partSize)
+        if checksum == expected:
+            return checksum
+    return None
+
+class ResumableDownload(object):
+    """
+    One BaseSpace file being downloaded into a directory, in chunks, picking up any earlier attempt's progress
+    """
+
+    def __init__(self, api, appResultFile, outputDir, streams=None, chunkSize=None, sync=False, previous=None):
+        """
+        @param api: (BaseSpaceAPI)
+        @param appResultFile: (BaseSpace file object)
+        @param outputDir: (str) the directory to put the file in
+        @param sync: (bool) leave the file alone if it's already in place and up to date
+        @param previous: (DownloadedFile) the manifest entry for an earlier download of the file, if there is one
+        @param streams: (int) maximum number of chunks to fetch at once, for files of at least DOWNLOAD_PARALLEL_MIN_SIZE bytes
+            (defaults to DOWNLOAD_STREAMS_PER_FILE)
+        @param chunkSize: (int) bytes per chunk (defaults to DOWNLOAD_CHUNK_SIZE); rounded to a whole number of parts for multipart ETags
+        """
+        if streams is None:
+            streams = ConfigurationServices.GetConfig("DOWNLOAD_STREAMS_PER_FILE")
+        if chunkSize is None:
+            chunkSize = ConfigurationServices.GetConfig("DOWNLOAD_CHUNK_SIZE")
+        self.api = api
+        self.fileId = appResultFile.Id
+        self.name = appResultFile.Name
+        self.size = appResultFile.Size
+        self.path = os.path.join(outputDir, self.name)
+        self.partialPath = self.path + PARTIAL_SUFFIX
+        self.checkpointPath = self.path + CHECKPOINT_SUFFIX
+        self.chunkSize = chunkSize
+        self.streams = streams if self.size >= ConfigurationServices.GetConfig("DOWNLOAD_PARALLEL_MIN_SIZE") else 1
+        self.retries = ConfigurationServices.GetConfig("DOWNLOAD_CHUNK_RETRIES")
+        self.lock = threading.Lock()
+        self.url = None
+        self.etag = None
+        # how the ETag was made: the number of parts and their size (None for one part), or None if we can't reproduce it
+        self.numParts = None
+        self.partSize = None
+        # md5 of the file so far, for single part ETags, and the md5 of each part downloaded, for multipart ones
+        self.wholeMd5 = None
+        self.partMd5s = {}
+        # indexes of the chunks that are safely on disk
+        self.doneChunks = set()
+        self.bytesTransferred = 0
+        self.failed = False
+        self.sync = sync
+        self.previous = previous
+
+    def _PlanChunks(self):
+        """
+        fit the chunks to the way the file's ETag can be checked
+        """
+        self.numParts, partSizes = _ParseEtag(self.etag, self.size)
+        # checksum the parts as they arrive using the likeliest part size; the others are only tried if that doesn't match
+        self.partSize = partSizes[0] if partSizes else None
+        if self.partSize:
+            self.chunkSize = max(1, self.chunkSize // self.partSize) * self.partSize
+        elif self.numParts == 1:
+            # the md5 of the whole file has to be built up in order
+            self.streams = 1
+            self.wholeMd5 = hashlib.md5()
+
+    def _UpToDate(self):
+        """
+        @return (DownloadedFile): the file already in place, if it is the same as the one in BaseSpace, otherwise None
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) != self.size:
+            return None
+        previous = self.previous
+        if previous is not None and previous.path == self.path and previous.size == self.size and previous.etag == self.etag:
+            return previous._replace(fileId=self.fileId, transferred=0, skipped=True)
+        # not downloaded by us, or the manifest is out of date - check the file itself, which is still cheaper than fetching it
+        checksum = _MatchLocalFile(self.path, self.etag, self.size)
+        if checksum is not None:
+            return DownloadedFile(self.fileId, self.name, self.path, self.size, self.etag, checksum, VERIFIED_BY_ETAG, 0, True)
+        return None
+
+    def NumChunks(self):
+        return (self.size + self.chunkSize - 1) // self.chunkSize
+
+    def ChunkRange(self, index):
+        """
+        @return (int, int): the first and last byte of a chunk, inclusive (as for an HTTP range)
+        """
+        start = index * self.chunkSize
+        return start, min(start + self.chunkSize, self.size) - 1
+
+    def _LoadCheckpoint(self):
+        """
+        pick up the chunks already downloaded by an earlier attempt, if it was for the same version of the file
+        """
+        if not os.path.exists(self.checkpointPath) or not os.path.exists(self.partialPath):
+            return False
+        try:
+            checkpoint = json.load(open(self.checkpointPath))
+        except ValueError:
+            return False
+        if (checkpoint.get("id") != self.fileId or checkpoint.get("size") != self.size or checkpoint.get("etag") != self.etag
+                or checkpoint.get("chunksize") != self.chunkSize or os.path.getsize(self.partialPath) != self.size):
+            return False
+        self.doneChunks = set(checkpoint["done"])
+        self.partMd5s = dict((int(partIndex), digest) for partIndex, digest in checkpoint.get("parts", {}).iteritems())
+        if self.wholeMd5 is not None:
+            # a running md5 can't be saved, so rebuild it from the chunks on disk - only those before the first gap count
+            numDone = 0
+            while numDone in self.doneChunks:
+                numDone += 1
+            self.doneChunks = set(range(numDone))
+            with open(self.partialPath, "rb") as fh:
+                remaining = numDone and self.ChunkRange(numDone - 1)[1] + 1
+                while remaining:
+                    data = fh.read(min(READ_SIZE, remaining))
+                    self.wholeMd5.update(data)
+                    remaining -= len(data)
+        return True
+
+    def _SaveCheckpoint(self):
+        # callers hold the lock
+        _WriteJsonAtomically(self.checkpointPath, { "id" : self.fileId, "size" : self.size, "etag" : self.etag, "chunksize" : self.chunkSize,
+                                                    "done" : sorted(self.doneChunks), "parts" : self.partMd5s })
+
+    def _Reset(self):
+        # a fresh .partial file of the full size, so chunks can be written into place in any order
+        with open(self.partialPath, "wb") as fh:
+            fh.truncate(self.size)
+        self.doneChunks = set()
+        self.partMd5s = {}
+        self._SaveCheckpoint()
+
+    def _FetchChunkOnce(self, index):
+        """
+        @return (int, hashlib md5, dict): the bytes received, the md5 of the whole file up to the end of the chunk (if
+            we're keeping one) and the md5s of the parts in the chunk (if the file was uploaded in parts)
+        """
+        start, end = self.ChunkRange(index)
+        wholeMd5 = self.wholeMd5.copy() if self.wholeMd5 is not None else None
+        partHasher = _PartHasher(self.partSize, start) if self.partSize else None
+        request = urllib2.Request(self.url, headers={ "Range" : "bytes=%d-%d" % (start, end) })
+        response = urllib2.urlopen(request)
+        try:
+            if response.getcode() != 206 and not (response.getcode() == 200 and start == 0 and end == self.size - 1):
+                raise TransferServicesException("unexpected response to range request: %s" % response.getcode())
+            with open(self.partialPath, "r+b") as fh:
+                fh.seek(start)
+                received = 0
+                while True:
+                    data = response.read(READ_SIZE)
+                    if not data:
+                        break
+                    bandwidthLimiter.Consume(len(data))
+                    throughputMeter.Add(len(data))
+                    fh.write(data)
+                    received += len(data)
+                    if wholeMd5 is not None:
+                        wholeMd5.update(data)
+                    if partHasher is not None:
+                        partHasher.Update(data)
+                if received != end - start + 1:
+                    raise TransferServicesException("expected %d bytes but got %d" % (end - start + 1, received))
+                fh.flush()
+                os.fsync(fh.fileno())
+        finally:
+            response.close()
+        return received, wholeMd5, partHasher.Finish() if partHasher is not None else {}
+
+    def _FetchChunk(self, index):
+        """
+        download one chunk into place and record it in the checkpoint, retrying with a fresh URL if it fails
+        (the URLs BaseSpace gives out expire)
+
+        @return (str): an error, or None if the chunk was downloaded
+        """
+        if self.failed and self.wholeMd5 is not None:
+            # chunks have to arrive in order, so there's no point carrying on past a gap
+            return None
+        for attempt in range(self.retries + 1):
+            try:
+                received, wholeMd5, partMd5s = self._FetchChunkOnce(index)
+            except Exception as e:
+                logging.warn("chunk %d of %s failed (attempt %d): %s" % (index, self.name, attempt + 1, str(e)))
+                error = str(e)
+                try:
+                    with self.lock:
+                        self.url = _GetFileUrl(self.api, self.fileId)[0]
+                except TransferServicesException as te:
+                    error = str(te)
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            with self.lock:
+                self.doneChunks.add(index)
+                self.bytesTransferred += received
+                if wholeMd5 is not None:
+                    self.wholeMd5 = wholeMd5
+                self.partMd5s.update(partMd5s)
+                self._SaveCheckpoint()
+            return None
+        self.failed = True
+        return "chunk %d of %s failed: %s" % (index, self.name, error)
+
+    def _Checksum(self):
+        """
+        @return (str): the checksum of the downloaded file in the same form as its ETag, or None if it can't be checked
+        """
+        # a multipart ETag can have just one part, so check for parts first
+        if self.partSize:
+            return _CombinePartMd5s(self.partMd5s, self.numParts)
+        if self.numParts == 1:
+            return self.wholeMd5.hexdigest()
+        return None
+
+    def _Discard(self):
+        for path in [ self.partialPath, self.checkpointPath ]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def Run(self):
+        """
+        download the file, resuming an earlier attempt if possible, and verify it
+
+        @return (DownloadedFile)
+
+        @raises TransferServicesException: if the download fails, in which case the progress so far is kept for the next
+            attempt, or if the finished file doesn't match its size or ETag, in which case it is thrown away
+        """
+        self.url, self.etag = _GetFileUrl(self.api, self.fileId)
+        if self.sync:
+            upToDate = self._UpToDate()
+            if upToDate is not None:
+                return upToDate
+        self._PlanChunks()
+        if self._LoadCheckpoint():
+            logging.info("resuming %s: %d of %d chunks already downloaded" % (self.name, len(self.doneChunks), self.NumChunks()))
+        else:
+            self._Reset()
+        pending = [ index for index in range(self.NumChunks()) if index not in self.doneChunks ]
+        if pending:
+            chunkPool = ThreadPool(min(self.streams, len(pending)))
+            try:
+                errors = [ error for error in chunkPool.map(self._FetchChunk, pending) if error ]
+            finally:
+                chunkPool.close()
+                chunkPool.join()
+            if errors:
+                raise TransferServicesException("; ".join(errors))
+
+        if os.path.getsize(self.partialPath) != self.size:
+            self._Discard()
+            raise TransferServicesException("%s is %d bytes, expected %d" % (self.name, os.path.getsize(self.partialPath), self.size))
+        checksum = self._Checksum()
+        if checksum is None:
+            logging.warn("can't check %s against its ETag (%s), checked its size only" % (self.name, self.etag))
+            verification = VERIFIED_BY_SIZE
+        elif checksum == self.etag.strip('"').lower():
+            verification = VERIFIED_BY_ETAG
+        elif not self.partSize:
+            # the md5 of the whole file leaves no doubt
+            self._Discard()
+            raise TransferServicesException("checksum of %s does not match: got %s, expected %s" % (self.name, checksum, self.etag))
+        else:
+            # the part size was a guess - try the others it could have been, reading the file back
+            checksum = _MatchLocalFile(self.partialPath, self.etag, self.size, self.partSize)
+            if checksum is not None:
+                verification = VERIFIED_BY_ETAG
+            else:
+                logging.warn("can't find the part size %s was uploaded with to check it against its ETag (%s), checked its size only" % (self.name, self.etag))
+                verification = VERIFIED_BY_SIZE
+        os.rename(self.partialPath, self.path)
+        os.remove(self.checkpointPath)
+        return DownloadedFile(self.fileId, self.name, self.path, self.size, self.etag, checksum, verification, self.bytesTransferred, False)
+
+def DownloadFile(api, appResultFile, outputDir, streams=None, sync=False, previous=None):
+    """
+    Download a BaseSpace file into a directory, resuming any earlier interrupted attempt, and verify it against its size and ETag
+
+    @param api: (BaseSpaceAPI)
+    @param appResultFile: (BaseSpace file object)
+    @param outputDir: (str)
+    @param streams: (int) maximum number of ranges of a large file to fetch at once (defaults to DOWNLOAD_STREAMS_PER_FILE)
+    @param sync: (bool) if the file is already in place and matches, don't download it again (a DownloadedFile with
+        skipped set is returned). It matches if it has the size and ETag in the manifest entry, or its checksum matches the ETag
+    @param previous: (DownloadedFile) the manifest entry for an earlier download of the file, if there is one
+
+    @return (DownloadedFile)
+
+    @raises TransferServicesException: if the download fails or the file doesn't match its size or ETag
+    """
+    return ResumableDownload(api, appResultFile, outputDir, streams, sync=sync, previous=previous).Run()
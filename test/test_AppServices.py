@@ -0,0 +1,129 @@
+"""
+Tests for QC threshold evaluation and reading json metrics
+
+Run from the repository root with: python -m unittest discover test
+"""
+
+import os
+import sys
+import json
+import unittest
+from StringIO import StringIO
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import AppServices
+
+# metric values covering numbers, numbers stored as strings, and everything that can't be compared as a number
+VALUES = [ 5, 4, 6, 10.5, -1, 0, "5", "4.5", "6", "nan", None, "NA", "", "abc", "PASS", "FAIL" ]
+ABSENT = object()
+
+class ThresholdEvaluatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = AppServices.numpy
+
+    def tearDown(self):
+        AppServices.numpy = self.numpy
+
+    def _MetricsList(self, metricName):
+        metricsList = [ { metricName : value } for value in VALUES ]
+        # a set of metrics without this one at all
+        metricsList.append({})
+        return metricsList
+
+    def _SingleFailures(self, evaluator, metricsList):
+        # the failures each set of metrics gets when evaluated on its own
+        singleFailures = []
+        for metrics in metricsList:
+            if evaluator.metricNames.issubset(metrics):
+                singleFailures.append(evaluator.Evaluate(metrics))
+            else:
+                self.assertRaises(AppServices.AppServicesException, evaluator.Evaluate, metrics)
+                singleFailures.append([ failure for failure in [ evaluator._Check(check, metrics.get(check[0])) for check in evaluator.checks ] if failure ])
+        return singleFailures
+
+    def _AssertBatchMatchesSingle(self, thresholds):
+        evaluator = AppServices.ThresholdEvaluator(thresholds)
+        metricsList = self._MetricsList(sorted(thresholds)[0])
+        singleFailures = self._SingleFailures(evaluator, metricsList)
+        batchFailures = evaluator.EvaluateBatch(metricsList)
+        for metrics, single, batch in zip(metricsList, singleFailures, batchFailures):
+            self.assertEqual(batch, single, "%s: batch %s, single %s (%s)" % (metrics, batch, single, thresholds))
+        return batchFailures
+
+    def _AllOperators(self, threshold):
+        for operatorName in sorted(AppServices.THRESHOLD_OPERATORS):
+            batchFailures = self._AssertBatchMatchesSingle({ "metric" : { "operator" : operatorName, "threshold" : threshold } })
+            if isinstance(threshold, (int, float)):
+                # anything missing or not a number always fails a numeric threshold, whatever the operator
+                for metrics, failures in zip(self._MetricsList("metric"), batchFailures):
+                    value = metrics.get("metric")
+                    if value is None or value in [ "NA", "", "abc", "PASS", "FAIL" ]:
+                        self.assertEqual(len(failures), 1, "%s %s %s passed" % (value, operatorName, threshold))
+                        self.assertEqual(failures[0].error, "missing" if value is None else "not a number")
+
+    def testNumericThresholdWithNumpy(self):
+        if AppServices.numpy is None:
+            self.skipTest("numpy is not installed")
+        self._AllOperators(5)
+        self._AllOperators(4.5)
+
+    def testNumericThresholdWithoutNumpy(self):
+        AppServices.numpy = None
+        self._AllOperators(5)
+        self._AllOperators(4.5)
+
+    def testStringThreshold(self):
+        self._AllOperators("PASS")
+        AppServices.numpy = None
+        self._AllOperators("PASS")
+
+    def testSeveralMetrics(self):
+        thresholds = { "a" : { "operator" : "ne", "threshold" : 0 }, "b" : { "operator" : "ge", "threshold" : 30 } }
+        evaluator = AppServices.ThresholdEvaluator(thresholds)
+        metricsList = [ { "a" : 1, "b" : 30 }, { "a" : None, "b" : "NA" }, { "b" : 10 }, { "a" : 0, "b" : "31" } ]
+        failures = evaluator.EvaluateBatch(metricsList)
+        self.assertEqual(failures, self._SingleFailures(evaluator, metricsList))
+        self.assertEqual([ [ failure.metric for failure in sampleFailures ] for sampleFailures in failures ], [ [], [ "a", "b" ], [ "a", "b" ], [ "a" ] ])
+
+# objects whose values end at every point of a short read, including numbers that only look complete part way through
+JSON_OBJECTS = [
+    '{"T0": -2.5e10}',
+    '{"T0":-2.5E+10,"T1":1.25e-3 , "T2" : 0}',
+    '{ "a" : 10, "bb" : [1, 2.5, -3e2], "ccc" : { "x" : "y\\u00e9", "z" : null }, "d" : true, "e" : false }',
+    '{"table": {"header": ["name", "value"], "rows": [["x", 12345.678], ["y", -0.5]]}}\n',
+    '{}',
+    ' { } \n',
+]
+
+# objects followed by more than whitespace
+JSON_TRAILING_GARBAGE = [ '{"T0": 1}x', '{"T0": 1} 2', '{"T0": 1}}', '{} {}' ]
+
+class JsonObjectReaderTest(unittest.TestCase):
+
+    def _Items(self, text, readSize):
+        return list(AppServices._JsonObjectReader(StringIO(text), readSize).Items())
+
+    def testMatchesJsonLoads(self):
+        for text in JSON_OBJECTS:
+            for readSize in [ 1, 2, 3, 7 ]:
+                items = self._Items(text, readSize)
+                self.assertEqual(dict(items), json.loads(text), "%r read %d at a time: %r" % (text, readSize, items))
+                self.assertEqual(len(items), len(json.loads(text)))
+
+    def testTrailingGarbage(self):
+        for text in JSON_TRAILING_GARBAGE:
+            self.assertRaises(ValueError, json.loads, text)
+            for readSize in [ 1, 2, 3, 7 ]:
+                self.assertRaises(AppServices.AppServicesException, self._Items, text, readSize)
+
+    def testInvalid(self):
+        for text in [ '{"T0": -2.5e}', '{"T0": 1', '{"T0" 1}', '[1, 2]', '' ]:
+            for readSize in [ 1, 2, 3, 7 ]:
+                self.assertRaises(AppServices.AppServicesException, self._Items, text, readSize)
+
+if __name__ == "__main__":
+    unittest.main()
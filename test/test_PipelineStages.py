@@ -0,0 +1,114 @@
+"""
+Tests for how stage runs claim SampleApps, in a throwaway database
+
+Run from the repository root with: python -m unittest discover test
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import DBOrm
+import Repository
+import PipelineStages
+import ConfigurationServices
+
+NUM_SAMPLE_APPS = 6
+
+class BatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        DBOrm.database.init(os.path.join(self.tempDir, "test.db"))
+        DBOrm.database.create_tables(DBOrm.TABLES)
+        DBOrm.database.execute_sql(DBOrm.UPDATE_TRIGGER)
+        Repository.AddProject("P1", self.tempDir, "PRJ1")
+        Repository.AddApp("A1", "SingleGenome", "{}", "", "summary.csv", "{}", "bam", "1")
+        for index in range(NUM_SAMPLE_APPS):
+            Repository.AddSample("S%d" % index, "P1")
+            Repository.AddSampleApp("S%d" % index, "A1")
+        self.oldBatchSize = ConfigurationServices.GetConfig("CLAIM_BATCH_SIZE")
+        ConfigurationServices.config.CLAIM_BATCH_SIZE = 2
+        # count the claims each run makes
+        self.claimSampleApps = Repository.ClaimSampleApps
+        self.claims = 0
+        Repository.ClaimSampleApps = self._ClaimSampleApps
+
+    def tearDown(self):
+        Repository.ClaimSampleApps = self.claimSampleApps
+        ConfigurationServices.config.CLAIM_BATCH_SIZE = self.oldBatchSize
+        DBOrm.database.close()
+        shutil.rmtree(self.tempDir)
+
+    def _ClaimSampleApps(self, *args):
+        self.claims += 1
+        return self.claimSampleApps(*args)
+
+    def _Ids(self, batch):
+        return [ Repository.SampleAppToId(sampleApp) for sampleApp in batch ]
+
+    def _Run(self, statuses, process=None):
+        # the ids of each batch a whole queue run claims, processing each SampleApp as it goes
+        run = PipelineStages.StageRun("test")
+        batches = []
+        try:
+            for batch in run.Batches(statuses):
+                batches.append(self._Ids(batch))
+                for sampleApp in batch:
+                    run.Reached(sampleApp)
+                    if process:
+                        process(sampleApp)
+        finally:
+            run.Release()
+        return batches
+
+    def testStatusChangeMidRun(self):
+        # as the Tracker polling everything: a SampleApp moving to another status the run is claiming from gives up
+        # its claim, but isn't handed out again
+        allIds = self._Ids(Repository.GetSampleAppByConstraints({ "status" : "waiting" }))
+        for sampleApp in Repository.GetSampleAppByConstraints({ "status" : "waiting" }):
+            Repository.SetSampleAppStatus(sampleApp, "submitted")
+        process = lambda sampleApp: Repository.SetSampleAppStatus(sampleApp, "running")
+        self.assertEqual(self._Run([ "submitted", "pending", "running" ], process), [ allIds[0:2], allIds[2:4], allIds[4:6] ])
+        self.assertEqual(self.claims, 4)
+        self.assertEqual(self._Ids(Repository.GetSampleAppByConstraints({ "status" : "running" })), allIds)
+
+    def testCursorWrap(self):
+        allIds = self._Ids(Repository.GetSampleAppByConstraints({ "status" : "waiting" }))
+        Repository.SetStageCursor("test", allIds[2])
+        # one of those after the cursor is held by a run elsewhere
+        self.assertEqual(self._Ids(Repository.ClaimSampleApps("waiting", None, "elsewhere", 60, [ allIds[4] ])), [ allIds[4] ])
+        self.claims = 0
+        batches = self._Run([ "waiting" ])
+        self.assertEqual(batches, [ [ allIds[3], allIds[5] ], allIds[0:2], [ allIds[2] ] ])
+        # two past the cursor, one to go back round, and one to find nothing more up to the cursor
+        self.assertEqual(self.claims, 5)
+
+    def testTwoOwners(self):
+        # runs in two processes share out the queue between them, a batch at a time
+        first = PipelineStages.StageRun("test")
+        second = PipelineStages.StageRun("test")
+        second.owner = "elsewhere:1:test"
+        claimed = []
+        try:
+            firstBatches = first.Batches([ "waiting" ])
+            secondBatches = second.Batches([ "waiting" ])
+            claimed.extend(self._Ids(next(firstBatches)))
+            claimed.extend(self._Ids(next(secondBatches)))
+            claimed.extend(self._Ids(next(firstBatches)))
+            self.assertEqual(list(secondBatches), [])
+            self.assertEqual(list(firstBatches), [])
+        finally:
+            first.Release()
+            second.Release()
+        self.assertEqual(sorted(claimed), self._Ids(Repository.GetSampleAppByConstraints({ "status" : "waiting" })))
+        self.assertEqual(len(set(claimed)), NUM_SAMPLE_APPS)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Tests for recording SampleApp status changes, in a throwaway database
+
+Run from the repository root with: python -m unittest discover test
+"""
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import DBOrm
+import Repository
+
+LONG_AGO = datetime.datetime(2000, 1, 1)
+
+class LastUpdatedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        DBOrm.database.init(os.path.join(self.tempDir, "test.db"))
+        DBOrm.database.create_tables(DBOrm.TABLES)
+        DBOrm.database.execute_sql(DBOrm.UPDATE_TRIGGER)
+        Repository.AddProject("P1", self.tempDir, "PRJ1")
+        Repository.AddApp("A1", "SingleGenome", "{}", "", "summary.csv", "{}", "bam", "1")
+        Repository.AddSample("S1", "P1")
+        Repository.AddSampleApp("S1", "A1")
+        self.sampleAppId = Repository.SampleAppToId(Repository.GetSampleAppByConstraints({ "status" : "waiting" })[0])
+        # as if the SampleApp last changed long ago; only lastupdated is set, so the trigger leaves it be
+        DBOrm.SampleApp.update(lastupdated=LONG_AGO).where(DBOrm.SampleApp.id == self.sampleAppId).execute()
+
+    def tearDown(self):
+        DBOrm.database.close()
+        shutil.rmtree(self.tempDir)
+
+    def _LastUpdated(self):
+        return Repository.GetSampleAppByID(self.sampleAppId).lastupdated
+
+    def testStatusChangeThenLease(self):
+        sampleApp = Repository.GetSampleAppByID(self.sampleAppId)
+        Repository.SetSampleAppStatus(sampleApp, "downloading")
+        changed = self._LastUpdated()
+        self.assertTrue(changed > LONG_AGO)
+        # the same object, which still has the old lastupdated, saved again without changing the status
+        expiry = datetime.datetime.now() + datetime.timedelta(hours=1)
+        Repository.LeaseSampleApp(sampleApp, "downloading", "owner", expiry)
+        self.assertEqual(self._LastUpdated(), changed)
+        leased = Repository.GetSampleAppByID(self.sampleAppId)
+        self.assertEqual((leased.status, leased.leaseowner, leased.attempts), ("downloading", "owner", 1))
+
+    def testStaleObjectLeavesClaimAlone(self):
+        # a SampleApp read before another process claimed it doesn't write the old (empty) claim back
+        sampleApp = Repository.GetSampleAppByID(self.sampleAppId)
+        Repository.ClaimSampleApps("waiting", None, "elsewhere", 60)
+        Repository.SetSampleAppStatus(sampleApp, "waiting", "details only")
+        updated = Repository.GetSampleAppByID(self.sampleAppId)
+        self.assertEqual((updated.statusdetails, updated.leaseowner), ("details only", "elsewhere"))
+        self.assertTrue(updated.lastupdated > LONG_AGO)
+
+if __name__ == "__main__":
+    unittest.main()
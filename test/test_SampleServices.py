@@ -0,0 +1,112 @@
+"""
+Tests for sample yields and the readiness index
+
+Run from the repository root with: python -m unittest discover test
+"""
+
+import os
+import sys
+import datetime
+import unittest
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import SampleServices
+import ConfigurationServices
+
+PROJECT_ID = "test-project"
+
+def _Bundle(sampleName, index, numReads, read1, read2, paired, days):
+    return SampleServices.SampleBundle("%s-%d" % (sampleName, index), sampleName, datetime.datetime(2015, 1, 1) + datetime.timedelta(days=days),
+                                       numReads, read1, read2, paired)
+
+# several bundles per sample name, most recent not first, including a missing read2, unequal read lengths, a single
+# end bundle and bundles missing their number of reads or read length
+BUNDLES = [
+    _Bundle("S1", 0, 1000, 150, 150, True, 1),
+    _Bundle("S1", 1, 500, 150, 150, True, 3),
+    _Bundle("S1", 2, 200, 100, None, True, 2),
+    _Bundle("S2", 0, 300, 75, 0, False, 1),
+    _Bundle("S2", 1, 400, 150, 100, True, 0),
+    _Bundle("S3", 0, None, None, None, True, 5),
+    _Bundle("S4", 0, 600, None, 150, True, 2),
+    _Bundle("S4", 1, None, 150, 150, True, 1),
+]
+
+def _BaselineYield(bundle):
+    # the yield of a bundle as the Launcher has always measured it
+    if bundle.IsPairedEnd:
+        return float(bundle.NumReadsPF) * 2 * bundle.Read1
+    return float(bundle.NumReadsPF) * bundle.Read1
+
+class YieldTest(unittest.TestCase):
+
+    def setUp(self):
+        self.organised = SampleServices.OrganiseSamples(BUNDLES)
+        self.oldAggregation = ConfigurationServices.GetConfig("YieldAggregation")
+
+    def tearDown(self):
+        ConfigurationServices.config.YieldAggregation = self.oldAggregation
+        SampleServices.GetSamplesInProject.cache.clear()
+        SampleServices.GetReadinessIndex.cache.clear()
+
+    def _ReadinessIndex(self, aggregation):
+        ConfigurationServices.config.YieldAggregation = aggregation
+        SampleServices.GetSamplesInProject.cache[(PROJECT_ID,)] = self.organised
+        SampleServices.GetReadinessIndex.cache.clear()
+        return SampleServices.GetReadinessIndex(PROJECT_ID)
+
+    def testBundleYield(self):
+        self.assertEqual(SampleServices._BundleYield(BUNDLES[0]), 1000 * 300.0)
+        # read2 doesn't come into it, whether it is missing or differs from read1
+        self.assertEqual(SampleServices._BundleYield(BUNDLES[2]), 200 * 200.0)
+        self.assertEqual(SampleServices._BundleYield(BUNDLES[4]), 400 * 300.0)
+        self.assertEqual(SampleServices._BundleYield(BUNDLES[3]), 300 * 75.0)
+        for bundle in BUNDLES[:5]:
+            self.assertEqual(SampleServices._BundleYield(bundle), _BaselineYield(bundle))
+
+    def testMissingAttributes(self):
+        # a bundle without its number of reads or read length has no yield, rather than stopping the Launcher
+        for bundle in BUNDLES[5:]:
+            self.assertEqual(SampleServices._BundleYield(bundle), 0.0)
+
+    def testMostRecent(self):
+        sampleYields = SampleServices.ComputeYields(self.organised, "mostrecent")
+        self.assertEqual(sampleYields, { "S1" : 500 * 300.0, "S2" : 300 * 75.0, "S3" : 0.0, "S4" : 0.0 })
+        # the same as only ever looking at the most recent bundle
+        self.assertEqual(sampleYields["S1"], _BaselineYield(BUNDLES[1]))
+        self.assertEqual(sampleYields["S2"], _BaselineYield(BUNDLES[3]))
+
+    def testAll(self):
+        sampleYields = SampleServices.ComputeYields(self.organised, "all")
+        self.assertEqual(sampleYields, { "S1" : 1000 * 300.0 + 500 * 300.0 + 200 * 200.0, "S2" : 300 * 75.0 + 400 * 300.0, "S3" : 0.0, "S4" : 0.0 })
+
+    def testUnknownAggregation(self):
+        self.assertRaises(SampleServices.SampleServicesException, SampleServices.ComputeYields, self.organised, "newest")
+
+    def testReadinessIndexMatchesBundles(self):
+        # for each aggregation, the yield in the readiness index is the sum of the bundles it says counted towards it
+        for aggregation in SampleServices.YIELD_AGGREGATIONS:
+            sampleYields = SampleServices.ComputeYields(self.organised, aggregation)
+            readinessIndex = self._ReadinessIndex(aggregation)
+            self.assertEqual(sorted(readinessIndex), sorted(sampleYields))
+            for sampleName, readiness in readinessIndex.iteritems():
+                self.assertTrue(readiness.hasData)
+                self.assertEqual(readiness.mostRecent, max(self.organised[sampleName], key=lambda bundle: bundle.DateCreated))
+                self.assertEqual(readiness.bundles[0], readiness.mostRecent)
+                self.assertEqual(readiness.sampleYield, sampleYields[sampleName])
+                self.assertEqual(readiness.sampleYield, sum(SampleServices._BundleYield(bundle) for bundle in readiness.bundles))
+                if aggregation == "all":
+                    self.assertEqual(len(readiness.bundles), len(self.organised[sampleName]))
+                else:
+                    self.assertEqual(len(readiness.bundles), 1)
+
+    def testNoData(self):
+        self._ReadinessIndex("all")
+        self.assertEqual(SampleServices.GetSampleReadiness("missing", PROJECT_ID), SampleServices.NO_DATA)
+        self.assertFalse(SampleServices.SampleHasData("missing", PROJECT_ID))
+
+if __name__ == "__main__":
+    unittest.main()
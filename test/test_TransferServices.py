@@ -0,0 +1,169 @@
+"""
+Tests for checking downloaded files against their ETags
+
+Run from the repository root with: python -m unittest discover test
+"""
+
+import os
+import re
+import sys
+import random
+import shutil
+import hashlib
+import tempfile
+import unittest
+import urllib2
+from collections import namedtuple
+
+# Add relative path libraries
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.sep.join([SCRIPT_DIR, "..", "lib"])))
+
+import TransferServices
+
+MEGABYTE = TransferServices.MEGABYTE
+
+def _MultipartEtag(data, partSize):
+    # as S3 makes it: the md5 of the binary md5s of the parts, and the number of parts
+    parts = [ data[start:start + partSize] for start in range(0, len(data), partSize) ]
+    digests = "".join(hashlib.md5(part).digest() for part in parts)
+    return '"%s-%d"' % (hashlib.md5(digests).hexdigest(), len(parts))
+
+def _Data(size):
+    generator = random.Random(size)
+    return "".join(chr(generator.randint(0, 255)) for index in xrange(size % 4096)) + os.urandom(size - size % 4096)
+
+class ParseEtagTest(unittest.TestCase):
+
+    def _AssertCandidate(self, size, partSize):
+        numParts = (size + partSize - 1) // partSize
+        parsedParts, partSizes = TransferServices._ParseEtag("%s-%d" % ("0" * 32, numParts), size)
+        self.assertEqual(parsedParts, numParts)
+        self.assertIn(partSize, partSizes)
+        for candidate in partSizes:
+            self.assertEqual((size + candidate - 1) // candidate, numParts)
+            self.assertEqual(candidate % MEGABYTE, 0)
+        return partSizes
+
+    def testShortLastPart(self):
+        # all of these were once read as the smallest part size giving the right number of parts
+        self._AssertCandidate(150 * MEGABYTE, 100 * MEGABYTE)
+        self._AssertCandidate(130 * MEGABYTE, 64 * MEGABYTE)
+        self._AssertCandidate(20 * MEGABYTE + 5, 8 * MEGABYTE)
+        self._AssertCandidate(13 * MEGABYTE, 6 * MEGABYTE)
+
+    def testCommonSizesFirst(self):
+        self.assertEqual(self._AssertCandidate(150 * MEGABYTE, 100 * MEGABYTE)[0], 100 * MEGABYTE)
+        self.assertEqual(self._AssertCandidate(130 * MEGABYTE, 64 * MEGABYTE)[0], 64 * MEGABYTE)
+        self.assertEqual(self._AssertCandidate(20 * MEGABYTE + 5, 8 * MEGABYTE)[0], 8 * MEGABYTE)
+        # with no common size, the smallest comes first
+        self.assertEqual(self._AssertCandidate(13 * MEGABYTE, 6 * MEGABYTE), [ 5 * MEGABYTE, 6 * MEGABYTE ])
+
+    def testEveryCandidate(self):
+        # every whole megabyte part size that gives 2 parts
+        self.assertEqual(sorted(self._AssertCandidate(150 * MEGABYTE, 100 * MEGABYTE)), [ megabytes * MEGABYTE for megabytes in range(75, 150) ])
+
+    def testOtherEtags(self):
+        self.assertEqual(TransferServices._ParseEtag('"%s"' % ("a" * 32), 10), (1, []))
+        self.assertEqual(TransferServices._ParseEtag("%s-1" % ("a" * 32), 10), (1, [ MEGABYTE ]))
+        self.assertEqual(TransferServices._ParseEtag("not an md5", 10), (None, []))
+        self.assertEqual(TransferServices._ParseEtag(None, 10), (None, []))
+        # can't be 5 whole megabyte parts
+        self.assertEqual(TransferServices._ParseEtag("%s-5" % ("a" * 32), 3 * MEGABYTE), (None, []))
+
+# a BaseSpace file, as far as ResumableDownload is concerned
+FakeFile = namedtuple("FakeFile", [ "Id", "Name", "Size" ])
+
+class _FakeApi(object):
+    def __init__(self, etag):
+        self.etag = etag
+
+    def fileS3metadata(self, fileId):
+        return { "url" : "http://storage.invalid/%s" % fileId, "etag" : self.etag }
+
+class _FakeResponse(object):
+    # a range of the file, as storage would send it
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def getcode(self):
+        return 206
+
+    def read(self, size):
+        piece = self.data[self.offset:self.offset + size]
+        self.offset += len(piece)
+        return piece
+
+    def close(self):
+        pass
+
+class ResumableDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outputDir = tempfile.mkdtemp()
+        self.urlopen = urllib2.urlopen
+        urllib2.urlopen = self._Urlopen
+        self.data = None
+
+    def tearDown(self):
+        urllib2.urlopen = self.urlopen
+        shutil.rmtree(self.outputDir)
+
+    def _Urlopen(self, request):
+        start, end = [ int(position) for position in re.match(r"bytes=(\d+)-(\d+)", request.get_header("Range")).groups() ]
+        return _FakeResponse(self.data[start:end + 1])
+
+    def _Download(self, data, etag):
+        self.data = data
+        downloadedFile = FakeFile("file1", "file1.bam", len(data))
+        download = TransferServices.ResumableDownload(_FakeApi(etag), downloadedFile, self.outputDir, streams=2, chunkSize=4 * MEGABYTE)
+        return download, os.path.join(self.outputDir, downloadedFile.Name)
+
+    def _AssertVerifiedByEtag(self, data, partSize):
+        etag = _MultipartEtag(data, partSize)
+        download, path = self._Download(data, etag)
+        downloaded = download.Run()
+        self.assertEqual(downloaded.verification, TransferServices.VERIFIED_BY_ETAG)
+        self.assertEqual(downloaded.checksum, etag.strip('"'))
+        self.assertEqual(open(path, "rb").read(), data)
+        # and again from disk, as when syncing
+        self.assertEqual(TransferServices._MatchLocalFile(path, etag, len(data)), etag.strip('"'))
+        os.remove(path)
+
+    def testShortLastPartGuessedRight(self):
+        # the usual S3 default
+        self._AssertVerifiedByEtag(_Data(20 * MEGABYTE + 5), 8 * MEGABYTE)
+
+    def testShortLastPartGuessedWrong(self):
+        # streamed with 5MB parts, found to be 6MB parts when read back
+        self._AssertVerifiedByEtag(_Data(13 * MEGABYTE), 6 * MEGABYTE)
+
+    def testSinglePartMultipartEtag(self):
+        self._AssertVerifiedByEtag(_Data(3 * MEGABYTE + 7), 8 * MEGABYTE)
+
+    def testNoPartSizeMatches(self):
+        # the file is kept, checked by its size only
+        data = _Data(13 * MEGABYTE)
+        download, path = self._Download(data, "%s-3" % ("0" * 32))
+        downloaded = download.Run()
+        self.assertEqual(downloaded.verification, TransferServices.VERIFIED_BY_SIZE)
+        self.assertEqual(downloaded.checksum, None)
+        self.assertEqual(open(path, "rb").read(), data)
+        self.assertEqual(TransferServices._MatchLocalFile(path, "%s-3" % ("0" * 32), len(data)), None)
+
+    def testSinglePartMismatch(self):
+        # the md5 of the whole file can't be wrong about how it was made, so a mismatch means a bad download
+        data = _Data(5 * MEGABYTE)
+        download, path = self._Download(data, '"%s"' % ("0" * 32))
+        self.assertRaises(TransferServices.TransferServicesException, download.Run)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + TransferServices.PARTIAL_SUFFIX))
+
+    def testSinglePart(self):
+        data = _Data(5 * MEGABYTE + 3)
+        download, path = self._Download(data, '"%s"' % hashlib.md5(data).hexdigest())
+        self.assertEqual(download.Run().verification, TransferServices.VERIFIED_BY_ETAG)
+
+if __name__ == "__main__":
+    unittest.main()